@@ -6,9 +6,14 @@
 
 from datetime import datetime
 from email.utils import parsedate
-import copy, logging, mimetools, types, urllib, urllib2, urlparse
+import copy, logging, mimetools, Queue, StringIO, threading, time, types, urllib, urllib2, urlparse
 
 from guernsey.entities import *
+from guernsey.headers import HeaderMap
+from guernsey.urls import UriTemplate, join_url, legacy_expand, split_url
+from guernsey.connections import ConnectionPool, DeadlineExceededError, PooledHTTPHandler, PooledHTTPSHandler, TimeoutRedirectHandler
+from guernsey.executor import BatchResult, RequestExecutor, ResponseFuture
+from guernsey.cache import ParsedEntityCache
 
 class RequestWithMethod(urllib2.Request):
     """ This simple class is used to allow us to use the standard urllib2
@@ -31,6 +36,345 @@ class RequestWithMethod(urllib2.Request):
         """
         return self._method
 
+class FilterLink(object):
+    """ A link in a compiled filter chain, which records the position of 
+        its filter in the chain so that :py:func:`ClientRequest.next_filter`
+        does not have to search for it. Any attribute not defined by the
+        link is taken from the filter itself.
+
+        The class supports the following data members.
+
+        * ``filter`` - the :class:`ClientFilter` at this point in the chain.
+        * ``position`` - the index of this link in the chain.
+    """
+    __slots__ = ('filter', 'position')
+
+    def __init__(self, filter, position):
+        self.filter = filter
+        self.position = position
+
+    def handle(self, client_request):
+        """ handle(client_request) -> ClientResponse
+            Call the filter's ``handle`` method, with the request's current
+            position in the chain set to this link for the duration of 
+            the call.
+
+            :type client_request: :class:`ClientRequest`
+            :param client_request: The request to pass to the filter.
+            :rtype: :class:`ClientResponse`
+        """
+        position = client_request.position
+        client_request.position = self.position
+        try:
+            return self.filter.handle(client_request)
+        finally:
+            client_request.position = position
+
+    def __getattr__(self, name):
+        if name in FilterLink.__slots__:
+            raise AttributeError(name)
+        return getattr(self.filter, name)
+
+    def __repr__(self):
+        return '<FilterLink %d %r>' % (self.position, self.filter)
+
+class ProfilingFilterLink(FilterLink):
+    """ A :class:`FilterLink` which records the time spent in its filter in
+        the request's ``profile``, a :class:`FilterProfile`. Chains of these
+        links are used in place of plain links when the client has a 
+        ``profiler``.
+    """
+    __slots__ = ()
+
+    def handle(self, client_request):
+        position = client_request.position
+        client_request.position = self.position
+        start = time.time()
+        try:
+            return self.filter.handle(client_request)
+        finally:
+            client_request.profile.record(self.position, start, time.time())
+            client_request.position = position
+
+    def __repr__(self):
+        return '<ProfilingFilterLink %d %r>' % (self.position, self.filter)
+
+
+def filter_name(filter):
+    """ filter_name(filter) -> string
+        Return the name used to report the time spent in a filter, this is
+        the name of the filter's class.
+
+        :type filter: :class:`ClientFilter`
+        :param filter: The filter.
+        :rtype: string
+    """
+    return filter.__class__.__name__
+
+
+class FilterProfile(object):
+    """ The time spent in each filter of a chain while handling a single
+        request, and in parsing the response entity. The time spent in a
+        filter does not include the time spent in the filters after it in
+        the chain, and is split into a request phase (before the filter 
+        first calls the next filter) and a response phase (everything else,
+        including time between calls if the filter calls the next filter
+        more than once). The time for the last filter in the chain, the
+        client's ``ExecClientFilter``, is the time spent on the network.
+
+        The class supports the following data members.
+
+        * ``filters`` - the filters in the chain, in order.
+        * ``intervals`` - a list of ``(position, start, end)`` tuples, one
+          for each call to a filter.
+        * ``parse`` - the seconds spent parsing the response entity.
+    """
+    def __init__(self, chain):
+        """ FilterProfile(chain) -> FilterProfile
+        """
+        self.filters = [link.filter for link in chain]
+        self.intervals = []
+        self.parse = 0.0
+
+    def record(self, position, start, end):
+        """ record(position, start, end)
+            Record a call to the filter at ``position`` in the chain.
+
+            :type position: int
+            :param position: The position of the filter in the chain.
+            :type start: float
+            :param start: The time the filter was called.
+            :type end: float
+            :param end: The time the filter returned.
+        """
+        self.intervals.append((position, start, end))
+
+    def phases(self):
+        """ phases() -> list
+            Return a list of ``(name, calls, request, response)`` tuples,
+            one for each filter in the chain which was called, giving the
+            number of times the filter was called and the seconds it spent
+            in each phase. If the response entity has been parsed the list
+            ends with an entry for ``parse_entity``, with the time spent in
+            its response phase.
+
+            :rtype: list
+        """
+        phases = []
+        for (position, filter) in enumerate(self.filters):
+            calls = [(s, e) for (p, s, e) in self.intervals if p == position]
+            if len(calls) == 0:
+                continue
+            inner = [(s, e) for (p, s, e) in self.intervals if p == position + 1]
+            (request, response) = (0.0, 0.0)
+            for (start, end) in calls:
+                children = [(max(s, start), min(e, end)) for (s, e) in inner if s >= start and s <= end]
+                children.sort()
+                if len(children) == 0:
+                    request = request + (end - start)
+                    continue
+                covered = 0.0
+                (low, high) = children[0]
+                for (s, e) in children[1:]:
+                    if s > high:
+                        covered = covered + (high - low)
+                        low = s
+                    high = max(high, e)
+                covered = covered + (high - low)
+                before = children[0][0] - start
+                request = request + before
+                response = response + max(0.0, (end - start) - covered - before)
+            phases.append((filter_name(filter), len(calls), request, response))
+        if self.parse > 0:
+            phases.append(('parse_entity', 1, 0.0, self.parse))
+        return phases
+
+    def total(self):
+        """ total() -> float
+            Return the total seconds spent in all filters and parsing.
+
+            :rtype: float
+        """
+        return sum([request + response for (name, calls, request, response) in self.phases()])
+
+
+class FilterProfiler(object):
+    """ Aggregates the :class:`FilterProfile` of each request made by a 
+        client, by filter name. A client only profiles its filter chains if
+        it has a profiler, either by setting the ``profile_filters`` 
+        configuration value or by assigning a profiler to the client's 
+        ``profiler`` member; otherwise chains are built from plain
+        :class:`FilterLink` objects and cost nothing extra.
+
+        The class supports the following data members.
+
+        * ``requests`` - the number of requests profiled.
+        * ``totals`` - a dictionary of filter name to a list of the number
+          of calls, request phase seconds and response phase seconds.
+    """
+    def __init__(self):
+        """ FilterProfiler() -> FilterProfiler
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ reset()
+            Discard all recorded timings.
+        """
+        self.lock.acquire()
+        try:
+            self.requests = 0
+            self.totals = {}
+        finally:
+            self.lock.release()
+
+    def add(self, profile):
+        """ add(profile)
+            Add the filter timings for a completed request.
+
+            :type profile: :class:`FilterProfile`
+            :param profile: The profile of the request.
+        """
+        phases = profile.phases()
+        self.lock.acquire()
+        try:
+            self.requests = self.requests + 1
+            for (name, calls, request, response) in phases:
+                self._add(name, calls, request, response)
+        finally:
+            self.lock.release()
+
+    def add_parse(self, seconds):
+        """ add_parse(seconds)
+            Add the time spent parsing a response entity, which may happen
+            after the request's profile has been added.
+
+            :type seconds: float
+            :param seconds: The time spent in ``parse_entity``.
+        """
+        self.lock.acquire()
+        try:
+            self._add('parse_entity', 1, 0.0, seconds)
+        finally:
+            self.lock.release()
+
+    def _add(self, name, calls, request, response):
+        totals = self.totals.setdefault(name, [0, 0.0, 0.0])
+        totals[0] = totals[0] + calls
+        totals[1] = totals[1] + request
+        totals[2] = totals[2] + response
+
+    def summary(self):
+        """ summary() -> dict
+            Return a dictionary of filter name to a dictionary of ``calls``,
+            ``request``, ``response`` and ``total`` seconds and the ``mean``
+            seconds per call.
+
+            :rtype: dict
+        """
+        summary = {}
+        self.lock.acquire()
+        try:
+            for (name, (calls, request, response)) in self.totals.items():
+                summary[name] = {'calls': calls, 'request': request, 'response': response,
+                    'total': request + response, 'mean': (request + response) / calls}
+        finally:
+            self.lock.release()
+        return summary
+
+
+class FilterList(list):
+    """ The list of filters for a :class:`Client` or :class:`WebResource`,
+        this compiles the filters into a chain of :class:`FilterLink` objects
+        which is kept until the list is changed, so that the cost of each
+        request does not depend on the number of filters.
+    """
+    def __init__(self, filters=()):
+        list.__init__(self, filters)
+        self.compiled = None
+
+    def changed(self):
+        """ changed()
+            Discard the compiled chain, this is called by all the list 
+            methods which modify the filters.
+        """
+        self.compiled = None
+
+    def compile(self, last, link_class=FilterLink):
+        """ compile(last, link_class=FilterLink) -> tuple
+            Return the chain of :class:`FilterLink` objects for these 
+            filters followed by the filter ``last``, which is usually the
+            client's ``actual_client``.
+
+            :type last: :class:`ClientFilter`
+            :param last: The filter at the end of the chain.
+            :type link_class: class
+            :param link_class: The class of link to use, either 
+                :class:`FilterLink` or :class:`ProfilingFilterLink`.
+            :rtype: tuple of :class:`FilterLink`
+        """
+        compiled = self.compiled
+        if compiled is None or not compiled[0] is last or not compiled[1] is link_class:
+            filters = list(self) + [last]
+            compiled = (last, link_class, tuple([link_class(f, i) for (i, f) in enumerate(filters)]))
+            self.compiled = compiled
+        return compiled[2]
+
+    def append(self, filter):
+        list.append(self, filter)
+        self.changed()
+
+    def extend(self, filters):
+        list.extend(self, filters)
+        self.changed()
+
+    def insert(self, position, filter):
+        list.insert(self, position, filter)
+        self.changed()
+
+    def remove(self, filter):
+        list.remove(self, filter)
+        self.changed()
+
+    def pop(self, *args):
+        result = list.pop(self, *args)
+        self.changed()
+        return result
+
+    def reverse(self):
+        list.reverse(self)
+        self.changed()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.changed()
+
+    def __setitem__(self, position, filter):
+        list.__setitem__(self, position, filter)
+        self.changed()
+
+    def __delitem__(self, position):
+        list.__delitem__(self, position)
+        self.changed()
+
+    def __setslice__(self, start, end, filters):
+        list.__setslice__(self, start, end, filters)
+        self.changed()
+
+    def __delslice__(self, start, end):
+        list.__delslice__(self, start, end)
+        self.changed()
+
+    def __iadd__(self, filters):
+        self.extend(filters)
+        return self
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self.changed()
+        return self
+
 class Filterable(object):
     """ Base class for :class:`Client` and :class:`WebResource` which 
         provides the common implementation of a filter list. Note that
@@ -39,11 +383,24 @@ class Filterable(object):
 
         The class supports the following data members.
 
-        * ``filters`` - the list of filters to execute.
+        * ``filters`` - the list of filters to execute, this is a 
+          :class:`FilterList`; assigning a plain list is also supported.
     """
+    __slots__ = ()
+
     def __init__(self):
         self.filters = []
 
+    def _get_filters(self):
+        return self._filters
+
+    def _set_filters(self, filters):
+        if not isinstance(filters, FilterList):
+            filters = FilterList(filters)
+        self._filters = filters
+
+    filters = property(_get_filters, _set_filters)
+
     def add_filter(self, filter):
         """ add_filter(filter) -> Filterable
             Add a filter to the chain for this resource, note that filters
@@ -110,9 +467,59 @@ class Client(Filterable):
 
         * ``config`` - the configuration properties provided on construction.
         * ``entity_classes`` - the set of EntityReader and EntityWriter 
-          objects used to marshall objects to/from Python.
+          objects used to marshall objects to/from Python, this is a 
+          :class:`guernsey.entities.EntityRegistry` which indexes them
+          by media type; assigning a plain list is also supported.
         * ``filters`` - the default set of filters used to handle actual
           request/response objects.
+        * ``connection_pool`` - the :class:`guernsey.connections.ConnectionPool`
+          of persistent connections shared by all resources created by 
+          this client.
+        * ``executor`` - the :class:`guernsey.executor.RequestExecutor` 
+          used to run the ``*_async`` methods on resources.
+        * ``entity_cache`` - an optional :class:`guernsey.cache.ParsedEntityCache`
+          used by :py:func:`parse_entity`, ``None`` unless configured.
+        * ``profiler`` - an optional :class:`FilterProfiler` which records
+          the time spent in each filter, ``None`` unless configured.
+        * ``actual_client`` - the transport, the filter at the end of every
+          filter chain which actually sends requests. This may be replaced
+          at any time, for example by a 
+          :class:`guernsey.http2.Http2Transport`.
+
+        The following configuration values are recognized.
+
+        * ``max_connections_per_host`` - the maximum number of idle 
+          connections kept for each scheme/host/port; default is 4.
+        * ``connection_idle_timeout`` - the number of seconds an idle
+          connection is kept before it is closed; default is 30.
+        * ``max_workers`` - the maximum number of worker threads used
+          to run asynchronous requests, and so the number which may be in 
+          flight at once; default is 10.
+        * ``entity_cache_size`` - if specified, the size in bytes of a
+          cache of parsed entities; default is no cache.
+        * ``entity_cache_copy`` - whether the entity cache returns copies
+          of cached values; default is ``False``, cached values are shared
+          and must be treated as read-only.
+        * ``json_backend`` - the name of the JSON implementation used by
+          the JSON reader and writer (``ujson``, ``simplejson`` or ``json``);
+          default is the fastest installed.
+        * ``connect_timeout`` - the number of seconds to wait to connect to
+          a server; default is no timeout.
+        * ``read_timeout`` - the number of seconds to wait for data from a
+          server; default is no timeout.
+        * ``deadline`` - the number of seconds allowed for a request, 
+          including all filters, retries and redirects; default is no 
+          deadline.
+        * ``profile_filters`` - if ``True`` the time spent in each filter
+          is recorded in the client's ``profiler``; default is ``False``.
+        * ``immutable_resources`` - if ``True`` resources created by the
+          client are immutable, see :py:func:`WebResource.freeze`; default
+          is ``False``.
+        * ``transport`` - the filter at the end of every filter chain which
+          actually sends requests, either a :class:`ClientFilter` or 
+          ``http2`` for a :class:`guernsey.http2.Http2Transport` (which 
+          requires the ``h2`` package); default is an 
+          :class:`ExecClientFilter` using HTTP/1.1.
     """
     def __init__(self, config):
         """ Client(config)
@@ -128,28 +535,70 @@ class Client(Filterable):
         else:
             self.config = {}
         self.filters = []
-        self.entity_classes = [JsonReader(), JsonWriter(), XmlReader(), XmlWriter()]
+        json_backend = None
+        if not self.config.get('json_backend') is None:
+            json_backend = load_json_backend(self.config['json_backend'])
+        self.entity_classes = EntityRegistry([JsonReader(json_backend), JsonWriter(json_backend), XmlReader(), XmlWriter()])
         logging.getLogger('guernsey').debug('Initializing password manager')
         self.auth_handler = urllib2.HTTPBasicAuthHandler()
-        self.opener = urllib2.build_opener(self.auth_handler)
+        self.connection_pool = ConnectionPool(
+            self.config.get('max_connections_per_host', 4),
+            self.config.get('connection_idle_timeout', 30.0))
+        self.opener = urllib2.build_opener(self.auth_handler,
+            TimeoutRedirectHandler(),
+            PooledHTTPHandler(self.connection_pool),
+            PooledHTTPSHandler(self.connection_pool))
+        self.executor = RequestExecutor(self.config.get('max_workers', 10))
+        self.entity_cache = None
+        if not self.config.get('entity_cache_size') is None:
+            self.entity_cache = ParsedEntityCache(self.config['entity_cache_size'],
+                self.config.get('entity_cache_copy', False))
+        self.profiler = None
+        if self.config.get('profile_filters', False):
+            self.profiler = FilterProfiler()
+        self.immutable_resources = self.config.get('immutable_resources', False)
         self.actual_client = ExecClientFilter(self.opener)
+        transport = self.config.get('transport')
+        if transport == 'http2':
+            from guernsey.http2 import Http2Transport
+            self.actual_client = Http2Transport(fallback=self.actual_client)
+        elif not transport is None:
+            self.actual_client = transport
+
+    def _get_entity_classes(self):
+        return self._entity_classes
+
+    def _set_entity_classes(self, entity_classes):
+        if not isinstance(entity_classes, EntityRegistry):
+            entity_classes = EntityRegistry(entity_classes)
+        self._entity_classes = entity_classes
+
+    entity_classes = property(_get_entity_classes, _set_entity_classes)
 
     def resource(self, url, parameters=None):
         """ resource(url, parameters=None) -> WebResource
             This will construct a new :class:`WebResource` with the specified URL.
 
             :type url: string
-            :param url: the URL for the new resource, this MUST be an absolute URL.
+            :param url: the URL for the new resource, this MUST be an absolute 
+                URL, or a :class:`guernsey.urls.UriTemplate` which expands to
+                one.
 
             :type parameters: dict
             :param parameters: If ``parameters`` is specified then treat the
                 ``url`` as a template containing strings of the form "{key}" to be 
                 replaced with values from the dictionary.
             :rtype: :class:`WebResource`
+            :raises: KeyError if a string template refers to a key which is
+                not in ``parameters``.
         """
-        if isinstance(parameters, dict):
-            url = url.replace('{', '%(').replace('}', ')s')
-            url = url % parameters
+        if isinstance(url, UriTemplate):
+            url = url.expand(parameters or {})
+        elif isinstance(parameters, dict):
+            try:
+                url = UriTemplate.compile(url, True).expand(parameters)
+            except ValueError:
+                url = legacy_expand(url, parameters)
         return WebResource(url, self)
 
     def parse_http_date(self, s):
@@ -170,37 +619,189 @@ class Client(Filterable):
             Parse the data in the response from the server using all the
             configured entity class handlers. Will return a new response
             with any modification, usually this only sets the value of
-            the ``parsed_entity`` property.
+            the ``parsed_entity`` property. If the client has an
+            ``entity_cache`` a previously parsed value is reused when the
+            same entity is seen again. If the reader supports ``read_stream``
+            (as :class:`guernsey.entities.JsonStreamReader` does) and the 
+            response is streaming, the reader is given the response body 
+            as an iterator of chunks rather than the whole entity.
 
             :type client_response: :class:`ClientResponse`
             :param client_response: The response from the server itself.
             :rtype: :class:`ClientResponse`
         """
         client_response.parsed_entity = None
-        for reader in self.entity_classes:
-            if hasattr(reader, 'is_readable') and not client_response.type is None and reader.is_readable(client_response.type):
+        if client_response.type is None:
+            return client_response
+        reader = self.entity_classes.reader_for(client_response.type)
+        if reader is None:
+            return client_response
+        if hasattr(reader, 'read_stream'):
+            if client_response.body is None:
                 client_response.parsed_entity = reader.read(client_response.entity, client_response.type)
-                break
+            else:
+                chunks = client_response.iter_content(getattr(reader, 'chunk_size', 8192))
+                client_response.parsed_entity = reader.read_stream(chunks, client_response.type)
+            return client_response
+        key = None
+        if not self.entity_cache is None and isinstance(client_response.entity, basestring):
+            key = self.entity_cache.key(client_response.url, client_response.type,
+                client_response.entity_tag, client_response.entity)
+            (found, parsed_entity) = self.entity_cache.get(key)
+            if found:
+                client_response.parsed_entity = parsed_entity
+                return client_response
+        client_response.parsed_entity = reader.read(client_response.entity, client_response.type)
+        if not key is None:
+            self.entity_cache.put(key, len(client_response.entity), client_response.parsed_entity)
         return client_response
 
     def write_entity(self, client_request):
         """ write_entity(client_request) -> ClientRequest
             Write the Python data in the request entity using all the
-            configured entity class handlers.
+            configured entity class handlers. Entities which are already
+            strings, or which are streaming entities (file-like objects,
+            ``mmap`` objects and iterators of string chunks), are left
+            as-is to be sent without being held in memory. If the writer
+            returns an iterator from ``iter_write`` the entity is replaced
+            by that iterator and so is also sent as it is serialized.
 
             :type client_request: :class:`ClientRequest`
             :param client_request: the request to modify before sending
                 to the server.
             :rtype: :class:`ClientRequest`
         """
-        for writer in self.entity_classes:
-            if hasattr(writer, 'is_writable') and not client_request.entity is None and not client_request.type is None and writer.is_writable(client_request.entity, client_request.type):
-                fh = StringIO.StringIO()
-                writer.write(client_request.entity, client_request.type, fh)
-                client_request.entity = fh.getvalue()
+        entity = client_request.entity
+        if entity is None or client_request.type is None or isinstance(entity, basestring) or is_streaming_entity(entity):
+            return client_request
+        for writer in self.entity_classes.writers_for(client_request.type):
+            if writer.is_writable(entity, client_request.type):
+                chunks = None
+                if hasattr(writer, 'iter_write'):
+                    chunks = writer.iter_write(entity, client_request.type)
+                if chunks is None:
+                    fh = StringIO.StringIO()
+                    writer.write(entity, client_request.type, fh)
+                    chunks = fh.getvalue()
+                client_request.entity = chunks
                 break
-        return client_response
-        pass
+        return client_request
+
+    def execute_all(self, requests, max_workers=None, ordered=True):
+        """ execute_all(requests, max_workers=None, ordered=True) -> list
+            Execute a batch of requests concurrently, each request is a
+            tuple of ``(resource, method)`` or ``(resource, method, entity)``.
+            Requests are run on a bounded set of worker threads which share
+            this client's connection pool, and any exception raised by a 
+            request is captured in its :class:`guernsey.executor.BatchResult`
+            rather than raised.
+
+            Note that this should not be called from within a request 
+            running on the client's own executor (for example from an
+            ``*_async`` callback) unless ``max_workers`` is specified.
+
+            :type requests: iterable
+            :param requests: the sequence of request tuples to execute.
+            :type max_workers: int
+            :param max_workers: the number of worker threads to use for this
+                batch, if not specified the client's ``executor`` is used.
+                The threads exit once the batch has run, even if the caller
+                stops iterating over the results early.
+            :type ordered: Boolean
+            :param ordered: if ``True`` return a list of results in the same
+                order as ``requests``, else return an iterator which yields 
+                each result as it completes.
+            :rtype: list of :class:`guernsey.executor.BatchResult`
+        """
+        if max_workers is None:
+            executor = self.executor
+        else:
+            executor = RequestExecutor(max_workers)
+        completed = Queue.Queue()
+        futures = []
+        try:
+            for index, request in enumerate(requests):
+                (resource, method) = request[:2]
+                entity = None
+                if len(request) > 2:
+                    entity = request[2]
+                result = BatchResult(index, resource, method)
+                future = executor.submit(self._execute_one, resource, method, entity)
+                future.add_done_callback(lambda f, result=result: self._complete_one(f, result, completed))
+                futures.append(future)
+        finally:
+            if not max_workers is None:
+                # the workers run every queued request before they stop, 
+                # so however the results are consumed no thread is left.
+                executor.shutdown(False)
+        if ordered:
+            results = [None] * len(futures)
+            for i in range(len(futures)):
+                result = completed.get()
+                results[result.index] = result
+            return results
+        return self._iter_completed(completed, len(futures))
+
+    def _execute_one(self, resource, method, entity):
+        if not entity is None:
+            resource = resource.clone()
+            resource.req_entity = entity
+        return resource.handle(ClientRequest(resource, method))
+
+    def _complete_one(self, future, result, completed):
+        result.error = future.exception()
+        if result.error is None:
+            result.response = future.result()
+        completed.put(result)
+
+    def _iter_completed(self, completed, count):
+        for i in range(count):
+            yield completed.get()
+
+    def circuit_state(self, host):
+        """ circuit_state(host) -> string
+            Return the state of the circuit for the host, as kept by a 
+            :class:`guernsey.filters.CircuitBreakerFilter` added to this 
+            client, one of ``'closed'``, ``'open'`` or ``'half-open'``, or
+            ``None`` if the client has no circuit breaker.
+
+            :type host: string
+            :param host: a URL, host name or ``host:port``.
+            :rtype: string
+        """
+        for filter in self.filters:
+            if hasattr(filter, 'circuit_state'):
+                return filter.circuit_state(host)
+        return None
+
+    def metrics(self, format='dict'):
+        """ metrics(format='dict') -> object
+            Return a snapshot of the metrics recorded by a 
+            :class:`guernsey.filters.MetricsFilter` added to this client,
+            either as a dictionary or, if ``format`` is ``'prometheus'``, 
+            as a string in the Prometheus text exposition format. Returns
+            ``None`` if the client has no metrics filter.
+
+            :type format: string
+            :param format: either ``'dict'`` or ``'prometheus'``.
+            :rtype: object
+        """
+        for filter in self.filters:
+            if hasattr(filter, 'snapshot') and hasattr(filter, 'prometheus'):
+                if format == 'prometheus':
+                    return filter.prometheus()
+                return filter.snapshot()
+        return None
+
+    def close(self):
+        """ close()
+            Close any idle persistent connections held by this client, the
+            client may still be used after this call and will simply open
+            new connections as required.
+        """
+        self.connection_pool.close()
+        if hasattr(self.actual_client, 'close'):
+            self.actual_client.close()
 
     def add_basic_auth(realm, url, user, passwd):
         """ add_basic_auth(realm, url, user, passwd) 
@@ -231,6 +832,33 @@ class Client(Filterable):
         """
         return Client(config)
 
+# Marks a response date header which has not yet been parsed.
+UNPARSED = object()
+
+def _header_property(name):
+    """ A property for the value of the response header ``name``. """
+    def get(self):
+        return self.headers.get(name)
+    def set(self, value):
+        if value is None:
+            self.headers.pop(name, None)
+        else:
+            self.headers[name] = value
+    return property(get, set)
+
+def _date_property(name, slot):
+    """ A property for the response header ``name`` parsed as a date when
+        first accessed, and kept in the slot ``slot``. """
+    def get(self):
+        value = getattr(self, slot)
+        if value is UNPARSED:
+            value = self.client.parse_http_date(self.headers.get(name))
+            setattr(self, slot, value)
+        return value
+    def set(self, value):
+        setattr(self, slot, value)
+    return property(get, set)
+
 class ClientResponse(object):
     """ This represents the response from a server based on some request.
         This is commonly returned from one of the methods ``get``, ``head``,
@@ -244,9 +872,21 @@ class ClientResponse(object):
         * ``url``- the URL of the resource retrieved, note that this may be 
           different from the value requested if redirects were followed..
         * ``entity`` - the original entity, as a binary stream, retrieved.
+          For a streaming response this is read from ``body`` when first
+          accessed.
+        * ``parsed_entity`` - the entity parsed by the client's entity 
+          readers, this is parsed when first accessed so that callers which
+          only look at the status or headers do not pay for parsing.
+        * ``body`` - for a streaming response the file-like object from
+          which the entity may be read incrementally, ``None`` once the 
+          entity has been read.
+        * ``streaming`` - ``True`` if this response was requested in 
+          streaming mode.
         * ``status`` - the HTTP status code for this response.
         * ``reason_phrase`` - the HTTP reason phrase for this response.
-        * ``headers`` - the dictionary of all headers for this response.
+        * ``headers`` - the dictionary of all headers for this response, a
+          case-insensitive :class:`guernsey.headers.HeaderMap` which is only
+          parsed when first used.
         * ``allow`` - the value of the HTTP ``Allow`` response header.
         * ``entity_tag`` - the value of the HTTP ``ETag`` response header.`
         * ``language`` - the value of the HTTP ``Language`` response header.`
@@ -254,9 +894,23 @@ class ClientResponse(object):
         * ``location`` - the value of the HTTP ``Location`` response header.`
         * ``response_date`` - the value of the HTTP ``Date`` response header.`
         * ``type`` - the value of the HTTP ``Content-Type`` response header.`
+        * ``timings`` - a dictionary of the seconds spent in each phase of
+          the response, any of ``connect`` (zero for a reused connection),
+          ``first_byte`` (from sending the request to receiving the response
+          headers), ``read`` (reading the entity) and ``parse``.
+        * ``bytes_read`` - the number of bytes of the entity read so far.
+        * ``profile`` - the :class:`FilterProfile` of the time spent in each
+          filter, if the client has a ``profiler``, otherwise ``None``.
+
+        The header values above are read from ``headers`` when they are 
+        accessed, and the dates are parsed when first accessed.
     """
-    def __init__(self, resource, response, client):
-        """ ClientResponse(resource, response, client) -> ClientResponse
+    __slots__ = ('resource', 'client', 'streaming', 'body', 'url', 'status', 'reason_phrase',
+                 'headers', 'timings', 'listeners', 'bytes_read', 'profile',
+                 '_entity', '_parsed', '_parsed_entity', '_last_modified', '_response_date')
+
+    def __init__(self, resource, response, client, stream=False):
+        """ ClientResponse(resource, response, client, stream=False) -> ClientResponse
             construct a new response from the actual underlying HTTP response
             object. Also track the resource that created this response and
             the client.
@@ -264,26 +918,163 @@ class ClientResponse(object):
             :type resource: :class:`WebResource`
             :param resource: The resource that generated this response.
             :param response: The underlying HTTP response.
+            :type stream: Boolean
+            :param stream: If ``True`` the entity is not read, or parsed,
+                until it is asked for.
         """
         self.resource = resource
         self.client = client
-        self.entity = response.read()
+        self.streaming = stream
+        self.body = response
+        self._entity = None
+        self._parsed = False
+        self._parsed_entity = None
+        self._last_modified = self._response_date = UNPARSED
+        timings = getattr(response, 'timings', None)
+        if timings is None:
+            timings = getattr(getattr(response, 'fp', None), 'timings', None)
+        self.timings = dict(timings or ())
+        self.listeners = None
+        self.bytes_read = 0
+        self.profile = None
+        if not stream:
+            start = time.time()
+            self.entity = response.read()
+            self.bytes_read = len(self._entity)
+            self.record_timing('read', time.time() - start)
         self.url = response.geturl()
-        if isinstance(response.info(), mimetools.Message):
+        info = response.info()
+        if isinstance(info, mimetools.Message):
             self.status = response.getcode()
             self.reason_phrase = response.msg
-            self.headers = {}
-            for header in response.info().headers:
-                self.headers[header[:header.find(':')].lower()] = header[header.find(':')+1:].strip()
-            self.allow = self.headers.get('allow', None)
-            self.entity_tag = self.headers.get('etag', None)
-            self.language = self.headers.get('language', None)
-            self.last_modified = client.parse_http_date(self.headers.get('last-modified', None))
-            self.length = self.headers.get('content-length', None)
-            self.location = self.headers.get('location', None)
-            self.response_date = client.parse_http_date(self.headers.get('date', None))
-            self.type = self.headers.get('content-type', None)
+            self.headers = HeaderMap(info.headers)
+        else:
+            self.status = self.reason_phrase = None
+            self.headers = HeaderMap()
+
+    allow = _header_property('allow')
+    entity_tag = _header_property('etag')
+    language = _header_property('language')
+    length = _header_property('content-length')
+    location = _header_property('location')
+    type = _header_property('content-type')
+
+    last_modified = _date_property('last-modified', '_last_modified')
+    response_date = _date_property('date', '_response_date')
+
+    def _get_entity(self):
+        if not self.body is None:
+            start = time.time()
+            self._entity = self.body.read()
+            self.body = None
+            self.bytes_read = self.bytes_read + len(self._entity)
+            self.record_timing('read', time.time() - start)
+        return self._entity
+
+    def _set_entity(self, entity):
+        self._entity = entity
+        self.body = None
+
+    entity = property(_get_entity, _set_entity)
+
+    def _get_parsed_entity(self):
+        if not self._parsed:
+            try:
+                self.parse()
+            except:
+                self._parsed = False
+                raise
+        return self._parsed_entity
+
+    def _set_parsed_entity(self, parsed_entity):
+        self._parsed_entity = parsed_entity
+        self._parsed = True
+
+    parsed_entity = property(_get_parsed_entity, _set_parsed_entity)
+
+    def iter_content(self, chunk_size=8192):
+        """ iter_content(chunk_size=8192) -> iterator
+            Return an iterator over the entity in chunks of, at most, 
+            ``chunk_size`` bytes. For a streaming response the chunks
+            are read from ``body`` as they are requested so the entity
+            is never held in memory as a whole.
+
+            :type chunk_size: int
+            :param chunk_size: the maximum number of bytes per chunk.
+            :rtype: iterator
+        """
+        if self.body is None:
+            entity = self._entity or ''
+            for i in xrange(0, len(entity), chunk_size):
+                yield entity[i:i + chunk_size]
+        else:
+            body = self.body
+            elapsed = 0.0
+            while True:
+                start = time.time()
+                chunk = body.read(chunk_size)
+                elapsed = elapsed + time.time() - start
+                if chunk == '':
+                    break
+                self.bytes_read = self.bytes_read + len(chunk)
+                yield chunk
+            self.body = None
+            self.record_timing('read', elapsed)
+
+    def parse(self):
+        """ parse() -> object
+            Read and parse the entity using the client's configured entity
+            readers and return the parsed value, this is the same as
+            accessing ``parsed_entity`` except the entity is parsed again
+            even if it has been parsed before (for example after a filter
+            has replaced the ``entity``).
+
+            :rtype: object
+        """
+        start = time.time()
         self.client.parse_entity(self)
+        self.record_timing('parse', time.time() - start)
+        return self._parsed_entity
+
+    def add_listener(self, listener):
+        """ add_listener(listener) -> ClientResponse
+            Add a function to be called as ``listener(response, name, 
+            seconds)`` whenever a timing is recorded for this response 
+            after it has been returned, for example when the entity of a
+            streaming response has been read or when the entity is parsed.
+
+            :type listener: function
+            :param listener: the function to call.
+            :rtype: :class:`ClientResponse`
+        """
+        if self.listeners is None:
+            self.listeners = []
+        self.listeners.append(listener)
+        return self
+
+    def record_timing(self, name, seconds):
+        """ record_timing(name, seconds)
+            Record the time spent in a phase of the response in ``timings``
+            and notify any listeners.
+
+            :type name: string
+            :param name: the name of the phase.
+            :type seconds: float
+            :param seconds: the time spent.
+        """
+        self.timings[name] = seconds
+        if not self.listeners is None:
+            for listener in self.listeners:
+                listener(self, name, seconds)
+
+    def close(self):
+        """ close()
+            Close a streaming response without reading the rest of the 
+            entity; the underlying connection will not be reused.
+        """
+        if not self.body is None:
+            self.body.close()
+            self.body = None
 
 class WebResource(Filterable):
     """ This is the primary class used to represent a REST resource which a 
@@ -294,9 +1085,28 @@ class WebResource(Filterable):
         Note that nearly all methods either return the current, or a new
         instance of :class:`WebResource` which allows a chaining style of
         construction.
+
+        The class supports the following data members.
+
+        * ``url`` - the absolute URL of the resource, assigning a new URL 
+          validates it.
+        * ``parts`` - the components of ``url`` as a (read-only) 
+          ``urlparse.ParseResult``; resources derived with :py:func:`path`,
+          :py:func:`sub_resource` and :py:func:`query_params` are built from
+          these rather than by parsing the URL again.
+        * ``headers`` - the request headers for the resource; this may be
+          shared with other resources and should only be changed using
+          :py:func:`add_header` and the methods which call it.
+        * ``immutable`` - if ``True`` the methods which configure the 
+          resource return a new resource rather than changing this one, 
+          see :py:func:`freeze`.
     """
-    def __init__(self, url, client):
-        """ Webresource(URL, client) -> WebResource
+    __slots__ = ('_url', '_parts', 'client', '_filters', 'headers', 'req_entity', 'streaming',
+                 'connect_timeout', 'read_timeout', 'time_limit', 'immutable',
+                 'headers_shared', 'filters_shared')
+
+    def __init__(self, url, client, parts=None, immutable=None):
+        """ Webresource(URL, client, parts=None, immutable=None) -> WebResource
             Construct a new WebResource from a client, with the specified
             URL. Resources should not be created directly in this manner,
             rather they should use the ``create`` method on :class:`Client`
@@ -307,32 +1117,148 @@ class WebResource(Filterable):
             :param url: The absolute URL for the resource.
             :type client: :class:`Client`
             :param client: The client object to use for this resource.
+            :type parts: urlparse.ParseResult
+            :param parts: The already validated components of ``url``, used
+                when deriving one resource from another so that the URL is
+                not parsed again.
+            :type immutable: Boolean
+            :param immutable: Whether the resource is immutable, by default
+                the client's ``immutable_resources`` configuration.
             :rtype: WebResource
             :raises: ValueError if the URL is not absolute.
         """
-        self.url = url
-        check = urlparse.urlparse(url)
-        if check.scheme == '' or check.netloc == '':
-            raise ValueError('invalid URL value')
+        if parts is None:
+            self.url = url
+        else:
+            (self._url, self._parts) = (url, parts)
         self.client = client
         self.filters = client.filters
         self.headers = {}
         self.req_entity = None
+        self.streaming = False
+        self.connect_timeout = None
+        self.read_timeout = None
+        self.time_limit = None
+        if immutable is None:
+            immutable = client.immutable_resources
+        self.immutable = immutable
+        # the filters are the client's until the resource changes them.
+        self.headers_shared = False
+        self.filters_shared = True
+
+    def _get_url(self):
+        return self._url
+
+    def _set_url(self, url):
+        parts = split_url(url)
+        if parts.scheme == '' or parts.netloc == '':
+            raise ValueError('invalid URL value')
+        (self._url, self._parts) = (url, parts)
+
+    url = property(_get_url, _set_url)
+
+    def _get_parts(self):
+        return self._parts
+
+    parts = property(_get_parts)
 
     def clone(self):
         """ clone() -> WebResource
-            This will return a copy of the current resource with no shared data,
-            specifically will copy ``url``, ``filters``, ``headers`` and 
-            ``req_entity``.
+            This will return a copy of the current resource, which may be
+            changed without affecting this resource. The ``headers`` and 
+            ``filters`` are shared until either resource changes them, when
+            the resource changing them first takes its own copy. The 
+            ``req_entity`` is shared and so should be replaced, with 
+            :py:func:`entity`, rather than modified in place.
 
             :rtype: :class:`WebResource`
         """
-        r2 = WebResource(self.url, self.client)
-        r2.filters = self.filters[:]
-        r2.headers = self.headers.copy()
-        r2.req_entity = copy.deepcopy(self.req_entity)
+        r2 = WebResource(self._url, self.client, self._parts, self.immutable)
+        r2._filters = self._filters
+        r2.headers = self.headers
+        r2.req_entity = self.req_entity
+        r2.streaming = self.streaming
+        r2.connect_timeout = self.connect_timeout
+        r2.read_timeout = self.read_timeout
+        r2.time_limit = self.time_limit
+        r2.headers_shared = self.headers_shared = True
+        r2.filters_shared = self.filters_shared = True
         return r2
 
+    def freeze(self):
+        """ freeze() -> WebResource
+            Return an immutable copy of this resource, or the resource 
+            itself if it is already immutable. The methods which configure
+            an immutable resource, such as :py:func:`add_header`, 
+            :py:func:`accept`, :py:func:`entity` and :py:func:`add_filter`,
+            return a new resource which shares everything it does not 
+            change with this one, and the request methods never change the
+            resource. An immutable resource may therefore be shared between
+            threads, and used as the base for many requests, without being
+            cloned. All resources derived from an immutable resource, with
+            :py:func:`path` for example, are also immutable.
+
+            :rtype: :class:`WebResource`
+        """
+        if self.immutable:
+            return self
+        resource = self.clone()
+        resource.immutable = True
+        return resource
+
+    def _mutable(self):
+        """ _mutable() -> WebResource
+            Return the resource that a configuration method should change, 
+            which is this resource unless it is immutable.
+        """
+        if self.immutable:
+            return self.clone()
+        return self
+
+    def _own_headers(self):
+        if self.headers_shared:
+            self.headers = self.headers.copy()
+            self.headers_shared = False
+
+    def _own_filters(self):
+        if self.filters_shared:
+            self._filters = FilterList(self._filters)
+            self.filters_shared = False
+
+    def add_filter(self, filter):
+        """ add_filter(filter) -> WebResource
+            Add a filter to the head of the chain for this resource, as 
+            :py:func:`Filterable.add_filter`. The filters are copied the 
+            first time they are changed, so this does not add the filter to
+            the client or to other resources sharing the same filters. 
+            Returns a new resource if this one is immutable.
+
+            :type filter: :class:`ClientFilter`
+            :param filter: the filter to add.
+            :rtype: :class:`WebResource`
+        """
+        resource = self._mutable()
+        if not resource.is_filter_present(filter):
+            resource._own_filters()
+            resource.filters.insert(0, filter)
+        return resource
+
+    def remove_filter(self, filter):
+        """ remove_filter(filter) -> WebResource
+            Remove a filter from the chain for this resource, as 
+            :py:func:`Filterable.remove_filter`; like :py:func:`add_filter`
+            this does not change the client or other resources, and returns
+            a new resource if this one is immutable.
+
+            :type filter: :class:`ClientFilter`
+            :param filter: the filter to remove.
+            :rtype: :class:`WebResource`
+        """
+        resource = self._mutable()
+        resource._own_filters()
+        resource.filters.remove(filter)
+        return resource
+
     def query_params(self, params):
         """ query_params(params) -> WebResource
             Construct and return a new :class:`WebResource` whose URL is 
@@ -344,15 +1270,14 @@ class WebResource(Filterable):
                 into the resource URL query segment.
             :rtype: WebResource
         """
-        check = urlparse.urlparse(self.url, allow_fragments=True)
-        if check.query == '':
-            query_terms = '?' + urllib.urlencode(dictionary)
+        if self.parts.query == '':
+            query_terms = urllib.urlencode(params)
         else:
-            orig_query_terms = urlparse.parse_qsl(check.query)
-            new_query_terms = [(k, v) for k,v in dictionary.iteritems()]
-            query_terms = '?' + urllib.urlencode(orig_query_terms + new_query_terms)
-        new_url = urlparse.urljoin(self.url, query_terms)
-        return WebResource(new_url, self.client)
+            orig_query_terms = urlparse.parse_qsl(self.parts.query)
+            new_query_terms = [(k, v) for k,v in params.iteritems()]
+            query_terms = urllib.urlencode(orig_query_terms + new_query_terms)
+        parts = self.parts
+        return self._derive(urlparse.ParseResult(parts.scheme, parts.netloc, parts.path, parts.params, query_terms, ''))
 
     def sub_resource(self, append_path):
         """ sub_resource(append_path) -> WebResource
@@ -373,7 +1298,7 @@ class WebResource(Filterable):
         """
         if append_path.find('#') >= 0 or append_path.find('?') >= 0:
             raise ValueError('Invalid value for append_path, appears to include a query or fragment part.')
-        url = urlparse.urlparse(self.url, allow_fragments=True)
+        url = self.parts
         if url.path.endswith('/'):
             if append_path.startswith('/'):
                 new_path = url.path + append_path[1:]
@@ -384,8 +1309,7 @@ class WebResource(Filterable):
                 new_path = url.path + append_path
             else:
                 new_path = url.path + '/' + append_path
-        new_url = (url.scheme, url.netloc, new_path, url.params, url.query, url.fragment)
-        return WebResource(urlparse.urlunparse(new_url), self.client)
+        return self._derive(urlparse.ParseResult(url.scheme, url.netloc, new_path, url.params, url.query, url.fragment))
 
     def path(self, relative_path, parameters=None):
         """ path(relative_path, parameters=None) -> WebResource
@@ -396,22 +1320,47 @@ class WebResource(Filterable):
 
             :type relative_path: string
             :param relative_path: A path segment to resolve against the current
-                resource URL.
+                resource URL, or a :class:`guernsey.urls.UriTemplate`. An
+                absolute template is not resolved against the current URL.
             :type parameters: dict
             :param parameters: A dictionary of template parameter values, if
                 specified we assume that the relative_path is a template URL.
             :rtype: WebResource
+            :raises: KeyError if a string template refers to a key which is
+                not in ``parameters``.
+        """
+        template = None
+        if isinstance(relative_path, UriTemplate):
+            template = relative_path
+            parameters = parameters or {}
+        elif isinstance(parameters, dict):
+            try:
+                template = UriTemplate.compile(relative_path, True)
+            except ValueError:
+                relative_path = legacy_expand(relative_path, parameters)
+        if not template is None:
+            relative_path = template.expand(parameters)
+            if template.absolute:
+                return WebResource(relative_path, self.client, None, self.immutable)
+        parts = join_url(self.parts, relative_path)
+        if parts.scheme == '' or parts.netloc == '':
+            raise ValueError('invalid URL value')
+        return self._derive(parts)
+
+    def _derive(self, parts):
+        """ _derive(parts) -> WebResource
+            Return a new resource for the URL with the given components,
+            which have been derived from those of this resource and so need
+            not be parsed or validated again.
         """
-        if isinstance(parameters, dict):
-            relative_path = relative_path.replace('{', '%(').replace('}', ')s')
-            relative_path = relative_path % parameters
-        return WebResource(urlparse.urljoin(self.url, relative_path, True), self.client)
+        return WebResource(urlparse.urlunparse(parts), self.client, parts, self.immutable)
 
     def add_header(self, name, value, append=False):
         """ add_header(name, value, append=False) -> WebResource
             Add a custom header to the resource, all headers will be sent
             when the request for this resource is handled. This method will
-            return the current resource.
+            return the current resource, or a new resource if this one is
+            immutable.
 
             :type name: string
             :param name: The name of the header to add.
@@ -423,11 +1372,13 @@ class WebResource(Filterable):
                 value.
             :rtype: WebResource
         """
-        if append and name in self.headers:
-            self.headers[name] = "%s, %s" % (self.headers[name], value)
+        resource = self._mutable()
+        resource._own_headers()
+        if append and name in resource.headers:
+            resource.headers[name] = "%s, %s" % (resource.headers[name], value)
         else:
-            self.headers[name] = value
-        return self
+            resource.headers[name] = value
+        return resource
     
     def accept(self, content_type, quality=None):
         """ accept(content_type, quality=None) -> WebResource
@@ -445,8 +1396,7 @@ class WebResource(Filterable):
         """
         if not quality is None:
             content_type = "%s; q=%s" % (content_type, quality)
-        self.add_header('Accept', content_type, True)
-        return self
+        return self.add_header('Accept', content_type, True)
 
     def accept_encoding(self, encoding):
         """ accept_encoding(encoding) -> WebResource
@@ -457,8 +1407,7 @@ class WebResource(Filterable):
             :param encoding: An encoding value to add.
             :rtype: WebResource
         """
-        self.add_header('Accept-Language', language, True)
-        return self
+        return self.add_header('Accept-Encoding', encoding, True)
 
     def accept_language(self, language):
         """ accept_language(language) -> WebResource
@@ -469,8 +1418,7 @@ class WebResource(Filterable):
             :param language: A language value to add.
             :rtype: WebResource
         """
-        self.add_header('Accept-Language', language, True)
-        return self
+        return self.add_header('Accept-Language', language, True)
 
     def encoding(self, encoding):
         """ encoding(encoding) -> WebResource
@@ -480,8 +1428,7 @@ class WebResource(Filterable):
             :param encoding: An encoding value to add.
             :rtype: WebResource
         """
-        self.add_header('Content-Type', content_type)
-        return self
+        return self.add_header('Content-Encoding', encoding)
 
     def language(self, language):
         """ language(language) -> WebResource
@@ -491,8 +1438,7 @@ class WebResource(Filterable):
             :param language: A language value to add.
             :rtype: WebResource
         """
-        self.add_header('Content-Type', content_type)
-        return self
+        return self.add_header('Content-Language', language)
 
     def type(self, content_type):
         """ type(content_type) -> WebResource
@@ -502,91 +1448,349 @@ class WebResource(Filterable):
             :param content_type: A MIME type value to add.
             :rtype: WebResource
         """
-        self.add_header('Content-Type', content_type)
-        return self
+        return self.add_header('Content-Type', content_type)
 
     def entity(self, req_entity):
         """ entity() -> WebResource
             Set the data to be sent to the REST service as the entity body
             with this request.
 
-            :type req_entity: string
-            :param req_entity: An Entity type value to add.
+            :type req_entity: object
+            :param req_entity: An Entity type value to add; either a string,
+                a file-like or ``mmap`` object, an iterator of string chunks,
+                or an object to be written by an entity writer. File-like and
+                iterator entities are streamed to the server, with chunked 
+                transfer encoding if their length cannot be determined.
             :rtype: WebResource
         """
-        self.req_entity = req_entity
-        return self
+        resource = self._mutable()
+        resource.req_entity = req_entity
+        return resource
+
+    def stream(self, streaming=True):
+        """ stream(streaming=True) -> WebResource
+            Set whether responses for this resource are streamed, a 
+            streaming response does not read the entity until it is asked
+            for and does not parse it until ``parse()`` is called on the 
+            response. This may be overridden for an individual request with
+            the ``stream`` parameter on the request methods.
+
+            :type streaming: Boolean
+            :param streaming: ``True`` to stream response entities.
+            :rtype: WebResource
+        """
+        resource = self._mutable()
+        resource.streaming = streaming
+        return resource
+
+    def timeout(self, connect=None, read=None):
+        """ timeout(connect=None, read=None) -> WebResource
+            Set the connect and read timeouts for requests to this resource,
+            overriding the client's ``connect_timeout`` and ``read_timeout``
+            configuration. These may be overridden for an individual request
+            with the ``timeout`` parameter on the request methods.
+
+            :type connect: float
+            :param connect: the number of seconds to wait to connect.
+            :type read: float
+            :param read: the number of seconds to wait for data.
+            :rtype: WebResource
+        """
+        resource = self._mutable()
+        resource.connect_timeout = connect
+        resource.read_timeout = read
+        return resource
+
+    def deadline(self, seconds):
+        """ deadline(seconds) -> WebResource
+            Set the total time allowed for each request to this resource,
+            overriding the client's ``deadline`` configuration. The deadline
+            covers the whole filter chain, including any retries and 
+            redirects, and filters may find the time remaining with 
+            :py:func:`ClientRequest.remaining`.
+
+            :type seconds: float
+            :param seconds: the number of seconds allowed for a request.
+            :rtype: WebResource
+        """
+        resource = self._mutable()
+        resource.time_limit = seconds
+        return resource
 
-    def get(self):
-        """ get() -> ClientResponse
+    def get(self, stream=None, timeout=None):
+        """ get(stream=None, timeout=None) -> ClientResponse
             Perform a GET against the resource associated with the URL
             of this :class:`WebResource`.
 
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
             :rtype: :class:`ClientResponse`
         """
-        request = ClientRequest(self, 'GET')
+        request = ClientRequest(self, 'GET', stream, timeout)
         return self.handle(request)
 
-    def head(self):
-        """ head() -> ClientResponse
+    def head(self, timeout=None):
+        """ head(timeout=None) -> ClientResponse
             Perform a HEAD against the resource associated with the URL
             of this :class:`WebResource`.
 
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
             :rtype: :class:`ClientResponse`
         """
-        request = ClientRequest(self, 'HEAD')
+        request = ClientRequest(self, 'HEAD', None, timeout)
         return self.handle(request)
 
-    def put(self, entity=None):
-        """ put(entity=None) -> ClientResponse
+    def put(self, entity=None, stream=None, timeout=None):
+        """ put(entity=None, stream=None, timeout=None) -> ClientResponse
             Perform a PUT against the resource associated with the URL
             of this :class:`WebResource`.
 
-            :type entity: string
+            :type entity: object
             :param entity: The entity to send to the server, if not specified
-                any value set by the :py:func:`entity` will be used.
+                any value set by the :py:func:`entity` will be used. This may
+                be a string, a file-like or ``mmap`` object, an iterator of
+                string chunks or an object to be written by an entity writer.
+                The entity is also set on this resource, unless it is 
+                immutable.
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
             :rtype: :class:`ClientResponse`
         """
+        resource = self
         if not entity is None:
-            self.req_entity = entity
-        request = ClientRequest(self, 'PUT')
-        return self.handle(request)
+            resource = self.entity(entity)
+        request = ClientRequest(resource, 'PUT', stream, timeout)
+        return resource.handle(request)
 
-    def post(self, entity=None):
-        """ post(entity=None) -> ClientResponse
+    def post(self, entity=None, stream=None, timeout=None):
+        """ post(entity=None, stream=None, timeout=None) -> ClientResponse
             Perform a POST against the resource associated with the URL
             of this :class:`WebResource`.
 
-            :type entity: string
+            :type entity: object
             :param entity: The entity to send to the server, if not specified
-                any value set by the :py:func:`entity` will be used.
+                any value set by the :py:func:`entity` will be used. This may
+                be a string, a file-like or ``mmap`` object, an iterator of
+                string chunks or an object to be written by an entity writer.
+                The entity is also set on this resource, unless it is 
+                immutable.
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
             :rtype: :class:`ClientResponse`
         """
+        resource = self
         if not entity is None:
-            self.req_entity = entity
-        request = ClientRequest(self, 'POST')
-        return self.handle(request)
+            resource = self.entity(entity)
+        request = ClientRequest(resource, 'POST', stream, timeout)
+        return resource.handle(request)
 
-    def delete(self):
-        """ delete() -> ClientResponse
+    def delete(self, stream=None, timeout=None):
+        """ delete(stream=None, timeout=None) -> ClientResponse
             Perform a DELETE against the resource associated with the URL
             of this :class:`WebResource`.
 
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
             :rtype: :class:`ClientResponse`
         """
-        request = ClientRequest(self, 'DELETE')
+        request = ClientRequest(self, 'DELETE', stream, timeout)
         return self.handle(request)
 
-    def options(self):
-        """ options() -> ClientResponse
+    def options(self, stream=None, timeout=None):
+        """ options(stream=None, timeout=None) -> ClientResponse
             Perform an OPTIONS against the resource associated with the URL
             of this :class:`WebResource`.
 
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
             :rtype: :class:`ClientResponse`
         """
-        request = ClientRequest(self, 'OPTIONS')
+        request = ClientRequest(self, 'OPTIONS', stream, timeout)
         return self.handle(request)
 
+    def get_async(self, callback=None, stream=None, timeout=None):
+        """ get_async(callback=None, stream=None, timeout=None) -> ResponseFuture
+            Perform a GET, as :py:func:`get`, on one of the client's worker
+            threads and return immediately.
+
+            :type callback: function
+            :param callback: an optional function called with the future
+                when the request completes.
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
+            :rtype: :class:`guernsey.executor.ResponseFuture`
+        """
+        return self.submit('GET', None, callback, stream, timeout)
+
+    def head_async(self, callback=None, timeout=None):
+        """ head_async(callback=None, timeout=None) -> ResponseFuture
+            Perform a HEAD, as :py:func:`head`, on one of the client's 
+            worker threads and return immediately.
+
+            :type callback: function
+            :param callback: an optional function called with the future
+                when the request completes.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
+            :rtype: :class:`guernsey.executor.ResponseFuture`
+        """
+        return self.submit('HEAD', None, callback, None, timeout)
+
+    def put_async(self, entity=None, callback=None, stream=None, timeout=None):
+        """ put_async(entity=None, callback=None, stream=None, timeout=None) -> ResponseFuture
+            Perform a PUT, as :py:func:`put`, on one of the client's worker
+            threads and return immediately.
+
+            :type entity: string
+            :param entity: The entity to send to the server, if not specified
+                any value set by the :py:func:`entity` will be used.
+            :type callback: function
+            :param callback: an optional function called with the future
+                when the request completes.
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
+            :rtype: :class:`guernsey.executor.ResponseFuture`
+        """
+        return self.submit('PUT', entity, callback, stream, timeout)
+
+    def post_async(self, entity=None, callback=None, stream=None, timeout=None):
+        """ post_async(entity=None, callback=None, stream=None, timeout=None) -> ResponseFuture
+            Perform a POST, as :py:func:`post`, on one of the client's 
+            worker threads and return immediately.
+
+            :type entity: string
+            :param entity: The entity to send to the server, if not specified
+                any value set by the :py:func:`entity` will be used.
+            :type callback: function
+            :param callback: an optional function called with the future
+                when the request completes.
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
+            :rtype: :class:`guernsey.executor.ResponseFuture`
+        """
+        return self.submit('POST', entity, callback, stream, timeout)
+
+    def delete_async(self, callback=None, stream=None, timeout=None):
+        """ delete_async(callback=None, stream=None, timeout=None) -> ResponseFuture
+            Perform a DELETE, as :py:func:`delete`, on one of the client's
+            worker threads and return immediately.
+
+            :type callback: function
+            :param callback: an optional function called with the future
+                when the request completes.
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
+            :rtype: :class:`guernsey.executor.ResponseFuture`
+        """
+        return self.submit('DELETE', None, callback, stream, timeout)
+
+    def options_async(self, callback=None, stream=None, timeout=None):
+        """ options_async(callback=None, stream=None, timeout=None) -> ResponseFuture
+            Perform an OPTIONS, as :py:func:`options`, on one of the 
+            client's worker threads and return immediately.
+
+            :type callback: function
+            :param callback: an optional function called with the future
+                when the request completes.
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
+            :rtype: :class:`guernsey.executor.ResponseFuture`
+        """
+        return self.submit('OPTIONS', None, callback, stream, timeout)
+
+    def submit(self, method, entity=None, callback=None, stream=None, timeout=None):
+        """ submit(method, entity=None, callback=None, stream=None, timeout=None) -> ResponseFuture
+            Submit a request with the given method to the client's 
+            :class:`guernsey.executor.RequestExecutor`. The request is made
+            against a clone of this resource, so later changes to this
+            resource do not affect the request in flight; an immutable 
+            resource is used as it is. The same filter chain is executed as
+            for the synchronous methods. Each request occupies one of the
+            executor's ``max_workers`` threads until it completes, so once 
+            they are all busy further requests wait in a queue.
+
+            :type method: string
+            :param method: The HTTP method to use.
+            :type entity: string
+            :param entity: The entity to send to the server, if not specified
+                any value set by the :py:func:`entity` will be used.
+            :type callback: function
+            :param callback: an optional function called with the future
+                when the request completes.
+            :type stream: Boolean
+            :param stream: If specified, overrides the :py:func:`stream` 
+                setting for this resource.
+            :type timeout: float or tuple
+            :param timeout: If specified, overrides the :py:func:`timeout`
+                setting for this request, either a number of seconds for
+                both timeouts or a ``(connect, read)`` tuple.
+            :rtype: :class:`guernsey.executor.ResponseFuture`
+        """
+        resource = self
+        if not self.immutable:
+            resource = self.clone()
+        if not entity is None:
+            resource = resource.entity(entity)
+        future = self.client.executor.submit(resource.handle, ClientRequest(resource, method, stream, timeout))
+        if not callback is None:
+            future.add_done_callback(callback)
+        return future
+
     def handle(self, client_request):
         """ handle(client_request) -> ClientResponse
             This method is where we actually process a client request and 
@@ -598,9 +1802,27 @@ class WebResource(Filterable):
             :param client_request: The request to make to the server.
             :rtype: :class:`ClientResponse`
         """
-        client_request.set_filters(self.filters + [self.client.actual_client]);
-        final_response = client_request.filters[0].handle(client_request)
-        return final_response
+        self.client.write_entity(client_request)
+        profiler = self.client.profiler
+        if profiler is None:
+            chain = self.filters.compile(self.client.actual_client)
+            client_request.set_chain(chain)
+            return chain[0].handle(client_request)
+        chain = self.filters.compile(self.client.actual_client, ProfilingFilterLink)
+        client_request.set_chain(chain)
+        profile = client_request.profile = FilterProfile(chain)
+        try:
+            client_response = chain[0].handle(client_request)
+        finally:
+            profiler.add(profile)
+        if hasattr(client_response, 'add_listener'):
+            client_response.profile = profile
+            def parsed(response, name, seconds):
+                if name == 'parse':
+                    profile.parse = profile.parse + seconds
+                    profiler.add_parse(seconds)
+            client_response.add_listener(parsed)
+        return client_response
 
     def debug(self):
         return "<Web Resource '%s' %s>" % (self.url, repr(self.headers))
@@ -617,34 +1839,190 @@ class ClientRequest(object):
         * ``method`` - the HTTP method to use for this request.
         * ``url`` - the request URL.
         * ``resource`` - the originating resource itself.
+        * ``stream`` - whether the response entity should be streamed.
+        * ``entity`` - the request entity, initially the ``req_entity`` of
+          the resource.
+        * ``type`` - the ``Content-Type`` of the request entity.
+        * ``headers`` - headers added to this request only, these are sent
+          in addition to, and override, the headers of the resource.
+        * ``connect_timeout`` - the number of seconds to wait to connect, or
+          ``None``.
+        * ``read_timeout`` - the number of seconds to wait for data, or 
+          ``None``.
+        * ``deadline`` - the time (in seconds since the epoch) by which the
+          request must complete, or ``None``.
+        * ``chain`` - the compiled filter chain, a tuple of :class:`FilterLink`.
+        * ``position`` - the position in ``chain`` of the filter currently
+          handling the request.
+        * ``profile`` - the :class:`FilterProfile` recording the time spent
+          in each filter, if the client has a ``profiler``.
+        * ``cancelled`` - ``True`` once :py:func:`cancel` has been called.
+
+        Filters may add attributes of their own to a request.
     """
-    def __init__(self, resource, method):
-        """ ClientRequest(resource, method) -> ClientRequest
+    # __dict__ is kept so that filters may still add their own attributes,
+    # it is only allocated when one does.
+    __slots__ = ('resource', 'method', 'url', 'stream', 'entity', 'type', 'headers',
+                 'connect_timeout', 'read_timeout', 'deadline', 'chain', 'position', 'profile',
+                 'cancelled', 'cancellers', '__dict__')
+
+    def __init__(self, resource, method, stream=None, timeout=None):
+        """ ClientRequest(resource, method, stream=None, timeout=None) -> ClientRequest
         """
         self.resource = resource
         self.method = method
         self.url = resource.url
-        self.filters = []
+        if stream is None:
+            self.stream = resource.streaming
+        else:
+            self.stream = stream
+        self.entity = resource.req_entity
+        self.type = resource.headers.get('Content-Type', None)
+        self.headers = {}
+        config = resource.client.config
+        if timeout is None:
+            self.connect_timeout = resource.connect_timeout
+            if self.connect_timeout is None:
+                self.connect_timeout = config.get('connect_timeout')
+            self.read_timeout = resource.read_timeout
+            if self.read_timeout is None:
+                self.read_timeout = config.get('read_timeout')
+        elif isinstance(timeout, tuple):
+            (self.connect_timeout, self.read_timeout) = timeout
+        else:
+            self.connect_timeout = self.read_timeout = timeout
+        time_limit = resource.time_limit
+        if time_limit is None:
+            time_limit = config.get('deadline')
+        self.deadline = None
+        if not time_limit is None:
+            self.deadline = time.time() + time_limit
+        self.chain = ()
+        self.position = -1
+        self.profile = None
+        self.cancelled = False
+        self.cancellers = None
+
+    def remaining(self):
+        """ remaining() -> float
+            Return the number of seconds left before the request's 
+            ``deadline``, which may be zero, or ``None`` if there is no
+            deadline.
+
+            :rtype: float
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def copy(self):
+        """ copy() -> ClientRequest
+            Return a copy of this request, at the same position in the same
+            filter chain, which may be sent independently of this request
+            (for example on another thread). The ``headers`` are copied, the
+            ``entity`` is shared.
+
+            :rtype: :class:`ClientRequest`
+        """
+        request = copy.copy(self)
+        request.headers = self.headers.copy()
+        request.cancelled = False
+        request.cancellers = None
+        return request
+
+    def on_cancel(self, canceller):
+        """ on_cancel(canceller)
+            Register a function to be called if the request is cancelled,
+            a transport uses this to abandon the connection the request is
+            waiting on. If the request has already been cancelled the 
+            function is called immediately. The function may be called 
+            more than once and may be called on any thread.
+
+            :type canceller: function
+            :param canceller: a function taking no parameters.
+        """
+        if self.cancellers is None:
+            self.cancellers = []
+        self.cancellers.append(canceller)
+        if self.cancelled:
+            canceller()
+
+    def cancel(self):
+        """ cancel()
+            Cancel the request from another thread, the thread sending the
+            request sees an error (usually ``urllib2.URLError``) as soon as
+            the transport notices, and the request is not retried on a new
+            connection. Transports which do not support cancellation simply
+            complete the request.
+        """
+        self.cancelled = True
+        for canceller in list(self.cancellers or []):
+            try:
+                canceller()
+            except:
+                logging.getLogger('guernsey').exception('Error cancelling request')
+
+    def add_header(self, name, value):
+        """ add_header(name, value) -> ClientRequest
+            Add a header to this request only, unlike the ``add_header`` 
+            method on :class:`WebResource` this does not affect later 
+            requests made with the same resource.
+
+            :type name: string
+            :param name: The name of the header to add.
+            :type value: string
+            :param value: The value to add for this header.
+            :rtype: :class:`ClientRequest`
+        """
+        self.headers[name] = value
+        return self
+
+    def _get_filters(self):
+        return [link.filter for link in self.chain]
+
+    filters = property(_get_filters)
 
     def set_filters(self, filters):
-        self.filters = filters
+        """ set_filters(filters)
+            Set the filter chain for this request from a list of filters,
+            :py:func:`set_chain` is used by resources to avoid building the
+            chain for every request.
+
+            :type filters: list of :class:`ClientFilter`
+            :param filters: The filters, the last of which must execute
+                the request.
+        """
+        self.set_chain(tuple([FilterLink(f, i) for (i, f) in enumerate(filters)]))
+
+    def set_chain(self, chain):
+        """ set_chain(chain)
+            Set the compiled filter chain for this request.
+
+            :type chain: tuple of :class:`FilterLink`
+            :param chain: The compiled chain.
+        """
+        self.chain = chain
+        self.position = -1
 
     def next_filter(self, filter):
-        """ next_filter(filter) -> ClientFilter
+        """ next_filter(filter) -> FilterLink
             This will return the next filter, after ``filter``,  in the
             filter chain for this request. Note that the filter chain
             is copied from the resource when the request is created to
-            ensure it cannot be changed.
+            ensure it cannot be changed. The next filter is found from the
+            request's current ``position`` so a filter may appear in the
+            chain more than once, and may call the next filter more than
+            once (for example to retry a request).
 
             :type filter: :class:`ClientFilter`
             :param filter: The current filter.
-            :rtype: :class:`ClientFilter`
+            :rtype: :class:`FilterLink`
         """
-        next = self.filters.index(filter)+1
-        if next > len(self.filters):
-            return self.client.default_filter
-        else:
-            return self.filters[next]
+        chain = self.chain
+        position = self.position
+        if position < 0 or position >= len(chain) or not chain[position].filter is filter:
+            position = [link.filter for link in chain].index(filter)
+        return chain[position + 1]
 
 class ClientFilter(object):
     """ A Filter can be associated with a :class:`WebResource` object and
@@ -692,23 +2070,38 @@ class ExecClientFilter(ClientFilter):
 
     def handle(self, client_request):
         """ handle(client_request) -> ClientResponse
-            This is where the real HTTP stuff happens.
+            This is where the real HTTP stuff happens. An HTTP error status
+            is returned as a response, any failure to reach the server is
+            raised as a ``urllib2.URLError``.
         """ 
         if client_request.method in ['GET', 'POST']:
-            request = urllib2.Request(url=client_request.url, data=client_request.resource.req_entity)
+            request = urllib2.Request(url=client_request.url, data=client_request.entity)
         else:
-            request = RequestWithMethod(client_request.method, url=client_request.url, data=client_request.resource.req_entity)
+            request = RequestWithMethod(client_request.method, url=client_request.url, data=client_request.entity)
         for k, v in client_request.resource.headers.iteritems():
             request.add_header(k, v)
+        for k, v in client_request.headers.iteritems():
+            request.add_header(k, v)
+        request.connect_timeout = client_request.connect_timeout
+        request.read_timeout = client_request.read_timeout
+        request.deadline = client_request.deadline
+        request.client_request = client_request
+        if client_request.remaining() == 0:
+            raise DeadlineExceededError(client_request.url)
         try:
             response = self.opener.open(request)
-        except urllib2.URLError, e:
+        except urllib2.HTTPError, e:
             logger = logging.getLogger('guernsey')
-            if hasattr(e, 'reason'):
-                logger.error('We failed to reach a server. Reason: %s' % e.reason)
-            elif hasattr(e, 'code'):
+            if e.code >= 400:
                 logger.error('The server couldn\'t fulfill the request. Status code: %d' % e.code)
-            return ClientResponse(client_request.resource, e, client_request.resource.client)
+            else:
+                # such as 304 Not Modified in answer to a conditional request
+                logger.debug('The server responded with status code: %d' % e.code)
+            return ClientResponse(client_request.resource, e, client_request.resource.client, client_request.stream)
+        except urllib2.URLError, e:
+            logger = logging.getLogger('guernsey')
+            logger.error('We failed to reach a server. Reason: %s' % e.reason)
+            raise
         else:
-            return ClientResponse(client_request.resource, response, client_request.resource.client)
+            return ClientResponse(client_request.resource, response, client_request.resource.client, client_request.stream)
 
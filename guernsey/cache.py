@@ -0,0 +1,456 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+import copy, cPickle, hashlib, logging, mimetools, os, StringIO, threading, time
+
+logger = logging.getLogger('guernsey')
+
+def parse_cache_control(value):
+    """ parse_cache_control(value) -> dict
+        Parse the value of a ``Cache-Control`` header into a dictionary of
+        directives, directives without a value map to ``True``.
+
+        :type value: string
+        :param value: the header value.
+        :rtype: dict
+    """
+    directives = {}
+    if value is None:
+        return directives
+    for directive in value.split(','):
+        directive = directive.strip()
+        if directive == '':
+            continue
+        if directive.find('=') >= 0:
+            (name, argument) = directive.split('=', 1)
+            directives[name.strip().lower()] = argument.strip().strip('"')
+        else:
+            directives[directive.lower()] = True
+    return directives
+
+def parse_http_time(value):
+    """ parse_http_time(value) -> float
+        Return the seconds since the epoch for an HTTP date/time value, or
+        ``None`` if it cannot be parsed.
+
+        :type value: string
+        :param value: the header value.
+        :rtype: float
+    """
+    if value is None:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+class CacheEntry(object):
+    """ A stored response, the entry holds only plain data (the status,
+        headers and entity) so it may be pickled by a :class:`DiskCache`.
+
+        The class supports the following data members.
+
+        * ``url`` - the URL of the stored response.
+        * ``status`` - the HTTP status code.
+        * ``reason_phrase`` - the HTTP reason phrase.
+        * ``headers`` - the dictionary of response headers, names are lower
+          case.
+        * ``entity`` - the response entity.
+        * ``vary`` - a dictionary of the request headers named in the
+          response ``Vary`` header and their values.
+        * ``expires`` - the time, in seconds since the epoch, after which the
+          entry is stale.
+        * ``revalidate`` - ``True`` if the entry must always be revalidated
+          before use (``Cache-Control: no-cache``).
+    """
+    def __init__(self, url, status, reason_phrase, headers, entity, vary=None):
+        self.url = url
+        self.status = status
+        self.reason_phrase = reason_phrase
+        self.headers = headers
+        self.entity = entity
+        self.vary = vary or {}
+        self.expires = 0
+        self.revalidate = False
+        self.update_freshness()
+
+    def update_freshness(self, now=None):
+        """ update_freshness(now=None)
+            Calculate the expiry time of the entry from its ``Cache-Control``,
+            ``Expires`` and ``Date`` headers. Note that ``Expires`` is taken
+            relative to ``Date`` so that clock skew between client and server
+            does not matter.
+        """
+        if now is None:
+            now = time.time()
+        cache_control = parse_cache_control(self.headers.get('cache-control'))
+        self.revalidate = 'no-cache' in cache_control
+        age = 0
+        try:
+            age = int(self.headers.get('age', 0))
+        except ValueError:
+            pass
+        expires = now
+        if 'max-age' in cache_control:
+            try:
+                expires = now + int(cache_control['max-age']) - age
+            except ValueError:
+                pass
+        elif 'expires' in self.headers:
+            expires_time = parse_http_time(self.headers.get('expires'))
+            date_time = parse_http_time(self.headers.get('date'))
+            if not expires_time is None:
+                if date_time is None:
+                    date_time = now
+                expires = now + (expires_time - date_time) - age
+        self.expires = expires
+
+    def is_fresh(self, now=None):
+        """ is_fresh(now=None) -> boolean
+            Return ``True`` if the entry may be used without revalidation.
+
+            :rtype: Boolean
+        """
+        if now is None:
+            now = time.time()
+        return not self.revalidate and now < self.expires
+
+    def validators(self):
+        """ validators() -> dict
+            Return the conditional request headers used to revalidate this
+            entry, ``If-None-Match`` and/or ``If-Modified-Since``.
+
+            :rtype: dict
+        """
+        validators = {}
+        if 'etag' in self.headers:
+            validators['If-None-Match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            validators['If-Modified-Since'] = self.headers['last-modified']
+        return validators
+
+    def matches(self, request_headers):
+        """ matches(request_headers) -> boolean
+            Return ``True`` if the request headers named by ``Vary`` have the
+            same values as those of the request that stored this entry.
+
+            :type request_headers: dict
+            :param request_headers: the request headers, names are lower case.
+            :rtype: Boolean
+        """
+        for (name, value) in self.vary.iteritems():
+            if request_headers.get(name) != value:
+                return False
+        return True
+
+    def merge(self, headers):
+        """ merge(headers)
+            Update the stored headers from those of a ``304 Not Modified``
+            response and recalculate freshness.
+
+            :type headers: dict
+            :param headers: the headers of the 304 response.
+        """
+        for name in ['cache-control', 'date', 'etag', 'expires', 'last-modified', 'vary']:
+            if name in headers:
+                self.headers[name] = headers[name]
+        self.update_freshness()
+
+    def response(self):
+        """ response() -> CachedResponse
+            Return a file-like response object, in the same form as those
+            returned by urllib2, from which a ``ClientResponse`` may be
+            constructed.
+
+            :rtype: :class:`CachedResponse`
+        """
+        return CachedResponse(self)
+
+class CachedResponse(object):
+    """ Presents a :class:`CacheEntry` with the same interface as the
+        response objects returned by urllib2.
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        self.code = entry.status
+        self.msg = entry.reason_phrase
+        self.fp = StringIO.StringIO(entry.entity)
+        lines = ['%s: %s\r\n' % (k, v) for (k, v) in entry.headers.iteritems()]
+        self.headers = mimetools.Message(StringIO.StringIO(''.join(lines) + '\r\n'))
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.entry.url
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.fp.read()
+        return self.fp.read(amt)
+
+    def close(self):
+        self.fp.close()
+
+class MemoryCache(object):
+    """ An in-memory, least-recently-used, store of :class:`CacheEntry`
+        objects holding at most ``max_entries`` entries.
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ get(key) -> CacheEntry
+            Return the entry for the key, or ``None``.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if not entry is None:
+                self.entries[key] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+    def put(self, key, entry):
+        """ put(key, entry)
+            Store the entry, evicting the least recently used entry if the
+            cache is full.
+        """
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        """ remove(key)
+            Remove any entry for the key.
+        """
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """ clear()
+            Remove all entries.
+        """
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+class DiskCache(object):
+    """ An on-disk, least-recently-used, store of :class:`CacheEntry`
+        objects holding at most ``max_entries`` entries. Each entry is
+        pickled into its own file in ``directory`` and the file
+        modification time is used to track use.
+    """
+    def __init__(self, directory, max_entries=10000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def filename(self, key):
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest() + '.cache')
+
+    def get(self, key):
+        """ get(key) -> CacheEntry
+            Return the entry for the key, or ``None``.
+        """
+        filename = self.filename(key)
+        self.lock.acquire()
+        try:
+            try:
+                fp = open(filename, 'rb')
+                try:
+                    entry = cPickle.load(fp)
+                finally:
+                    fp.close()
+                os.utime(filename, None)
+                return entry
+            except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+                return None
+        finally:
+            self.lock.release()
+
+    def put(self, key, entry):
+        """ put(key, entry)
+            Store the entry, evicting the least recently used entries if the
+            cache is full.
+        """
+        filename = self.filename(key)
+        self.lock.acquire()
+        try:
+            temp = filename + '.tmp'
+            fp = open(temp, 'wb')
+            try:
+                cPickle.dump(entry, fp, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+            os.rename(temp, filename)
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        """ remove(key)
+            Remove any entry for the key.
+        """
+        self.lock.acquire()
+        try:
+            try:
+                os.remove(self.filename(key))
+            except OSError:
+                pass
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """ clear()
+            Remove all entries.
+        """
+        self.lock.acquire()
+        try:
+            for name in self._files():
+                os.remove(name)
+        finally:
+            self.lock.release()
+
+    def _files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.cache')]
+
+    def _evict(self):
+        files = self._files()
+        if len(files) > self.max_entries:
+            files.sort(key=lambda name: os.path.getmtime(name))
+            for name in files[:len(files) - self.max_entries]:
+                os.remove(name)
+
+    def __len__(self):
+        return len(self._files())
+
+class ParsedEntityCache(object):
+    """ A least-recently-used store of parsed entities, so that a response
+        whose entity has already been parsed (for example a repeated 
+        response, or one answered by :class:`guernsey.filters.CacheFilter`
+        after a 304) can reuse the parsed object rather than parse again.
+        Entries are keyed by URL, content type and either the ``ETag`` of
+        the response or, if there is none, an MD5 hash of the entity.
+
+        The size of each entry is taken to be the length of the raw entity
+        it was parsed from, which is a reasonable proxy for the memory used
+        by the parsed object, and the cache holds at most ``max_bytes`` in
+        total.
+
+        By default the same parsed object is shared between all responses
+        with the same entity, so callers must treat it as read-only. A deep
+        copy usually costs more than parsing the entity again, so setting
+        ``copy_on_read`` to ``True`` (to return a private copy on each hit)
+        is only worthwhile where callers must modify the parsed entity.
+
+        The class supports the following data members.
+
+        * ``hits`` - the number of times a parsed entity was reused.
+        * ``misses`` - the number of times an entity had to be parsed.
+    """
+    def __init__(self, max_bytes=16777216, copy_on_read=False):
+        """ ParsedEntityCache(max_bytes=16777216, copy_on_read=False) -> ParsedEntityCache
+
+            :type max_bytes: int
+            :param max_bytes: the total size of the entities to cache.
+            :type copy_on_read: Boolean
+            :param copy_on_read: if ``True`` return a copy of the cached value.
+        """
+        self.max_bytes = max_bytes
+        self.copy_on_read = copy_on_read
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, url, content_type, entity_tag, entity):
+        """ key(url, content_type, entity_tag, entity) -> tuple
+            Return the cache key for a response entity.
+        """
+        if entity_tag is None or entity_tag.startswith('W/'):
+            return (url, content_type, hashlib.md5(entity).hexdigest())
+        return (url, content_type, entity_tag)
+
+    def get(self, key):
+        """ get(key) -> (boolean, object)
+            Return a tuple of ``(found, parsed_entity)`` for the key, note
+            that ``None`` is a valid parsed entity.
+        """
+        self.lock.acquire()
+        try:
+            if not key in self.entries:
+                self.misses = self.misses + 1
+                return (False, None)
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            self.hits = self.hits + 1
+        finally:
+            self.lock.release()
+        if self.copy_on_read:
+            return (True, copy.deepcopy(entry[1]))
+        return (True, entry[1])
+
+    def put(self, key, size, parsed_entity):
+        """ put(key, size, parsed_entity)
+            Store a parsed entity, evicting the least recently used entries
+            to stay within ``max_bytes``. Entities larger than ``max_bytes``
+            are not stored.
+        """
+        if size > self.max_bytes:
+            return
+        if self.copy_on_read:
+            parsed_entity = copy.deepcopy(parsed_entity)
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if not old is None:
+                self.size = self.size - old[0]
+            self.entries[key] = (size, parsed_entity)
+            self.size = self.size + size
+            while self.size > self.max_bytes:
+                (evicted, (evicted_size, value)) = self.entries.popitem(last=False)
+                self.size = self.size - evicted_size
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """ clear()
+            Remove all entries, the counters are not reset.
+        """
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,506 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import httplib, logging, os, select, socket, threading, time, urllib, urllib2
+
+logger = logging.getLogger('guernsey')
+
+DEFAULT_PORTS = {'http': httplib.HTTP_PORT, 'https': httplib.HTTPS_PORT}
+
+BLOCK_SIZE = 65536
+
+# Methods which may safely be sent again if a reused connection fails, a
+# server may have acted on the first attempt before closing the connection.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+class DeadlineExceededError(urllib2.URLError):
+    """ Raised when a request cannot be sent, or a redirect followed, 
+        because its deadline has passed. This is a subclass of 
+        ``urllib2.URLError`` and is never retried.
+    """
+    retryable = False
+
+    def __init__(self, url):
+        urllib2.URLError.__init__(self, 'deadline exceeded for %s' % url)
+        self.url = url
+
+def request_timeouts(req):
+    """ request_timeouts(req) -> tuple
+        Return the ``(connect, read)`` timeouts, in seconds, for a urllib2
+        request. These are taken from the ``connect_timeout`` and 
+        ``read_timeout`` attributes of the request, if present, or else
+        its ``timeout``, and are limited by the time remaining before the
+        request's ``deadline`` attribute (seconds since the epoch), if 
+        present. Either value may be ``socket._GLOBAL_DEFAULT_TIMEOUT``.
+
+        :type req: urllib2.Request
+        :param req: the request.
+        :rtype: tuple
+        :raises DeadlineExceededError: if the deadline has passed.
+    """
+    timeouts = []
+    for name in ['connect_timeout', 'read_timeout']:
+        timeout = getattr(req, name, None)
+        if timeout is None:
+            timeout = req.timeout
+        timeouts.append(timeout)
+    deadline = getattr(req, 'deadline', None)
+    if not deadline is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceededError(req.get_full_url())
+        for i in range(len(timeouts)):
+            if timeouts[i] in [None, socket._GLOBAL_DEFAULT_TIMEOUT] or timeouts[i] > remaining:
+                timeouts[i] = remaining
+    return tuple(timeouts)
+
+class TimeoutRedirectHandler(urllib2.HTTPRedirectHandler):
+    """ A urllib2 redirect handler which carries the ``connect_timeout``,
+        ``read_timeout``, ``deadline`` and ``client_request`` of a request 
+        over to the redirected request, so that a deadline covers all 
+        redirects and cancelling the request also cancels the redirect.
+    """
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = urllib2.HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+        if not new is None:
+            for name in ['connect_timeout', 'read_timeout', 'deadline', 'client_request']:
+                if hasattr(req, name):
+                    setattr(new, name, getattr(req, name))
+        return new
+
+def entity_length(body):
+    """ entity_length(body) -> int
+        Return the number of bytes that will be sent for a request body, 
+        or ``None`` if this cannot be determined without reading it. For
+        seekable file-like objects (including ``mmap`` objects) this is
+        the number of bytes from the current position to the end.
+
+        :type body: object
+        :param body: a string, file-like object or iterator of strings.
+        :rtype: int
+    """
+    if isinstance(body, basestring):
+        return len(body)
+    if hasattr(body, 'fileno') and hasattr(body, 'tell'):
+        try:
+            return os.fstat(body.fileno()).st_size - body.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        try:
+            position = body.tell()
+            body.seek(0, 2)
+            length = body.tell() - position
+            body.seek(position)
+            return length
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+    return None
+
+def iter_body(body):
+    """ iter_body(body) -> iterator
+        Return an iterator over the blocks of a request body.
+
+        :type body: object
+        :param body: a string, file-like object or iterator of strings.
+        :rtype: iterator
+    """
+    if isinstance(body, basestring):
+        return iter([body])
+    if hasattr(body, 'read'):
+        return iter(lambda: body.read(BLOCK_SIZE), '')
+    return iter(body)
+
+def send_request(connection, method, url, body, headers):
+    """ send_request(connection, method, url, body, headers)
+        Send a request on the connection, unlike ``HTTPConnection.request``
+        the body may be an iterator of strings as well as a string or a 
+        file-like object. If the headers specify ``Transfer-Encoding: 
+        chunked`` the body is sent using the chunked encoding, so that the
+        total length need not be known in advance.
+    """
+    names = dict([(k.lower(), v) for (k, v) in headers.iteritems()])
+    connection.putrequest(method, url,
+        skip_host='host' in names,
+        skip_accept_encoding='accept-encoding' in names)
+    for (k, v) in headers.iteritems():
+        connection.putheader(k, v)
+    connection.endheaders()
+    if body is None:
+        return
+    chunked = names.get('transfer-encoding', '').lower() == 'chunked'
+    for block in iter_body(body):
+        if len(block) == 0:
+            continue
+        if chunked:
+            connection.send('%x\r\n%s\r\n' % (len(block), block))
+        else:
+            connection.send(block)
+    if chunked:
+        connection.send('0\r\n\r\n')
+
+class ConnectionPool(object):
+    """ A ``ConnectionPool`` holds idle, persistent, HTTP/1.1 connections
+        so that they may be reused by later requests to the same server.
+        Connections are keyed by the tuple ``(scheme, host, port)`` and
+        are only returned to the pool once the response that was using
+        them has been completely read.
+
+        The class supports the following data members.
+
+        * ``max_per_host`` - the maximum number of idle connections kept
+          for any one ``(scheme, host, port)`` key, connections released
+          beyond this number are simply closed.
+        * ``idle_timeout`` - the number of seconds a connection may sit
+          unused in the pool before it is considered expired and closed.
+    """
+    def __init__(self, max_per_host=4, idle_timeout=30.0):
+        """ ConnectionPool(max_per_host=4, idle_timeout=30.0) -> ConnectionPool
+
+            :type max_per_host: int
+            :param max_per_host: the maximum number of idle connections to
+                keep per host.
+            :type idle_timeout: float
+            :param idle_timeout: the number of seconds after which an idle
+                connection is closed rather than reused.
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def key(self, scheme, host):
+        """ key(scheme, host) -> tuple
+            Return the pool key for a scheme and a ``host[:port]`` string
+            as returned by ``urllib2.Request.get_host()``.
+
+            :type scheme: string
+            :param scheme: the URL scheme, ``http`` or ``https``.
+            :type host: string
+            :param host: the host name with an optional port.
+            :rtype: tuple
+        """
+        hostname, port = urllib.splitport(host)
+        if port is None or port == '':
+            port = DEFAULT_PORTS.get(scheme)
+        return (scheme, hostname.lower(), int(port))
+
+    def acquire(self, key):
+        """ acquire(key) -> HTTPConnection
+            Return an idle connection for the key, or ``None`` if there is
+            no usable connection in the pool. Any connection found to be
+            expired or stale is closed and discarded.
+
+            :type key: tuple
+            :param key: the key returned by :py:func:`key`.
+            :rtype: httplib.HTTPConnection
+        """
+        now = time.time()
+        while True:
+            self.lock.acquire()
+            try:
+                connections = self.idle.get(key)
+                if not connections:
+                    return None
+                (connection, released) = connections.pop()
+            finally:
+                self.lock.release()
+            if now - released > self.idle_timeout:
+                logger.debug('Closing expired connection to %s://%s:%d' % key)
+                connection.close()
+            elif self.is_stale(connection):
+                logger.debug('Closing stale connection to %s://%s:%d' % key)
+                connection.close()
+            else:
+                return connection
+
+    def release(self, key, connection):
+        """ release(key, connection)
+            Return a connection to the pool for later reuse, if the pool
+            already holds ``max_per_host`` idle connections for this key
+            the connection is closed instead.
+
+            :type key: tuple
+            :param key: the key returned by :py:func:`key`.
+            :type connection: httplib.HTTPConnection
+            :param connection: the connection, with no outstanding response.
+        """
+        self.lock.acquire()
+        try:
+            connection.owner = None
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_per_host:
+                connections.append((connection, time.time()))
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def abandon(self, connection, owner):
+        """ abandon(connection, owner)
+            Shut down the socket of a connection in use, from any thread, so
+            that the request waiting on it fails. Nothing is done if the 
+            connection has since been released to the pool, as it may now
+            belong to another request.
+
+            :type connection: httplib.HTTPConnection
+            :param connection: the connection.
+            :param owner: the request the connection was acquired for.
+        """
+        self.lock.acquire()
+        try:
+            if getattr(connection, 'owner', None) is owner and not connection.sock is None:
+                try:
+                    connection.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        finally:
+            self.lock.release()
+
+    def is_stale(self, connection):
+        """ is_stale(connection) -> boolean
+            Return ``True`` if the idle connection can no longer be used,
+            either because it has no socket or because the socket is
+            readable. An idle HTTP connection should never have data to
+            read, so a readable socket indicates the server has closed
+            its end (or sent something we cannot use).
+
+            :type connection: httplib.HTTPConnection
+            :param connection: the connection to check.
+            :rtype: Boolean
+        """
+        if connection.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return len(readable) > 0
+
+    def size(self, key=None):
+        """ size(key=None) -> int
+            Return the number of idle connections held for the key, or in
+            total if no key is specified.
+
+            :type key: tuple
+            :param key: the key returned by :py:func:`key`.
+            :rtype: int
+        """
+        self.lock.acquire()
+        try:
+            if key is None:
+                return sum([len(c) for c in self.idle.itervalues()])
+            return len(self.idle.get(key, []))
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """ close()
+            Close all the idle connections held by this pool.
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for connections in idle.itervalues():
+            for (connection, released) in connections:
+                connection.close()
+
+class PooledResponse(object):
+    """ This wraps the ``httplib.HTTPResponse`` for a pooled connection and
+        provides the ``addinfourl`` interface expected by urllib2. When the
+        response body has been completely read the connection is released
+        back to the pool, if the response is closed before that point the
+        connection is discarded as it cannot be safely reused. The 
+        ``timings`` of the response record the seconds taken to ``connect``
+        and until the ``first_byte`` of the response.
+    """
+    def __init__(self, pool, key, connection, response, url):
+        """ PooledResponse(pool, key, connection, response, url) -> PooledResponse
+        """
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.timings = {}
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self._release()
+        return data
+
+    def readline(self):
+        # HTTPResponse has no readline, so read a byte at a time; this
+        # is only used by callers that expect a true file object.
+        line = []
+        while True:
+            c = self.read(1)
+            line.append(c)
+            if c == '' or c == '\n':
+                return ''.join(line)
+
+    def readlines(self):
+        return self.read().splitlines(True)
+
+    def close(self):
+        if not self.connection is None:
+            if self.response.isclosed():
+                self._release()
+            else:
+                connection = self.connection
+                self.connection = None
+                self.response.close()
+                connection.close()
+
+    def _release(self):
+        connection = self.connection
+        self.connection = None
+        if not connection is None:
+            if self.response.will_close:
+                connection.close()
+            else:
+                self.pool.release(self.key, connection)
+
+class PooledHandlerMixin(object):
+    """ Common implementation of ``do_open`` for the pooled HTTP and HTTPS
+        handlers. Unlike the urllib2 implementation this does not force
+        ``Connection: close`` and will retry an idempotent request once on a
+        new connection if a reused connection turns out to have been closed
+        by the server. Request bodies may also be file-like objects or
+        iterators which are streamed to the server, with chunked transfer
+        encoding when their length is not known. Separate connect and read
+        timeouts, and a deadline, are applied as described for 
+        :py:func:`request_timeouts`.
+    """
+    def do_request_(self, req):
+        data = req.get_data()
+        if data is None or isinstance(data, basestring):
+            return urllib2.AbstractHTTPHandler.do_request_(self, req)
+        if not req.has_header('Content-length') and not req.has_header('Transfer-encoding'):
+            length = entity_length(data)
+            if length is None:
+                req.add_unredirected_header('Transfer-encoding', 'chunked')
+            else:
+                req.add_unredirected_header('Content-length', '%d' % length)
+        if req.has_header('Content-length'):
+            return urllib2.AbstractHTTPHandler.do_request_(self, req)
+        # urllib2 insists on a length for any body, so hide the body while
+        # it adds the remaining headers.
+        if not req.has_header('Content-type'):
+            req.add_unredirected_header('Content-type', 'application/x-www-form-urlencoded')
+        req.data = None
+        try:
+            return urllib2.AbstractHTTPHandler.do_request_(self, req)
+        finally:
+            req.data = data
+
+    def do_pooled_open(self, connection_class, req, **connection_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        if req._tunnel_host:
+            # tunnelled proxy connections are not pooled.
+            return self.do_open(connection_class, req, **connection_args)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        (connect_timeout, read_timeout) = request_timeouts(req)
+        client_request = getattr(req, 'client_request', None)
+        key = self.pool.key(req.get_type(), host)
+        connection = self.pool.acquire(key)
+        position = None
+        if hasattr(req.data, 'seek') and hasattr(req.data, 'tell'):
+            position = req.data.tell()
+        while True:
+            reused = not connection is None
+            try:
+                start = time.time()
+                if not reused:
+                    connection = connection_class(host, timeout=connect_timeout, **connection_args)
+                    connection.connect()
+                connected = time.time()
+                if not client_request is None:
+                    connection.owner = req
+                    client_request.on_cancel(lambda connection=connection: self.pool.abandon(connection, req))
+                    if client_request.cancelled:
+                        raise socket.error('request cancelled')
+                # a new connection still has the connect timeout, and a 
+                # reused one the timeout of its previous request.
+                if read_timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    connection.sock.settimeout(socket.getdefaulttimeout())
+                else:
+                    connection.sock.settimeout(read_timeout)
+                send_request(connection, req.get_method(), req.get_selector(), req.data, headers)
+                response = connection.getresponse(buffering=True)
+                timings = {'connect': connected - start, 'first_byte': time.time() - connected}
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                cancelled = not client_request is None and client_request.cancelled
+                if reused and not isinstance(e, socket.timeout) and not cancelled and \
+                        req.get_method() in IDEMPOTENT_METHODS and self.rewind(req.data, position):
+                    logger.debug('Reused connection failed (%s), retrying' % e)
+                    connection = None
+                    continue
+                raise urllib2.URLError(e)
+            pooled = PooledResponse(self.pool, key, connection, response, req.get_full_url())
+            pooled.timings = timings
+            return pooled
+
+    def rewind(self, data, position):
+        """ rewind(data, position) -> boolean
+            Return ``True`` if the request body can be sent again, seekable
+            bodies are returned to their original position, iterators can
+            not be rewound.
+        """
+        if data is None or isinstance(data, basestring):
+            return True
+        if not position is None:
+            data.seek(position)
+            return True
+        return False
+
+class PooledHTTPHandler(PooledHandlerMixin, urllib2.HTTPHandler):
+    """ A urllib2 handler for ``http`` URLs which uses a :class:`ConnectionPool`.
+    """
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_pooled_open(httplib.HTTPConnection, req)
+
+    http_request = PooledHandlerMixin.do_request_
+
+class PooledHTTPSHandler(PooledHandlerMixin, urllib2.HTTPSHandler):
+    """ A urllib2 handler for ``https`` URLs which uses a :class:`ConnectionPool`.
+    """
+    def __init__(self, pool, debuglevel=0, context=None):
+        urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self.do_pooled_open(httplib.HTTPSConnection, req, context=self._context)
+
+    https_request = PooledHandlerMixin.do_request_
@@ -4,20 +4,404 @@
 # See LICENSE.txt included in this distribution or more details.
 #
 
-import logging
+import inspect, logging, re
 
 try:
     import json
 except:
     json = None
 from xml.etree.ElementTree import fromstring, _ElementInterface, ElementTree
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 logger = logging.getLogger('guernsey')
 
+class JsonBackend(object):
+    """ A JSON implementation used by :class:`JsonReader` and 
+        :class:`JsonWriter`. Backends are adapted so that they produce the
+        same results as the standard library ``json`` module; decoded
+        strings are always ``unicode`` and encoded output uses the same
+        separators, so the choice of backend only affects speed.
+
+        The class supports the following data members.
+
+        * ``name`` - the name of the backend, as used in the ``json_backend``
+          client configuration value.
+        * ``loads`` - the function to decode a JSON string.
+        * ``dumps`` - the function to encode a Python object.
+    """
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return '<JsonBackend %s>' % self.name
+
+def ujson_backend():
+    import ujson
+    options = {'precise_float': True}
+    try:
+        ujson.loads('0', **options)
+    except TypeError:
+        # ujson 2 always decodes floats precisely and has no such option
+        options = {}
+    def loads(s):
+        try:
+            return ujson.loads(s, **options)
+        except ValueError:
+            # ujson rejects integers wider than 64 bits, which the standard
+            # library decodes as long, so let it decide.
+            return json.loads(s)
+    # ujson does not produce the same formatting, so only decode with it
+    return JsonBackend('ujson', loads, json.dumps)
+
+def simplejson_backend():
+    import simplejson
+    # without its C speedups simplejson is slower than the standard library
+    from simplejson import _speedups
+    def loads(s):
+        # simplejson returns str for ASCII strings unless given unicode
+        if isinstance(s, str):
+            s = s.decode('utf-8')
+        return simplejson.loads(s)
+    def dumps(obj, **kwargs):
+        # simplejson writes namedtuples as objects, the standard library
+        # writes them, like all tuples, as arrays.
+        kwargs.setdefault('namedtuple_as_object', False)
+        kwargs.setdefault('tuple_as_array', True)
+        return simplejson.dumps(obj, **kwargs)
+    return JsonBackend('simplejson', loads, dumps)
+
+def stdlib_backend():
+    if json is None:
+        raise ImportError('No module named json')
+    return JsonBackend('json', json.loads, json.dumps)
+
+JSON_BACKENDS = [('ujson', ujson_backend), ('simplejson', simplejson_backend), ('json', stdlib_backend)]
+
+def load_json_backend(name):
+    """ load_json_backend(name) -> JsonBackend
+        Return the named JSON backend, one of those listed in 
+        ``JSON_BACKENDS``.
+
+        :type name: string
+        :param name: The name of the backend.
+        :rtype: :class:`JsonBackend`
+        :raises ValueError: if the backend name is not known.
+        :raises ImportError: if the backend is not installed.
+    """
+    for (backend_name, factory) in JSON_BACKENDS:
+        if backend_name == name:
+            return factory()
+    raise ValueError('Unknown JSON backend %s' % name)
+
+def select_json_backend(names=None):
+    """ select_json_backend(names=None) -> JsonBackend
+        Return the first of the named JSON backends which is installed, 
+        by default the fastest available of those listed in 
+        ``JSON_BACKENDS``, or ``None`` if none are installed.
+
+        :type names: list of string
+        :param names: The names of backends in order of preference.
+        :rtype: :class:`JsonBackend`
+        :raises ValueError: if a backend name is not known.
+    """
+    if names is None:
+        names = [name for (name, factory) in JSON_BACKENDS]
+    for name in names:
+        try:
+            backend = load_json_backend(name)
+            logger.debug('Using JSON backend %s' % name)
+            return backend
+        except ImportError:
+            pass
+    return None
+
+default_json_backend = select_json_backend()
+
+def is_streaming_entity(entity):
+    """ is_streaming_entity(entity) -> boolean
+        Return ``True`` if the request entity is a source of bytes to be
+        sent as-is, rather than an object to be serialized. Streaming 
+        entities are file-like objects (including ``mmap`` objects), 
+        which are read in blocks, and iterators (such as generators)
+        which yield string chunks.
+
+        :type entity: object
+        :param entity: The request entity.
+        :rtype: Boolean
+    """
+    if entity is None or isinstance(entity, basestring):
+        return False
+    return hasattr(entity, 'read') or hasattr(entity, 'next')
+
+def parse_media_type(content_type):
+    """ parse_media_type(content_type) -> tuple
+        Return the ``(type, subtype, suffix)`` of a MIME content type, 
+        ignoring any parameters and case. The suffix is the structured
+        syntax suffix (such as ``json`` in ``application/hal+json``) or
+        ``None``.
+
+        :type content_type: string
+        :param content_type: The MIME type, as in a ``Content-Type`` header.
+        :rtype: tuple
+    """
+    if content_type.find(';') >= 0:
+        content_type = content_type[:content_type.find(';')]
+    content_type = content_type.strip().lower()
+    if content_type.find('/') >= 0:
+        (major, minor) = content_type.split('/', 1)
+    else:
+        (major, minor) = (content_type, '')
+    suffix = None
+    if minor.find('+') >= 0:
+        suffix = minor[minor.rfind('+') + 1:]
+    return (major, minor, suffix)
+
+def media_type_keys(content_type):
+    """ media_type_keys(content_type) -> list
+        Return the list of media type patterns which match the content 
+        type, most specific first; that is the exact type, ``*/subtype``,
+        ``*/*+suffix``, ``type/*`` and finally ``*/*``.
+
+        :type content_type: string
+        :param content_type: The MIME type, as in a ``Content-Type`` header.
+        :rtype: list of string
+    """
+    (major, minor, suffix) = parse_media_type(content_type)
+    keys = ['%s/%s' % (major, minor), '*/%s' % minor]
+    if not suffix is None:
+        keys.append('*/*+%s' % suffix)
+    keys.append('%s/*' % major)
+    keys.append('*/*')
+    return keys
+
+def matches_media_type(media_types, content_type):
+    """ matches_media_type(media_types, content_type) -> boolean
+        Return whether any of the media type patterns match the content
+        type, see :py:func:`media_type_keys` for the supported patterns.
+
+        :type media_types: list of string
+        :param media_types: The media type patterns.
+        :type content_type: string
+        :param content_type: The MIME type, as in a ``Content-Type`` header.
+        :rtype: Boolean
+    """
+    for key in media_type_keys(content_type):
+        if key in media_types:
+            return True
+    return False
+
+def declares_media_types(entity_class, method):
+    """ declares_media_types(entity_class, method) -> boolean
+        Return whether the ``media_types`` of an entity class describe what
+        its ``method`` (``is_readable`` or ``is_writable``) accepts. This is
+        not the case if it has no media types, or if the method is 
+        overridden in a subclass of the class which declared them, for 
+        example a subclass of :class:`JsonReader` which narrows the types
+        it reads.
+
+        :type entity_class: object
+        :param entity_class: The reader or writer.
+        :type method: string
+        :param method: The name of the method.
+        :rtype: Boolean
+    """
+    if not getattr(entity_class, 'media_types', None):
+        return False
+    if 'media_types' in getattr(entity_class, '__dict__', {}):
+        return True
+    for klass in inspect.getmro(entity_class.__class__):
+        if 'media_types' in klass.__dict__:
+            return True
+        if method in klass.__dict__:
+            return False
+    return True
+
+class EntityRegistry(list):
+    """ The list of entity readers and writers used by a client, which
+        maintains an index of the ``media_types`` declared by each entity
+        class so that finding the reader or writer for a content type is
+        a dictionary lookup rather than a scan of the list. The result
+        for each distinct ``Content-Type`` string is cached, and the index
+        and cache are rebuilt whenever the list is changed.
+
+        Entity classes which declare ``media_types`` are ordered by the 
+        specificity of the matching pattern (exact, then ``*/subtype``,
+        ``*/*+suffix``, ``type/*`` and ``*/*``) and then by their position 
+        in the list. Entity classes which do not declare ``media_types``,
+        or which override ``is_readable`` or ``is_writable`` in a subclass
+        of the class that declared them (see :py:func:`declares_media_types`),
+        are always asked first, in list order, using those methods; the 
+        result of ``is_readable`` is cached per content type so it must 
+        depend only on the type.
+    """
+    max_cached = 256
+
+    def __init__(self, entity_classes=()):
+        list.__init__(self, entity_classes)
+        self.changed()
+
+    def changed(self):
+        """ changed()
+            Discard the index and cached lookups, this is called by all
+            the list methods which modify the registry.
+        """
+        self.index = {}
+        self.resolved = {}
+
+    def register(self, entity_class, first=False):
+        """ register(entity_class, first=False) -> EntityRegistry
+            Add a reader and/or writer to the registry.
+
+            :type entity_class: object
+            :param entity_class: The reader or writer to add.
+            :type first: Boolean
+            :param first: if ``True`` the entity class is added before any
+                existing ones with equally specific media types.
+            :rtype: :class:`EntityRegistry`
+        """
+        if first:
+            self.insert(0, entity_class)
+        else:
+            self.append(entity_class)
+        return self
+
+    def build_index(self, method):
+        index = {}
+        legacy = []
+        for (order, entity_class) in enumerate(self):
+            if not hasattr(entity_class, method):
+                continue
+            if declares_media_types(entity_class, method):
+                for media_type in entity_class.media_types:
+                    index.setdefault(media_type.lower(), []).append((order, entity_class))
+            else:
+                legacy.append(entity_class)
+        self.index[method] = (index, legacy)
+        return self.index[method]
+
+    def resolve(self, content_type, method):
+        (index, legacy) = self.index.get(method) or self.build_index(method)
+        found = []
+        for (rank, key) in enumerate(media_type_keys(content_type)):
+            for (order, entity_class) in index.get(key, []):
+                found.append((rank, order, entity_class))
+        found.sort()
+        candidates = list(legacy)
+        seen = set()
+        for (rank, order, entity_class) in found:
+            if not order in seen:
+                seen.add(order)
+                candidates.append(entity_class)
+        return candidates
+
+    def cached(self, key, function):
+        resolved = self.resolved
+        if key in resolved:
+            return resolved[key]
+        result = function()
+        if len(resolved) >= self.max_cached:
+            resolved.clear()
+        resolved[key] = result
+        return result
+
+    def reader_for(self, content_type):
+        """ reader_for(content_type) -> EntityReader
+            Return the reader for the content type, or ``None``.
+
+            :type content_type: string
+            :param content_type: The MIME type of the response entity.
+            :rtype: :class:`EntityReader`
+        """
+        def find():
+            for reader in self.resolve(content_type, 'is_readable'):
+                if declares_media_types(reader, 'is_readable') or reader.is_readable(content_type):
+                    return reader
+            return None
+        return self.cached(('reader', content_type), find)
+
+    def writers_for(self, content_type):
+        """ writers_for(content_type) -> list
+            Return the writers which may be able to write an object with
+            the content type, in the order they should be asked (using 
+            their ``is_writable`` method).
+
+            :type content_type: string
+            :param content_type: The MIME type of the request entity.
+            :rtype: list of :class:`EntityWriter`
+        """
+        return self.cached(('writers', content_type), 
+            lambda: self.resolve(content_type, 'is_writable'))
+
+    def append(self, entity_class):
+        list.append(self, entity_class)
+        self.changed()
+
+    def extend(self, entity_classes):
+        list.extend(self, entity_classes)
+        self.changed()
+
+    def insert(self, position, entity_class):
+        list.insert(self, position, entity_class)
+        self.changed()
+
+    def remove(self, entity_class):
+        list.remove(self, entity_class)
+        self.changed()
+
+    def pop(self, *args):
+        result = list.pop(self, *args)
+        self.changed()
+        return result
+
+    def reverse(self):
+        list.reverse(self)
+        self.changed()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.changed()
+
+    def __setitem__(self, position, entity_class):
+        list.__setitem__(self, position, entity_class)
+        self.changed()
+
+    def __delitem__(self, position):
+        list.__delitem__(self, position)
+        self.changed()
+
+    def __setslice__(self, start, end, entity_classes):
+        list.__setslice__(self, start, end, entity_classes)
+        self.changed()
+
+    def __delslice__(self, start, end):
+        list.__delslice__(self, start, end)
+        self.changed()
+
+    def __iadd__(self, entity_classes):
+        self.extend(entity_classes)
+        return self
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self.changed()
+        return self
+
 class EntityReader(object):
     """ An ``EntityReader`` is used to read a raw entity from the
         HTTP response and construct a Python object representation.
+
+        A reader may declare the list of ``media_types`` it reads, each
+        either an exact MIME type or a pattern of the form ``*/subtype``,
+        ``*/*+suffix``, ``type/*`` or ``*/*``. The client uses these to 
+        select the reader without calling :py:func:`is_readable`.
     """
+    media_types = []
+
     def is_readable(self, content_type):
         """ is_readable(content_type) -> boolean
             Return whether this reader can read an object serialized
@@ -44,7 +428,14 @@ class EntityReader(object):
 class EntityWriter(object):
     """ An ``EntityWriter`` is used to write a Python object into a
         serialized form for the HTTP request.
+
+        A writer may declare the list of ``media_types`` it writes, as
+        for :class:`EntityReader`, and the client only asks writers whose 
+        media types match the request content type whether they can 
+        write the object.
     """
+    media_types = []
+
     def is_writable(self, object, content_type):
         """ is_writable(object, content_type) -> boolean
             Return whether this writer can write the specified object
@@ -56,6 +447,21 @@ class EntityWriter(object):
         """
         return False
 
+    def iter_write(self, object, content_type):
+        """ iter_write(object, content_type) -> iterator
+            Return an iterator over the serialized form of the object in
+            string chunks, so that it can be sent without being held in
+            memory, or ``None`` if the writer does not support this for 
+            the object in which case :py:func:`write` is used.
+
+            :type object: object
+            :param object: The Python object to serialize.
+            :type content_type: string
+            :param content_type: The MIME type of the resource.
+            :rtype: iterator
+        """
+        return None
+
     def write(self, object, content_type, to_file):
         """ write(object, content_type, to_file) -> file
             Write the object to the file-like object according to 
@@ -71,38 +477,207 @@ class EntityWriter(object):
         return to_file
 
 class JsonReader(EntityReader):
-    """ Parse responses from ``application/json`` into Python objects. """
+    """ Parse responses from ``application/json`` (and other ``+json``
+        types) into Python objects, using the specified :class:`JsonBackend`
+        or else the fastest one installed. """
+    media_types = json and ['*/json', '*/*+json'] or []
+    backend = default_json_backend
+
+    def __init__(self, backend=None):
+        if not backend is None:
+            self.backend = backend
+
     def is_readable(self, content_type):
-        if content_type.find(';') >= 0:
-            content_type = content_type[:content_type.find(';')]
-        return not json is None and content_type.endswith('/json')
+        return matches_media_type(self.media_types, content_type)
 
     def read(self, raw_entity, content_type):
         if raw_entity is None or raw_entity.strip() == '':
             return None
         logger.debug('Parsing input as JSON')
-        return json.loads(raw_entity)
+        return self.backend.loads(raw_entity)
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class JsonStreamReader(JsonReader):
+    """ Parse responses from ``application/json`` (and other ``+json``
+        types) incrementally, the parsed entity is an iterator which 
+        yields each element of a top-level array, or each top-level value
+        where the entity is a sequence of values (such as 
+        ``application/x-ndjson``). For a streaming response the entity is
+        read from the response as the iterator is consumed, so only the
+        current record is held in memory. Incremental parsing always uses
+        the standard library ``json`` module.
+
+        This reader is not one of the client defaults, it can be added
+        for all JSON responses with 
+        ``client.entity_classes.register(JsonStreamReader(), first=True)``;
+        ``first`` is needed so that it is used in place of the default
+        :class:`JsonReader`, which reads the same media types.
+    """
+    media_types = json and ['*/json', '*/*+json', 'application/x-ndjson'] or []
+
+    def __init__(self, chunk_size=65536):
+        JsonReader.__init__(self)
+        self.chunk_size = chunk_size
+
+    def read(self, raw_entity, content_type):
+        if raw_entity is None:
+            return iter([])
+        return self.read_stream(iter([raw_entity]), content_type)
+
+    def read_stream(self, chunks, content_type):
+        """ read_stream(chunks, content_type) -> iterator
+            Return an iterator over the records parsed from an iterator 
+            of string chunks of the entity.
+
+            :type chunks: iterator
+            :param chunks: The entity, as string chunks.
+            :type content_type: string
+            :param content_type: The MIME type of the resource.
+            :rtype: iterator
+        """
+        logger.debug('Parsing input as streaming JSON')
+        decoder = json.JSONDecoder()
+        chunks = iter(chunks)
+        state = {'buffer': '', 'position': 0, 'eof': False}
+
+        def more():
+            """ Read at least as much again as is buffered, so that a large
+                record is not re-scanned once for every chunk. """
+            buffer = state['buffer'][state['position']:]
+            wanted = len(buffer)
+            read = []
+            while not state['eof'] and (len(read) == 0 or wanted > 0):
+                try:
+                    chunk = chunks.next()
+                    read.append(chunk)
+                    wanted = wanted - len(chunk)
+                except StopIteration:
+                    state['eof'] = True
+            state['buffer'] = buffer + ''.join(read)
+            state['position'] = 0
+            return len(read) > 0
+
+        def peek():
+            """ Skip whitespace and return the next character, or ``''``
+                at the end of the entity. """
+            while True:
+                position = WHITESPACE.match(state['buffer'], state['position']).end()
+                state['position'] = position
+                if position < len(state['buffer']):
+                    return state['buffer'][position]
+                if not more():
+                    return ''
+
+        def value():
+            """ Decode the next value, a value is only complete when it is
+                followed by more input which cannot continue a number (or 
+                the end of the entity) as otherwise a number could be cut 
+                short by a chunk boundary. """
+            while True:
+                try:
+                    (result, end) = decoder.raw_decode(state['buffer'], state['position'])
+                    if state['eof'] or (end < len(state['buffer']) and not state['buffer'][end] in '.eE+-'):
+                        state['position'] = end
+                        return result
+                except ValueError:
+                    if state['eof']:
+                        raise
+                more()
+
+        first = peek()
+        if first == '[':
+            state['position'] = state['position'] + 1
+            if peek() == ']':
+                return
+            while True:
+                yield value()
+                separator = peek()
+                state['position'] = state['position'] + 1
+                if separator == ']':
+                    if peek() != '':
+                        raise ValueError('Extra data after JSON array')
+                    return
+                elif separator != ',':
+                    raise ValueError('Expecting , or ] in JSON array')
+                peek()
+        while first != '':
+            yield value()
+            first = peek()
 
+class JsonStream(object):
+    """ An iterable of records to be written as a JSON array by the
+        :class:`JsonWriter` without the array being built in memory first,
+        the records are serialized as the request is sent. For example
+        ``resource.type('application/json').post(JsonStream(records))``.
+
+        The class supports the following data members.
+
+        * ``records`` - the iterable of records to serialize.
+    """
+    def __init__(self, records):
+        self.records = records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __deepcopy__(self, memo):
+        return self
 
 class JsonWriter(EntityWriter):
-    """ Write Python objects into ``application/json``. """
+    """ Write Python objects into ``application/json`` (and other ``+json``
+        types), using the specified :class:`JsonBackend` or else the 
+        fastest one installed. A :class:`JsonStream` is written 
+        incrementally as a JSON array. """
+    media_types = json and ['*/json', '*/*+json'] or []
+    backend = default_json_backend
+
+    def __init__(self, backend=None, chunk_size=8192):
+        if not backend is None:
+            self.backend = backend
+        self.chunk_size = chunk_size
+
     def is_writable(self, object, content_type):
-        if content_type.find(';') >= 0:
-            content_type = content_type[:content_type.find(';')]
-        return not json is None and content_type.endswith('/json')
+        return matches_media_type(self.media_types, content_type)
+
+    def iter_write(self, object, content_type):
+        if not isinstance(object, JsonStream):
+            return None
+        return self.iter_records(object)
+
+    def iter_records(self, records):
+        dumps = self.backend.dumps
+        buffer = ['[']
+        size = 1
+        for record in records:
+            if size > 1:
+                buffer.append(', ')
+            encoded = dumps(record)
+            buffer.append(encoded)
+            size = size + len(encoded) + 2
+            if size >= self.chunk_size:
+                yield ''.join(buffer)
+                buffer = []
+                size = 2
+        buffer.append(']')
+        yield ''.join(buffer)
 
     def write(self, object, content_type, to_file):
-        json.dump(object, to_file)
+        if isinstance(object, JsonStream):
+            for chunk in self.iter_records(object):
+                to_file.write(chunk)
+        else:
+            to_file.write(self.backend.dumps(object))
         return to_file
 
 class XmlReader(EntityReader):
-    """ Parse responses from ``application/xml`` into Python objects. """
+    """ Parse responses from ``application/xml`` (and other ``+xml`` 
+        types) into Python objects. """
+    media_types = ['*/xml', '*/*+xml']
+
     def is_readable(self, content_type):
-        if content_type.find(';') >= 0:
-            content_type = content_type[:content_type.find(';')]
-        if content_type.endswith('/xml') or content_type.endswith('+xml'):
-            return True
-        return False
+        return matches_media_type(self.media_types, content_type)
 
     def read(self, raw_entity, content_type):
         if raw_entity is None:
@@ -110,13 +685,123 @@ class XmlReader(EntityReader):
         logger.debug('Parsing input as XML')
         return fromstring(raw_entity)
 
+class ChunkFile(object):
+    """ A read-only file-like object over an iterator of string chunks,
+        used to feed a streaming entity to parsers which read files.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        buffered = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                chunk = self.chunks.next()
+            except StopIteration:
+                break
+            buffered.append(chunk)
+            length = length + len(chunk)
+        data = ''.join(buffered)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+class XmlStreamReader(XmlReader):
+    """ Parse responses from ``application/xml`` (and other ``+xml``
+        types) incrementally, the parsed entity is an iterator which yields
+        each element matching ``path`` once it is complete. The path is a
+        list of tags separated by ``/`` which must match the end of the
+        path from the root to the element, or the whole path if it starts
+        with ``/``. A tag without a ``{namespace}`` matches any namespace.
+
+        Each element is detached from its parent once it has been yielded,
+        and elements which are not part of a match are discarded once
+        parsed, so memory use does not grow with the number of records.
+        For a streaming response the entity is read from the response as 
+        the iterator is consumed.
+
+        This reader is not one of the client defaults, it can be added
+        with ``client.entity_classes.register(XmlStreamReader('record'), first=True)``;
+        ``first`` is needed so that it is used in place of the default
+        :class:`XmlReader`, which reads the same media types.
+    """
+    def __init__(self, path, chunk_size=65536):
+        self.anchored = path.startswith('/')
+        self.path = [tag for tag in path.split('/') if tag != '']
+        self.chunk_size = chunk_size
+
+    def read(self, raw_entity, content_type):
+        if raw_entity is None:
+            return iter([])
+        return self.read_stream(iter([raw_entity]), content_type)
+
+    def matches(self, tags):
+        """ matches(tags) -> boolean
+            Return whether the list of tags, from the root to an element,
+            matches the path of this reader.
+
+            :type tags: list of string
+            :param tags: The tags of the element and its ancestors.
+            :rtype: Boolean
+        """
+        if len(tags) < len(self.path) or (self.anchored and len(tags) != len(self.path)):
+            return False
+        for (expected, tag) in zip(reversed(self.path), reversed(tags)):
+            if expected != tag and (expected.startswith('{') or tag[tag.find('}') + 1:] != expected):
+                return False
+        return True
+
+    def read_stream(self, chunks, content_type):
+        """ read_stream(chunks, content_type) -> iterator
+            Return an iterator over the elements matching ``path`` parsed
+            from an iterator of string chunks of the entity.
+
+            :type chunks: iterator
+            :param chunks: The entity, as string chunks.
+            :type content_type: string
+            :param content_type: The MIME type of the resource.
+            :rtype: iterator
+        """
+        logger.debug('Parsing input as streaming XML')
+        tags = []
+        elements = []
+        matches = []
+        open_matches = 0
+        for (event, element) in iterparse(ChunkFile(chunks), events=('start', 'end')):
+            if event == 'start':
+                tags.append(element.tag)
+                elements.append(element)
+                matched = self.matches(tags)
+                if matched:
+                    open_matches = open_matches + 1
+                matches.append(matched)
+                continue
+            tags.pop()
+            elements.pop()
+            if matches.pop():
+                open_matches = open_matches - 1
+                yield element
+            elif open_matches > 0:
+                continue
+            else:
+                element.clear()
+            if len(elements) > 0:
+                parent = elements[-1]
+                if len(parent) > 0 and parent[-1] is element:
+                    del parent[-1]
+
 
 class XmlWriter(EntityWriter):
-    """ Write Python objects into ``application/xml``. """
+    """ Write Python objects into ``application/xml`` (and other ``+xml``
+        types). """
+    media_types = ['*/xml', '*/*+xml']
+
     def is_writable(self, object, content_type):
-        if content_type.find(';') >= 0:
-            content_type = content_type[:content_type.find(';')]
-        if content_type.endswith('/xml') or content_type.endswith('+xml'):
+        if matches_media_type(self.media_types, content_type):
             if isinstance(object, _ElementInterface) or isinstance(object, ElementTree):
                 return True
         return False
@@ -0,0 +1,234 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import logging, Queue, sys, threading
+
+logger = logging.getLogger('guernsey')
+
+class ResponseFuture(object):
+    """ A ``ResponseFuture`` represents a request that has been submitted
+        to a :class:`RequestExecutor` and which may not yet have completed.
+        It is returned from the ``*_async`` methods on
+        :class:`guernsey.WebResource`.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.finished = False
+        self.response = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        """ done() -> boolean
+            Return ``True`` if the request has completed, either with a
+            response or with an exception.
+
+            :rtype: Boolean
+        """
+        return self.finished
+
+    def result(self, timeout=None):
+        """ result(timeout=None) -> ClientResponse
+            Wait for the request to complete and return the response, if
+            the request raised an exception it is re-raised here.
+
+            :type timeout: float
+            :param timeout: the number of seconds to wait, or ``None`` to
+                wait for as long as it takes.
+            :rtype: :class:`guernsey.ClientResponse`
+            :raises: RuntimeError if the timeout expires first.
+        """
+        self.wait(timeout)
+        if not self.error is None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.response
+
+    def exception(self, timeout=None):
+        """ exception(timeout=None) -> Exception
+            Wait for the request to complete and return the exception it
+            raised, or ``None`` if it completed normally.
+
+            :type timeout: float
+            :param timeout: the number of seconds to wait, or ``None`` to
+                wait for as long as it takes.
+            :rtype: Exception
+        """
+        self.wait(timeout)
+        if self.error is None:
+            return None
+        return self.error[1]
+
+    def wait(self, timeout=None):
+        self.condition.acquire()
+        try:
+            if timeout is None:
+                while not self.finished:
+                    self.condition.wait()
+            elif not self.finished:
+                self.condition.wait(timeout)
+            if not self.finished:
+                raise RuntimeError('request did not complete within %s seconds' % timeout)
+        finally:
+            self.condition.release()
+
+    def add_done_callback(self, callback):
+        """ add_done_callback(callback)
+            Add a function to be called, with this future as its only
+            parameter, when the request completes. If the request has
+            already completed the function is called immediately.
+
+            :type callback: function
+            :param callback: the function to call.
+        """
+        self.condition.acquire()
+        try:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.condition.release()
+        self._call(callback)
+
+    def set_result(self, response):
+        self._finish(response, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def _finish(self, response, error):
+        self.condition.acquire()
+        try:
+            self.response = response
+            self.error = error
+            self.finished = True
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except:
+            logger.exception('Error in response future callback')
+
+class BatchResult(object):
+    """ The result of a single request made by ``Client.execute_all``,
+        exceptions raised by the request are captured rather than raised.
+
+        The class supports the following data members.
+
+        * ``index`` - the position of the request in the input sequence.
+        * ``resource`` - the resource the request was made against.
+        * ``method`` - the HTTP method used for the request.
+        * ``response`` - the :class:`guernsey.ClientResponse`, or ``None``
+          if the request raised an exception.
+        * ``error`` - the exception raised by the request, or ``None``.
+    """
+    def __init__(self, index, resource, method, response=None, error=None):
+        self.index = index
+        self.resource = resource
+        self.method = method
+        self.response = response
+        self.error = error
+
+    def succeeded(self):
+        """ succeeded() -> boolean
+            Return ``True`` if the request completed without an exception,
+            note that this says nothing about the HTTP status of the 
+            response.
+
+            :rtype: Boolean
+        """
+        return self.error is None
+
+    def __str__(self):
+        if self.error is None:
+            return '<Batch Result %d %s %s %s>' % (self.index, self.method, self.resource.url, self.response.status)
+        return '<Batch Result %d %s %s %r>' % (self.index, self.method, self.resource.url, self.error)
+
+class RequestExecutor(object):
+    """ A ``RequestExecutor`` runs requests on a bounded set of worker
+        threads, requests are queued until a worker is free. Workers are
+        started as needed up to ``max_workers`` and are daemon threads so
+        they do not prevent the process from exiting. A worker is busy for
+        the whole of a request, including waiting on the server, so no
+        more than ``max_workers`` requests are ever in flight at once.
+    """
+    def __init__(self, max_workers=10):
+        """ RequestExecutor(max_workers=10) -> RequestExecutor
+
+            :type max_workers: int
+            :param max_workers: the maximum number of worker threads.
+        """
+        self.max_workers = max_workers
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.idle = threading.Semaphore(0)
+        self.stopped = False
+
+    def submit(self, function, *args, **kwargs):
+        """ submit(function, *args, **kwargs) -> ResponseFuture
+            Queue the function to be called on a worker thread and return
+            a future for its result.
+
+            :type function: function
+            :param function: the function to call.
+            :rtype: :class:`ResponseFuture`
+        """
+        future = ResponseFuture()
+        self.lock.acquire()
+        try:
+            if self.stopped:
+                raise RuntimeError('executor has been shut down')
+            self.queue.put((future, function, args, kwargs))
+            if not self.idle.acquire(False) and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name='guernsey-worker-%d' % len(self.workers))
+                worker.daemon = True
+                self.workers.append(worker)
+                worker.start()
+        finally:
+            self.lock.release()
+        return future
+
+    def shutdown(self, wait=True):
+        """ shutdown(wait=True)
+            Stop the worker threads once the queued requests have been
+            run, no new requests may be submitted after this call.
+
+            :type wait: Boolean
+            :param wait: if ``True`` wait for the workers to finish.
+        """
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            workers = self.workers[:]
+        finally:
+            self.lock.release()
+        for worker in workers:
+            self.queue.put(None)
+        if wait:
+            for worker in workers:
+                if worker is not threading.currentThread():
+                    worker.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (future, function, args, kwargs) = item
+            try:
+                result = function(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+            self.idle.release()
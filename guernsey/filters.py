@@ -4,9 +4,72 @@
 # See LICENSE.txt included in this distribution or more details.
 #
 
-import gzip, logging, hashlib, StringIO
+import gzip, heapq, httplib, logging, hashlib, Queue, random, socket, StringIO, sys, threading, time, urllib2, urlparse, zlib
 
-from guernsey import ClientFilter
+from guernsey import ClientFilter, ClientResponse
+from guernsey.cache import CacheEntry, MemoryCache, parse_cache_control, parse_http_time
+from guernsey.connections import IDEMPOTENT_METHODS, entity_length
+from guernsey.entities import is_streaming_entity
+from guernsey.executor import RequestExecutor
+
+class GzipDecodingStream(object):
+    """ A file-like wrapper around a streaming response body which 
+        decompresses ``gzip`` encoded data incrementally as it is read.
+    """
+    def __init__(self, stream, chunk_size=8192):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.eof = False
+
+    def read(self, amt=None):
+        if amt is None:
+            data = [self.buffer]
+            self.buffer = ''
+            while not self.eof:
+                data.append(self._decode())
+            return ''.join(data)
+        while not self.eof and len(self.buffer) < amt:
+            self.buffer = self.buffer + self._decode()
+        data = self.buffer[:amt]
+        self.buffer = self.buffer[amt:]
+        return data
+
+    def _decode(self):
+        data = self.stream.read(self.chunk_size)
+        if data == '':
+            self.eof = True
+            return self.decoder.flush()
+        return self.decoder.decompress(data)
+
+    def close(self):
+        self.stream.close()
+
+class Md5VerifyingStream(object):
+    """ A file-like wrapper around a streaming response body which 
+        calculates the MD5 hash of the data as it is read and, once the
+        end of the stream is reached, compares it to the expected value.
+
+        :raises: ValueError if the hash does not match.
+    """
+    def __init__(self, stream, expected):
+        self.stream = stream
+        self.expected = expected
+        self.hash = hashlib.md5()
+        self.verified = False
+
+    def read(self, amt=None):
+        data = self.stream.read(amt)
+        self.hash.update(data)
+        if (amt is None or data == '') and not self.verified:
+            self.verified = True
+            if self.hash.hexdigest() != self.expected:
+                raise ValueError('MD5 hash mimatch')
+        return data
+
+    def close(self):
+        self.stream.close()
 
 class GzipContentEncodingFilter(ClientFilter):
     """ This filter does two things, on the request side it will add the
@@ -15,40 +78,169 @@ class GzipContentEncodingFilter(ClientFilter):
         and the response header ``Content-Encoding`` also set to ``gzip``.
         If the response does include the content encoding header the 
         filter will uncompress the data and replace the ``entity`` value
-        in the :class:`ClientResponse` object accordingly.
+        in the :class:`ClientResponse` object accordingly. For a streaming
+        response the ``body`` is instead wrapped so that it is uncompressed
+        incrementally as it is read.
     """
     def handle(self, client_request):
-        client_request.resource.headers['accept-encoding'] = 'gzip'
+        client_request.add_header('Accept-Encoding', 'gzip')
         client_response = client_request.next_filter(self).handle(client_request)
-        if client_response.headers['content-encoding'] == 'gzip':
-            data = StringIO.StringIO(client_response.entity)
-            encoded = gzip.GzipFile(fileobj=data, mode='rb')
-            entity = encoded.read()
-            encoded.close()
-            client_response.entity = entity
+        if client_response.headers.get('content-encoding') == 'gzip':
+            if not client_response.body is None:
+                client_response.body = GzipDecodingStream(client_response.body)
+            else:
+                data = StringIO.StringIO(client_response.entity)
+                encoded = gzip.GzipFile(fileobj=data, mode='rb')
+                entity = encoded.read()
+                encoded.close()
+                client_response.entity = entity
         return client_response
 
 class ContentMd5Filter(ClientFilter):
     """ This filter does two things, on the request side, if an entity is 
         present it will calculate an MD5 hash for the entity and include
-        a ``Content-MD5`` HTTP header. On the response side, if the response
+        a ``Content-MD5`` HTTP header (seekable file-like entities are read
+        once to calculate the hash and then rewound, iterator entities are
+        not hashed). On the response side, if the response
         includes this header the filter will calculate a new hash of the 
         entity it has been given and will compare the two values. If the 
         values do not match it will raise a :class:`ValueError` exception.
+        For a streaming response the hash is calculated as the ``body`` is
+        read, and the exception raised when the end of the body is reached.
     """
     def handle(self, client_request):
-        if not client_request.entity is None:
+        if isinstance(client_request.entity, basestring):
             hash = hashlib.md5()
             hash.update(client_request.entity)
             client_request.add_header('Content-MD5', hash.hexdigest())
-        client_response = client_request.next_filter(self).handle(client_request)
-        if not client_response.headers['content-md5'] is None:
+        elif hasattr(client_request.entity, 'read') and hasattr(client_request.entity, 'seek'):
             hash = hashlib.md5()
-            hash.update(client_response.entity)
-            if hash.hexdigest() != client_response.headers['content-md5']:
-                raise ValueError('MD5 hash mimatch')
+            position = client_request.entity.tell()
+            for block in iter(lambda: client_request.entity.read(8192), ''):
+                hash.update(block)
+            client_request.entity.seek(position)
+            client_request.add_header('Content-MD5', hash.hexdigest())
+        client_response = client_request.next_filter(self).handle(client_request)
+        if not client_response.headers.get('content-md5') is None:
+            if not client_response.body is None:
+                client_response.body = Md5VerifyingStream(client_response.body, client_response.headers['content-md5'])
+            else:
+                hash = hashlib.md5()
+                hash.update(client_response.entity)
+                if hash.hexdigest() != client_response.headers['content-md5']:
+                    raise ValueError('MD5 hash mimatch')
         return client_response
 
+class CacheFilter(ClientFilter):
+    """ This filter keeps ``GET`` responses in a cache and will answer
+        later requests for the same URL from the cache while they remain
+        fresh according to the ``Cache-Control`` (``max-age``, ``no-cache``,
+        ``no-store``) and ``Expires`` response headers. Once a stored
+        response is stale it is revalidated by sending ``If-None-Match``
+        and/or ``If-Modified-Since`` and, if the server responds with 
+        ``304 Not Modified``, the stored response is returned; any other
+        response replaces the stored one, or removes it if the new response
+        may not be stored. A successful ``PUT``, ``POST`` or ``DELETE`` 
+        removes any stored response for the URL. Streaming responses are never stored, although a streaming 
+        request may be answered from the cache.
+
+        The filter has to be configured with the following parameters on 
+        construction.
+
+        * ``cache`` - the store for responses, either a 
+          :class:`guernsey.cache.MemoryCache` or a 
+          :class:`guernsey.cache.DiskCache`; default is a new ``MemoryCache``.
+        * ``max_entries`` - the size of the default ``MemoryCache``; 
+          default is 1000.
+
+        The filter counts ``hits`` (answered without a request), 
+        ``revalidated`` (answered from the cache after a 304) and ``misses``.
+    """
+    def __init__(self, cache=None, max_entries=1000):
+        """ CacheFilter(cache=None, max_entries=1000) -> CacheFilter
+        """
+        if cache is None:
+            self.cache = MemoryCache(max_entries)
+        else:
+            self.cache = cache
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def handle(self, client_request):
+        if client_request.method != 'GET':
+            client_response = client_request.next_filter(self).handle(client_request)
+            if client_request.method in ['PUT', 'POST', 'DELETE'] and client_response.status < 400:
+                self.cache.remove(client_request.url)
+            return client_response
+        request_headers = self.request_headers(client_request)
+        directives = parse_cache_control(request_headers.get('cache-control'))
+        if 'no-store' in directives:
+            return client_request.next_filter(self).handle(client_request)
+        entry = None
+        if not 'no-cache' in directives and request_headers.get('pragma') != 'no-cache':
+            entry = self.cache.get(client_request.url)
+            if not entry is None and not entry.matches(request_headers):
+                entry = None
+        if not entry is None and entry.is_fresh():
+            self.count('hits')
+            return self.cached_response(client_request, entry)
+        if not entry is None:
+            for (name, value) in entry.validators().iteritems():
+                client_request.add_header(name, value)
+        client_response = client_request.next_filter(self).handle(client_request)
+        if not entry is None and client_response.status == 304:
+            entry.merge(client_response.headers)
+            self.cache.put(client_request.url, entry)
+            self.count('revalidated')
+            return self.cached_response(client_request, entry)
+        self.count('misses')
+        if not self.store(client_request, request_headers, client_response) and not entry is None:
+            # the stored response has been replaced by one we cannot keep.
+            self.cache.remove(client_request.url)
+        return client_response
+
+    def request_headers(self, client_request):
+        headers = dict([(k.lower(), v) for (k, v) in client_request.resource.headers.iteritems()])
+        headers.update([(k.lower(), v) for (k, v) in client_request.headers.iteritems()])
+        return headers
+
+    def store(self, client_request, request_headers, client_response):
+        """ store(client_request, request_headers, client_response) -> boolean
+            Store the response if it may be cached, returning ``True`` if
+            it was stored.
+        """
+        if client_response.status != 200 or not client_response.body is None:
+            return False
+        headers = dict(client_response.headers)
+        if 'no-store' in parse_cache_control(headers.get('cache-control')):
+            return False
+        vary = {}
+        for name in headers.get('vary', '').split(','):
+            name = name.strip().lower()
+            if name == '*':
+                return False
+            elif name != '':
+                vary[name] = request_headers.get(name)
+        entry = CacheEntry(client_response.url, client_response.status,
+            client_response.reason_phrase, headers, client_response.entity, vary)
+        if entry.expires > time.time() or len(entry.validators()) > 0:
+            self.cache.put(client_request.url, entry)
+            return True
+        return False
+
+    def cached_response(self, client_request, entry):
+        return ClientResponse(client_request.resource, entry.response(),
+            client_request.resource.client, client_request.stream)
+
+    def count(self, counter):
+        self.lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self.lock.release()
+
 class LoggingFilter(ClientFilter):
     """ This filter will log requests and responses, it uses the standard
         Python ``logging`` module and has to be configured with the 
@@ -87,3 +279,1005 @@ class LoggingFilter(ClientFilter):
             print 'Error writing response to log'
         return client_response
 
+class RetryBudget(object):
+    """ Limits the number of retries made, relative to the number of
+        requests, over a sliding time window. So that retries cannot 
+        multiply the load on a failing service, a retry is only allowed
+        while the retries in the window are fewer than ``minimum`` plus
+        ``ratio`` times the requests in the window.
+
+        The budget has to be configured with the following parameters on
+        construction.
+
+        * ``ratio`` - the proportion of requests which may be retried; 
+          default is 0.2.
+        * ``minimum`` - the number of retries always allowed in a window,
+          so that a low request rate may still retry; default is 10.
+        * ``window`` - the length of the window in seconds; default is 10.
+    """
+    def __init__(self, ratio=0.2, minimum=10, window=10.0):
+        """ RetryBudget(ratio=0.2, minimum=10, window=10.0) -> RetryBudget
+        """
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.lock = threading.Lock()
+        self.requests = []
+        self.retries = []
+
+    def expire(self, now):
+        horizon = now - self.window
+        for times in [self.requests, self.retries]:
+            expired = 0
+            while expired < len(times) and times[expired] < horizon:
+                expired = expired + 1
+            del times[:expired]
+
+    def record_request(self):
+        """ record_request()
+            Record that a request (not a retry) has been made.
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.expire(now)
+            self.requests.append(now)
+        finally:
+            self.lock.release()
+
+    def withdraw(self):
+        """ withdraw() -> boolean
+            Return ``True``, and record a retry, if the budget allows a 
+            retry to be made now.
+
+            :rtype: Boolean
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.expire(now)
+            if len(self.retries) >= self.minimum + self.ratio * len(self.requests):
+                return False
+            self.retries.append(now)
+            return True
+        finally:
+            self.lock.release()
+
+class RetryFilter(ClientFilter):
+    """ This filter will retry requests which fail with a transient error,
+        either an exception (such as a refused connection) or a response
+        status (such as ``503 Service Unavailable``). Retries are made after
+        an exponentially increasing delay with random jitter, or after the
+        delay given by a ``Retry-After`` response header. Only idempotent
+        methods are retried by default, so a ``POST`` is never retried 
+        unless it is added to ``methods``. A request entity which is a file
+        is rewound before a retry, one which cannot be rewound (such as
+        a generator) is never retried. No retry is made if the delay would
+        take the request past its deadline.
+
+        Retries are limited by a :class:`RetryBudget`, which should be
+        shared by all requests to the same service; adding the filter to
+        the client does this as all its resources share the filter. 
+
+        The filter has to be configured with the following parameters on 
+        construction.
+
+        * ``max_retries`` - the maximum number of retries of any request;
+          default is 3.
+        * ``backoff`` - the delay in seconds before the first retry, which
+          is doubled for each further retry; default is 0.1.
+        * ``max_backoff`` - the maximum delay in seconds; default is 10.
+        * ``jitter`` - if ``True`` the delay is chosen at random between 
+          zero and the computed delay; default is ``True``.
+        * ``statuses`` - the response status codes which are retried; 
+          default is 429, 502, 503 and 504.
+        * ``exceptions`` - the exception classes which are retried; default
+          is ``urllib2.URLError``, ``socket.error`` and 
+          ``httplib.HTTPException``. An exception with a ``retryable``
+          attribute of ``False`` (such as :class:`CircuitOpenError`) is 
+          never retried.
+        * ``methods`` - the methods which are retried; default is 
+          ``guernsey.connections.IDEMPOTENT_METHODS``.
+        * ``max_retry_after`` - the longest ``Retry-After`` delay, in 
+          seconds, which will be waited for, if a response asks for a longer
+          delay it is returned without retrying; default is 60.
+        * ``budget`` - the :class:`RetryBudget`; default is a new budget.
+
+        The filter counts ``retries`` (retries made) and ``exhausted``
+        (retries refused by the budget).
+    """
+    # shared with the connection pool, which resends the same methods when
+    # a reused connection fails.
+    IDEMPOTENT_METHODS = IDEMPOTENT_METHODS
+
+    def __init__(self, max_retries=3, backoff=0.1, max_backoff=10.0, jitter=True,
+                 statuses=(429, 502, 503, 504), exceptions=None, methods=None,
+                 max_retry_after=60.0, budget=None):
+        """ RetryFilter(max_retries=3, backoff=0.1, max_backoff=10.0, jitter=True,
+                statuses=(429, 502, 503, 504), exceptions=None, methods=None,
+                max_retry_after=60.0, budget=None) -> RetryFilter
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses
+        if exceptions is None:
+            self.exceptions = (urllib2.URLError, socket.error, httplib.HTTPException)
+        else:
+            self.exceptions = tuple(exceptions)
+        if methods is None:
+            self.methods = self.IDEMPOTENT_METHODS
+        else:
+            self.methods = methods
+        self.max_retry_after = max_retry_after
+        if budget is None:
+            self.budget = RetryBudget()
+        else:
+            self.budget = budget
+        self.sleep = time.sleep
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.exhausted = 0
+
+    def handle(self, client_request):
+        if not client_request.method in self.methods:
+            return client_request.next_filter(self).handle(client_request)
+        entity = client_request.entity
+        position = None
+        if is_streaming_entity(entity):
+            if hasattr(entity, 'seek') and hasattr(entity, 'tell'):
+                position = entity.tell()
+            else:
+                return client_request.next_filter(self).handle(client_request)
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            error = None
+            client_response = None
+            try:
+                client_response = client_request.next_filter(self).handle(client_request)
+            except self.exceptions, e:
+                if not getattr(e, 'retryable', True):
+                    raise
+                error = sys.exc_info()
+            if error is None and not client_response.status in self.statuses:
+                return client_response
+            delay = None
+            if attempt < self.max_retries:
+                delay = self.delay(attempt, client_response)
+            remaining = client_request.remaining()
+            if not delay is None and not remaining is None and delay >= remaining:
+                delay = None
+            if not delay is None and not self.budget.withdraw():
+                self.count('exhausted')
+                delay = None
+            if delay is None:
+                if error is None:
+                    return client_response
+                raise error[0], error[1], error[2]
+            if not client_response is None:
+                client_response.close()
+            logging.getLogger('guernsey').debug('Retrying %s %s in %.3fs' % 
+                (client_request.method, client_request.url, delay))
+            self.sleep(delay)
+            if not position is None:
+                entity.seek(position)
+            attempt = attempt + 1
+            self.count('retries')
+
+    def delay(self, attempt, client_response=None):
+        """ delay(attempt, client_response=None) -> float
+            Return the delay in seconds before the retry following 
+            ``attempt`` (counting from zero), or ``None`` if the response
+            asks for a longer delay than ``max_retry_after``.
+
+            :type attempt: int
+            :param attempt: the number of retries already made.
+            :type client_response: :class:`guernsey.ClientResponse`
+            :param client_response: the response being retried, if any.
+            :rtype: float
+        """
+        if not client_response is None:
+            retry_after = self.retry_after(client_response)
+            if not retry_after is None:
+                if retry_after > self.max_retry_after:
+                    return None
+                return retry_after
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def retry_after(self, client_response):
+        value = client_response.headers.get('retry-after')
+        if value is None:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        when = parse_http_time(value)
+        if when is None:
+            return None
+        return max(0.0, when - time.time())
+
+    def count(self, counter):
+        self.lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self.lock.release()
+
+class CircuitOpenError(urllib2.URLError):
+    """ Raised by the :class:`CircuitBreakerFilter` in place of making a
+        request to a host whose circuit is open. This is a subclass of
+        ``urllib2.URLError`` and so is handled in the same way as a failure
+        to reach the host, except that it is not retried by the 
+        :class:`RetryFilter`.
+
+        The class supports the following data members.
+
+        * ``host`` - the host whose circuit is open.
+    """
+    retryable = False
+
+    def __init__(self, host):
+        urllib2.URLError.__init__(self, 'circuit open for %s' % host)
+        self.host = host
+
+def host_key(url):
+    """ host_key(url) -> string
+        Return the key used to identify the host of a URL, the lower case
+        ``host:port`` without a default port. ``url`` may also be just a
+        host name or ``host:port``.
+
+        :type url: string
+        :param url: the URL or host.
+        :rtype: string
+    """
+    if url.find('://') < 0:
+        url = 'http://' + url
+    parsed = urlparse.urlsplit(url)
+    host = parsed.hostname or ''
+    port = parsed.port
+    if port is None or (parsed.scheme, port) in [('http', 80), ('https', 443)]:
+        return host
+    return '%s:%d' % (host, port)
+
+class Circuit(object):
+    """ The state of the circuit for a single host, as kept by the 
+        :class:`CircuitBreakerFilter`.
+
+        The class supports the following data members.
+
+        * ``host`` - the host key, see :py:func:`host_key`.
+        * ``state`` - one of ``CLOSED``, ``OPEN`` or ``HALF_OPEN``.
+        * ``opened_at`` - the time the circuit last opened.
+        * ``outcomes`` - the ``(time, failed, slow)`` outcome of each request 
+          in the current window.
+        * ``trials`` - the number of trial requests in progress, while
+          half-open.
+        * ``successes`` - the number of successful trial requests, while
+          half-open.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host):
+        self.host = host
+        self.state = Circuit.CLOSED
+        self.opened_at = None
+        self.outcomes = []
+        self.trials = 0
+        self.successes = 0
+
+    def __repr__(self):
+        return '<Circuit %s %s>' % (self.host, self.state)
+
+class CircuitBreakerFilter(ClientFilter):
+    """ This filter tracks the failure rate, and optionally the rate of
+        slow responses, of requests to each host. When either rate reaches
+        its threshold over a window of recent requests the circuit for 
+        the host opens, and requests to it fail immediately with a 
+        :class:`CircuitOpenError` instead of waiting on a host which is 
+        likely to fail. After ``reset_timeout`` seconds the circuit becomes
+        half-open and a limited number of trial requests are let through;
+        if they succeed the circuit closes, if any fails it opens again.
+
+        The state of each circuit may be retrieved with the 
+        :py:func:`guernsey.Client.circuit_state` method when the filter is
+        added to the client.
+
+        The filter has to be configured with the following parameters on 
+        construction.
+
+        * ``failure_rate`` - the proportion of failed requests which opens
+          the circuit; default is 0.5.
+        * ``min_requests`` - the number of requests in the window before 
+          the circuit may open; default is 10.
+        * ``window`` - the length in seconds of the window of requests
+          considered; default is 30.
+        * ``reset_timeout`` - the number of seconds a circuit stays open
+          before trial requests are allowed; default is 30.
+        * ``trial_requests`` - the number of successful trial requests
+          needed to close the circuit, and the number allowed at once;
+          default is 1.
+        * ``slow_duration`` - the number of seconds after which a response
+          is counted as slow, or ``None`` to not count slow responses; 
+          default is ``None``.
+        * ``slow_rate`` - the proportion of slow requests which opens the
+          circuit; default is 0.5.
+        * ``statuses`` - the response status codes which count as failures;
+          default is 500, 502, 503 and 504.
+        * ``exceptions`` - the exception classes which count as failures;
+          default is ``urllib2.URLError``, ``socket.error`` and 
+          ``httplib.HTTPException``.
+
+        The filter counts ``rejected`` (requests failed without being made).
+    """
+    def __init__(self, failure_rate=0.5, min_requests=10, window=30.0, reset_timeout=30.0,
+                 trial_requests=1, slow_duration=None, slow_rate=0.5,
+                 statuses=(500, 502, 503, 504), exceptions=None):
+        """ CircuitBreakerFilter(failure_rate=0.5, min_requests=10, window=30.0, 
+                reset_timeout=30.0, trial_requests=1, slow_duration=None, 
+                slow_rate=0.5, statuses=(500, 502, 503, 504), 
+                exceptions=None) -> CircuitBreakerFilter
+        """
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.trial_requests = trial_requests
+        self.slow_duration = slow_duration
+        self.slow_rate = slow_rate
+        self.statuses = statuses
+        if exceptions is None:
+            self.exceptions = (urllib2.URLError, socket.error, httplib.HTTPException)
+        else:
+            self.exceptions = tuple(exceptions)
+        self.clock = time.time
+        self.lock = threading.Lock()
+        self.circuits = {}
+        self.rejected = 0
+
+    def handle(self, client_request):
+        circuit = self.circuit(host_key(client_request.url))
+        if not self.allow(circuit):
+            raise CircuitOpenError(circuit.host)
+        start = self.clock()
+        try:
+            client_response = client_request.next_filter(self).handle(client_request)
+        except self.exceptions, e:
+            if isinstance(e, CircuitOpenError):
+                self.release(circuit)
+            else:
+                self.record(circuit, True, self.clock() - start)
+            raise
+        except:
+            self.release(circuit)
+            raise
+        self.record(circuit, client_response.status in self.statuses, self.clock() - start)
+        return client_response
+
+    def circuit(self, host):
+        """ circuit(host) -> Circuit
+            Return the circuit for the host key, creating it if needed.
+
+            :type host: string
+            :param host: the host key, see :py:func:`host_key`.
+            :rtype: :class:`Circuit`
+        """
+        self.lock.acquire()
+        try:
+            if not host in self.circuits:
+                self.circuits[host] = Circuit(host)
+            return self.circuits[host]
+        finally:
+            self.lock.release()
+
+    def circuit_state(self, host):
+        """ circuit_state(host) -> string
+            Return the state of the circuit for the host, ``Circuit.CLOSED``
+            if no requests have been made to it. An open circuit whose
+            ``reset_timeout`` has passed is reported as half-open.
+
+            :type host: string
+            :param host: a URL, host name or ``host:port``.
+            :rtype: string
+        """
+        self.lock.acquire()
+        try:
+            circuit = self.circuits.get(host_key(host))
+            if circuit is None:
+                return Circuit.CLOSED
+            self.update(circuit)
+            return circuit.state
+        finally:
+            self.lock.release()
+
+    def update(self, circuit):
+        if circuit.state == Circuit.OPEN and self.clock() - circuit.opened_at >= self.reset_timeout:
+            circuit.state = Circuit.HALF_OPEN
+            circuit.trials = 0
+            circuit.successes = 0
+
+    def allow(self, circuit):
+        self.lock.acquire()
+        try:
+            self.update(circuit)
+            if circuit.state == Circuit.CLOSED:
+                return True
+            if circuit.state == Circuit.HALF_OPEN and circuit.trials < self.trial_requests:
+                circuit.trials = circuit.trials + 1
+                return True
+            self.rejected = self.rejected + 1
+            return False
+        finally:
+            self.lock.release()
+
+    def release(self, circuit):
+        """ Release a trial without recording an outcome, for errors which
+            say nothing about the health of the host. """
+        self.lock.acquire()
+        try:
+            if circuit.state == Circuit.HALF_OPEN and circuit.trials > 0:
+                circuit.trials = circuit.trials - 1
+        finally:
+            self.lock.release()
+
+    def record(self, circuit, failed, duration):
+        slow = not self.slow_duration is None and duration >= self.slow_duration
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            if circuit.state == Circuit.HALF_OPEN:
+                circuit.trials = max(0, circuit.trials - 1)
+                if failed or slow:
+                    self.trip(circuit, now)
+                else:
+                    circuit.successes = circuit.successes + 1
+                    if circuit.successes >= self.trial_requests:
+                        circuit.state = Circuit.CLOSED
+                        circuit.outcomes = []
+                return
+            if circuit.state == Circuit.OPEN:
+                return
+            outcomes = circuit.outcomes
+            outcomes.append((now, failed, slow))
+            horizon = now - self.window
+            expired = 0
+            while expired < len(outcomes) and outcomes[expired][0] < horizon:
+                expired = expired + 1
+            del outcomes[:expired]
+            if len(outcomes) < self.min_requests:
+                return
+            failures = len([o for o in outcomes if o[1]])
+            slows = len([o for o in outcomes if o[2]])
+            if failures >= self.failure_rate * len(outcomes) or \
+               (not self.slow_duration is None and slows >= self.slow_rate * len(outcomes)):
+                self.trip(circuit, now)
+        finally:
+            self.lock.release()
+
+    def trip(self, circuit, now):
+        logging.getLogger('guernsey').warning('Opening circuit for %s' % circuit.host)
+        circuit.state = Circuit.OPEN
+        circuit.opened_at = now
+        circuit.outcomes = []
+        circuit.trials = 0
+        circuit.successes = 0
+
+class HedgedRequest(object):
+    """ The state of a single request made through a :class:`HedgingFilter`,
+        shared by the caller's thread, which sends the first request, and
+        the executor threads which send the extra requests.
+
+        The class supports the following data members.
+
+        * ``requests`` - the copies of the request sent, the first is the
+          request sent on the caller's thread.
+        * ``results`` - a queue of ``(index, client_response, exc_info)``
+          for the extra requests.
+        * ``decided`` - ``True`` once a response has been chosen, or all
+          requests have failed.
+        * ``won`` - ``True`` if the response chosen is from an extra request.
+        * ``pending`` - the number of extra requests not yet completed.
+    """
+    def __init__(self, next, client_request, start, delay):
+        self.next = next
+        self.client_request = client_request
+        self.start = start
+        self.delay = delay
+        self.requests = []
+        self.results = Queue.Queue()
+        self.decided = False
+        self.won = False
+        self.pending = 0
+        self.timer = None
+
+class HedgingFilter(ClientFilter):
+    """ This filter reduces tail latency by hedging idempotent requests; if
+        no response has arrived after a delay a second, identical, request
+        is sent and whichever response arrives first is returned. The other
+        request is cancelled (see :py:func:`guernsey.ClientRequest.cancel`)
+        and its response discarded. An error is only returned if every 
+        request sent fails. Requests with a streaming entity are never 
+        hedged.
+
+        The first request is sent on the caller's thread, so a request 
+        which is not hedged costs no more than a timer entry. The extra 
+        requests are sent on a small :class:`guernsey.executor.RequestExecutor`
+        belonging to the filter, and are scheduled by a single timer 
+        thread.
+
+        The delay may be fixed or may track a percentile of the latency of 
+        recent requests, so that only the slowest requests are hedged. The
+        extra load is limited by a :class:`RetryBudget`, by default to one
+        hedged request for every ten requests.
+
+        The filter has to be configured with the following parameters on 
+        construction.
+
+        * ``delay`` - the number of seconds to wait before hedging, used
+          until enough latencies are known if ``percentile`` is specified;
+          default is 0.05.
+        * ``percentile`` - if specified, the percentile (for example 95) of
+          recent latencies to wait before hedging; default is ``None``.
+        * ``max_hedges`` - the maximum number of extra requests for each
+          request; default is 1.
+        * ``methods`` - the methods which are hedged; default is ``GET``,
+          ``HEAD`` and ``OPTIONS``.
+        * ``budget`` - the :class:`RetryBudget` which limits the number of
+          hedged requests; default is ``RetryBudget(0.1, 1)``.
+        * ``samples`` - the number of recent latencies kept; default is 1000.
+        * ``max_workers`` - the number of threads sending extra requests,
+          an extra request waits if they are all busy; default is 4.
+
+        The filter counts ``hedged`` (extra requests sent), ``wins`` 
+        (responses returned from an extra request) and ``exhausted``
+        (extra requests refused by the budget).
+    """
+    def __init__(self, delay=0.05, percentile=None, max_hedges=1, methods=('GET', 'HEAD', 'OPTIONS'),
+                 budget=None, samples=1000, max_workers=4):
+        """ HedgingFilter(delay=0.05, percentile=None, max_hedges=1, 
+                methods=('GET', 'HEAD', 'OPTIONS'), budget=None, 
+                samples=1000, max_workers=4) -> HedgingFilter
+        """
+        self.delay = delay
+        self.percentile = percentile
+        self.max_hedges = max_hedges
+        self.methods = methods
+        if budget is None:
+            self.budget = RetryBudget(0.1, 1)
+        else:
+            self.budget = budget
+        self.samples = samples
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.executor = RequestExecutor(max_workers)
+        self.timers = []
+        self.timer_condition = threading.Condition()
+        self.timer_thread = None
+        self.scheduled = 0
+        self.hedged = 0
+        self.wins = 0
+        self.exhausted = 0
+
+    def handle(self, client_request):
+        if not client_request.method in self.methods or is_streaming_entity(client_request.entity):
+            return client_request.next_filter(self).handle(client_request)
+        start = time.time()
+        hedged = HedgedRequest(client_request.next_filter(self), client_request, start, self.hedge_delay())
+        self.budget.record_request()
+        request = client_request.copy()
+        hedged.requests.append(request)
+        if self.max_hedges > 0:
+            self.schedule(start + hedged.delay, hedged)
+        try:
+            client_response = hedged.next.handle(request)
+        except:
+            exc_info = sys.exc_info()
+            self.lock.acquire()
+            try:
+                # fail now unless there are extra requests still to finish.
+                decided = hedged.decided
+                if hedged.pending == 0:
+                    hedged.decided = True
+            finally:
+                self.lock.release()
+            if not decided and hedged.decided:
+                self.unschedule(hedged)
+                raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            self.lock.acquire()
+            try:
+                decided = hedged.decided
+                hedged.decided = True
+            finally:
+                self.lock.release()
+            if not decided:
+                self.unschedule(hedged)
+                self.cancel(hedged, request)
+                self.record(time.time() - start)
+                return client_response
+            self.discard(client_response)
+        while True:
+            (index, client_response, exc_info) = hedged.results.get()
+            if exc_info is None:
+                self.record(time.time() - start)
+                self.count('wins')
+                return client_response
+            self.lock.acquire()
+            try:
+                failed = hedged.pending == 0 and not hedged.won
+                if failed:
+                    hedged.decided = True
+            finally:
+                self.lock.release()
+            if failed:
+                self.unschedule(hedged)
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+    def schedule(self, due, hedged):
+        """ schedule(due, hedged)
+            Arrange for an extra request to be sent at the time ``due`` if
+            no response has been chosen by then.
+        """
+        self.timer_condition.acquire()
+        try:
+            self.scheduled = self.scheduled + 1
+            hedged.timer = (due, self.scheduled, hedged)
+            heapq.heappush(self.timers, hedged.timer)
+            if self.timer_thread is None:
+                self.timer_thread = threading.Thread(target=self.run_timers, name='guernsey-hedge-timer')
+                self.timer_thread.setDaemon(True)
+                self.timer_thread.start()
+            elif self.timers[0][2] is hedged:
+                self.timer_condition.notify()
+        finally:
+            self.timer_condition.release()
+
+    def unschedule(self, hedged):
+        """ unschedule(hedged)
+            Remove any extra request still to be sent for a request which
+            has been decided.
+        """
+        self.timer_condition.acquire()
+        try:
+            if hedged.timer in self.timers:
+                self.timers.remove(hedged.timer)
+                heapq.heapify(self.timers)
+            hedged.timer = None
+        finally:
+            self.timer_condition.release()
+
+    def run_timers(self):
+        while True:
+            self.timer_condition.acquire()
+            try:
+                while True:
+                    if len(self.timers) == 0:
+                        self.timer_condition.wait()
+                        continue
+                    wait = self.timers[0][0] - time.time()
+                    if wait <= 0:
+                        break
+                    self.timer_condition.wait(wait)
+                (due, n, hedged) = heapq.heappop(self.timers)
+            finally:
+                self.timer_condition.release()
+            try:
+                self.send(hedged)
+            except:
+                logging.getLogger('guernsey').exception('Error sending hedged request')
+
+    def send(self, hedged):
+        self.lock.acquire()
+        try:
+            if hedged.decided:
+                return
+            index = len(hedged.requests)
+            if not self.budget.withdraw():
+                self.exhausted = self.exhausted + 1
+                return
+            self.hedged = self.hedged + 1
+            request = hedged.client_request.copy()
+            hedged.requests.append(request)
+            hedged.pending = hedged.pending + 1
+        finally:
+            self.lock.release()
+        self.executor.submit(self.run_hedge, hedged, request, index)
+        if index < self.max_hedges:
+            self.schedule(hedged.start + hedged.delay * (index + 1), hedged)
+
+    def run_hedge(self, hedged, request, index):
+        exc_info = None
+        client_response = None
+        try:
+            client_response = hedged.next.handle(request)
+        except:
+            exc_info = sys.exc_info()
+        self.lock.acquire()
+        try:
+            hedged.pending = hedged.pending - 1
+            decided = hedged.decided
+            if exc_info is None and not decided:
+                hedged.decided = hedged.won = True
+        finally:
+            self.lock.release()
+        if decided:
+            self.discard(client_response)
+        elif exc_info is None:
+            hedged.results.put((index, client_response, None))
+            self.unschedule(hedged)
+            self.cancel(hedged, request)
+        else:
+            hedged.results.put((index, None, exc_info))
+
+    def cancel(self, hedged, winner):
+        for request in hedged.requests:
+            if not request is winner:
+                request.cancel()
+
+    def discard(self, client_response):
+        if not client_response is None:
+            try:
+                client_response.close()
+            except:
+                pass
+
+    def hedge_delay(self):
+        """ hedge_delay() -> float
+            Return the number of seconds to wait before sending an extra
+            request, either the fixed ``delay`` or the ``percentile`` of the
+            recent latencies.
+
+            :rtype: float
+        """
+        if self.percentile is None:
+            return self.delay
+        self.lock.acquire()
+        try:
+            latencies = sorted(self.latencies)
+        finally:
+            self.lock.release()
+        if len(latencies) < 20:
+            return self.delay
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))]
+
+    def record(self, latency):
+        self.lock.acquire()
+        try:
+            self.latencies.append(latency)
+            if len(self.latencies) > self.samples:
+                del self.latencies[0]
+        finally:
+            self.lock.release()
+
+    def count(self, counter):
+        self.lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self.lock.release()
+
+class Histogram(object):
+    """ A histogram of observed values, with cumulative counts for each
+        bucket upper bound as used by Prometheus.
+
+        The class supports the following data members.
+
+        * ``buckets`` - the sorted upper bounds of the buckets.
+        * ``counts`` - the number of observations less than or equal to 
+          each bound.
+        * ``count`` - the total number of observations.
+        * ``sum`` - the sum of all observations.
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        if buckets is None:
+            buckets = Histogram.DEFAULT_BUCKETS
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """ observe(value)
+            Add an observation to the histogram.
+
+            :type value: float
+            :param value: the observed value.
+        """
+        for i in range(len(self.buckets) - 1, -1, -1):
+            if value > self.buckets[i]:
+                break
+            self.counts[i] = self.counts[i] + 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+    def snapshot(self):
+        """ snapshot() -> dict
+            Return the histogram as a dictionary with ``count``, ``sum`` and
+            ``buckets``, a list of ``(bound, cumulative count)`` pairs.
+
+            :rtype: dict
+        """
+        return {'count': self.count, 'sum': self.sum, 'buckets': zip(self.buckets, self.counts)}
+
+class MetricsFilter(ClientFilter):
+    """ This filter records metrics for each request, labelled by host and
+        method. Latency histograms are kept for the whole request (as seen
+        by the filter) and for each phase of the response; connecting, 
+        waiting for the first byte, reading the entity and parsing it. The
+        read and parse phases of a streaming or lazily parsed response are
+        recorded when they happen, after the filter has returned. Counters
+        are kept of responses by status, errors and the bytes sent and 
+        received, along with a gauge of the requests in flight.
+
+        A snapshot of the metrics may be retrieved with :py:func:`snapshot`
+        or :py:func:`prometheus`, or from the client with 
+        :py:func:`guernsey.Client.metrics` when the filter is added to the
+        client. For the phase timings to be recorded this filter should be
+        the first filter added to the client, so it is last in the chain.
+
+        The filter has to be configured with the following parameters on 
+        construction.
+
+        * ``buckets`` - the upper bounds, in seconds, of the latency 
+          histogram buckets; default is ``Histogram.DEFAULT_BUCKETS``.
+        * ``prefix`` - the prefix for metric names; default is ``guernsey``.
+    """
+    PHASES = ('connect', 'first_byte', 'read', 'parse')
+
+    def __init__(self, buckets=None, prefix='guernsey'):
+        """ MetricsFilter(buckets=None, prefix='guernsey') -> MetricsFilter
+        """
+        self.buckets = buckets
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ reset()
+            Discard all recorded metrics.
+        """
+        self.lock.acquire()
+        try:
+            self.histograms = {}
+            self.counters = {}
+            self.gauges = {}
+        finally:
+            self.lock.release()
+
+    def handle(self, client_request):
+        labels = (('host', host_key(client_request.url)), ('method', client_request.method))
+        sent = 0
+        if isinstance(client_request.entity, basestring) or hasattr(client_request.entity, 'seek'):
+            sent = entity_length(client_request.entity) or 0
+        self.add('in_flight', labels[:1], 1, self.gauges)
+        start = time.time()
+        try:
+            try:
+                client_response = client_request.next_filter(self).handle(client_request)
+            except:
+                self.add('errors_total', labels, 1)
+                raise
+        finally:
+            self.add('in_flight', labels[:1], -1, self.gauges)
+            self.observe('request_duration_seconds', labels, time.time() - start)
+            self.add('request_bytes_total', labels, sent)
+        self.add('responses_total', labels + (('status', str(client_response.status)),), 1)
+        timings = getattr(client_response, 'timings', {})
+        for phase in self.PHASES:
+            if phase in timings:
+                self.response_timing(labels, client_response, phase, timings[phase])
+        if hasattr(client_response, 'add_listener'):
+            client_response.add_listener(lambda response, phase, seconds: 
+                self.response_timing(labels, response, phase, seconds))
+        return client_response
+
+    def response_timing(self, labels, client_response, phase, seconds):
+        if phase in self.PHASES:
+            self.observe('%s_seconds' % phase, labels, seconds)
+        if phase == 'read':
+            self.add('response_bytes_total', labels, getattr(client_response, 'bytes_read', 0))
+
+    def observe(self, name, labels, value):
+        self.lock.acquire()
+        try:
+            key = (name, labels)
+            if not key in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(value)
+        finally:
+            self.lock.release()
+
+    def add(self, name, labels, value, metrics=None):
+        if metrics is None:
+            metrics = self.counters
+        self.lock.acquire()
+        try:
+            key = (name, labels)
+            metrics[key] = metrics.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """ snapshot() -> dict
+            Return the current metrics as a dictionary of metric name to a
+            list of samples, each a dictionary with the ``labels`` (itself a 
+            dictionary) and either a ``value`` or, for histograms, the
+            ``count``, ``sum`` and ``buckets``.
+
+            :rtype: dict
+        """
+        self.lock.acquire()
+        try:
+            (metrics, types) = self._snapshot_locked()
+        finally:
+            self.lock.release()
+        return metrics
+
+    def _snapshot_locked(self):
+        """ _snapshot_locked() -> (dict, dict)
+            Return the current metrics, as :py:func:`snapshot` does, and a
+            dictionary of metric name to type. The caller must hold
+            ``lock`` so that both describe the same set of metrics.
+        """
+        metrics = {}
+        types = {}
+        for ((name, labels), histogram) in self.histograms.items():
+            sample = histogram.snapshot()
+            sample['labels'] = dict(labels)
+            metrics.setdefault(name, []).append(sample)
+            types[name] = 'histogram'
+        for (values, kind) in [(self.counters, 'counter'), (self.gauges, 'gauge')]:
+            for ((name, labels), value) in values.items():
+                metrics.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+                types[name] = kind
+        for samples in metrics.values():
+            samples.sort(key=lambda sample: sorted(sample['labels'].items()))
+        return (metrics, types)
+
+    def prometheus(self):
+        """ prometheus() -> string
+            Return the current metrics in the Prometheus text exposition
+            format, with each metric name prefixed by ``prefix``.
+
+            :rtype: string
+        """
+        def format_labels(labels, extra=()):
+            pairs = sorted(labels.items()) + list(extra)
+            if len(pairs) == 0:
+                return ''
+            return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for (k, v) in pairs])
+        def format_value(value):
+            if value == float('inf'):
+                return '+Inf'
+            return repr(value)
+        self.lock.acquire()
+        try:
+            (metrics, types) = self._snapshot_locked()
+        finally:
+            self.lock.release()
+        lines = []
+        for name in sorted(metrics.keys()):
+            full_name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s %s' % (full_name, types[name]))
+            for sample in metrics[name]:
+                labels = sample['labels']
+                if types[name] == 'histogram':
+                    for (bound, count) in sample['buckets']:
+                        lines.append('%s_bucket%s %d' % (full_name, 
+                            format_labels(labels, [('le', format_value(bound))]), count))
+                    lines.append('%s_bucket%s %d' % (full_name, 
+                        format_labels(labels, [('le', '+Inf')]), sample['count']))
+                    lines.append('%s_sum%s %s' % (full_name, format_labels(labels), format_value(sample['sum'])))
+                    lines.append('%s_count%s %d' % (full_name, format_labels(labels), sample['count']))
+                else:
+                    lines.append('%s%s %s' % (full_name, format_labels(labels), format_value(sample['value'])))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,150 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import UserDict
+
+def header_name(line):
+    """ header_name(line) -> string
+        Return the lower case name of a raw header line, or ``None`` for a
+        continuation line or a line which is not a header.
+
+        :type line: string
+        :param line: a raw header line such as ``'Content-Type: text/plain\\r\\n'``.
+        :rtype: string
+    """
+    if line[:1] in [' ', '\t']:
+        return None
+    colon = line.find(':')
+    if colon < 0:
+        return None
+    return line[:colon].strip().lower()
+
+class HeaderMap(object, UserDict.DictMixin):
+    """ A case-insensitive dictionary of HTTP headers kept as the raw header
+        lines of a response, as found in ``mimetools.Message.headers``. The
+        lines are not parsed until a header is first looked up, and then
+        only to build an index of header name to line; values are taken
+        from the line each time they are requested. The list of lines is
+        shared, with the message it came from and with any copies of the
+        map, until the map is changed.
+
+        Names returned by ``keys`` are in lower case, as for the dictionary
+        previously used for response headers. If a header appears more than
+        once the last value is returned, and continuation lines are joined
+        to the value of the header they continue.
+
+        The class supports the following data members.
+
+        * ``lines`` - the raw header lines, each ``'Name: value\\r\\n'``.
+    """
+    __slots__ = ('lines', 'index', 'shared')
+
+    def __init__(self, headers=None):
+        """ HeaderMap(headers=None) -> HeaderMap
+
+            :param headers: either a list of raw header lines, which is
+                shared rather than copied, or a dictionary of header names
+                and values.
+        """
+        if headers is None:
+            (self.lines, self.shared) = ([], False)
+        elif hasattr(headers, 'items'):
+            (self.lines, self.shared) = (['%s: %s\r\n' % (k, v) for (k, v) in headers.items()], False)
+        else:
+            (self.lines, self.shared) = (headers, True)
+        self.index = None
+
+    def _index(self):
+        index = self.index
+        if index is None:
+            index = {}
+            for (i, line) in enumerate(self.lines):
+                name = header_name(line)
+                if not name is None:
+                    index[name] = i
+            self.index = index
+        return index
+
+    def _own(self):
+        if self.shared:
+            self.lines = list(self.lines)
+            self.shared = False
+
+    def __getitem__(self, name):
+        lines = self.lines
+        i = self._index()[name.lower()]
+        line = lines[i]
+        value = line[line.find(':') + 1:].strip()
+        while i + 1 < len(lines) and lines[i + 1][:1] in [' ', '\t']:
+            i = i + 1
+            value = value + ' ' + lines[i].strip()
+        return value
+
+    def __setitem__(self, name, value):
+        self._own()
+        line = '%s: %s\r\n' % (name, value)
+        index = self._index()
+        key = name.lower()
+        if key in index:
+            self.__delitem__(name)
+            index = self._index()
+        self.lines.append(line)
+        index[key] = len(self.lines) - 1
+
+    def __delitem__(self, name):
+        key = name.lower()
+        if not key in self._index():
+            raise KeyError(name)
+        self._own()
+        lines = []
+        skipping = False
+        for line in self.lines:
+            name = header_name(line)
+            if name is None and line[:1] in [' ', '\t']:
+                if skipping:
+                    continue
+            else:
+                skipping = name == key
+                if skipping:
+                    continue
+            lines.append(line)
+        self.lines = lines
+        self.index = None
+
+    def __contains__(self, name):
+        return name.lower() in self._index()
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self._index())
+
+    def keys(self):
+        return self._index().keys()
+
+    def get(self, name, default=None):
+        if not name.lower() in self._index():
+            return default
+        return self[name]
+
+    def copy(self):
+        """ copy() -> HeaderMap
+            Return a copy of this map, which shares the header lines until
+            either map is changed.
+
+            :rtype: :class:`HeaderMap`
+        """
+        headers = HeaderMap(self.lines)
+        self.shared = True
+        if not self.index is None:
+            headers.index = dict(self.index)
+        return headers
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
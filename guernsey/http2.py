@@ -0,0 +1,569 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+""" An HTTP/2 transport for the client, using the ``h2`` package for the
+    protocol itself. All requests to the same scheme, host and port are
+    multiplexed as concurrent streams over a single connection, with
+    headers compressed by HPACK.
+
+    The transport is used in place of the client's ``actual_client``::
+
+      client = Client.create({'transport': 'http2'})
+
+    Plain ``http`` URLs are sent as HTTP/2 over cleartext (h2c) with prior
+    knowledge, so the server must speak HTTP/2 directly. For ``https`` URLs
+    HTTP/2 is negotiated with ALPN and if the server does not select it the
+    request is passed to the ``fallback`` transport, usually the client's
+    original HTTP/1.1 :class:`guernsey.ExecClientFilter`.
+"""
+
+import httplib, logging, mimetools, socket, ssl, StringIO, threading, time, urllib2, urlparse
+
+try:
+    import h2.config, h2.connection, h2.events, h2.exceptions, h2.errors
+except ImportError:
+    h2 = None
+
+from guernsey import ClientFilter, ClientResponse
+from guernsey.connections import DEFAULT_PORTS, DeadlineExceededError, entity_length, iter_body
+
+logger = logging.getLogger('guernsey')
+
+# Connection-specific headers which are not allowed in HTTP/2 (RFC 7540
+# section 8.1.2.2), the Host header is replaced by the :authority pseudo
+# header.
+CONNECTION_HEADERS = ['connection', 'host', 'keep-alive', 'proxy-connection',
+                      'transfer-encoding', 'upgrade']
+
+REDIRECT_STATUSES = [301, 302, 303, 307]
+
+MAX_REDIRECTS = 10
+
+READ_SIZE = 65536
+
+class Http2Stream(object):
+    """ The state of a single request/response stream on an
+        :class:`Http2Connection`, updated by the connection's reader
+        thread. All members are guarded by the connection's ``lock``.
+
+        The class supports the following data members.
+
+        * ``stream_id`` - the HTTP/2 stream identifier.
+        * ``headers`` - the response headers as a list of ``(name, value)``
+          tuples, ``None`` until they have been received.
+        * ``chunks`` - the data received and not yet read.
+        * ``ended`` - ``True`` once the server has ended the stream.
+        * ``error`` - an exception if the stream was reset or the
+          connection failed.
+    """
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.headers = None
+        self.chunks = []
+        self.ended = False
+        self.error = None
+
+class Http2Connection(object):
+    """ A single HTTP/2 connection to a server, shared by any number of
+        concurrent requests. A reader thread receives frames from the server
+        and updates the state of each :class:`Http2Stream`, requests wait
+        on the connection's ``condition`` for their stream to change.
+
+        The class supports the following data members.
+
+        * ``key`` - the ``(scheme, host, port)`` the connection is for.
+        * ``connection`` - the ``h2.connection.H2Connection`` protocol state.
+        * ``streams`` - a dictionary of stream identifier to
+          :class:`Http2Stream` for the open streams.
+        * ``closed`` - ``True`` once the connection has failed or been
+          closed by either side, no new streams may be started.
+    """
+    def __init__(self, key, sock):
+        """ Http2Connection(key, sock) -> Http2Connection
+            Start the HTTP/2 connection on a connected socket, and the
+            reader thread for it.
+
+            :type key: tuple
+            :param key: the ``(scheme, host, port)`` of the server.
+            :param sock: the connected socket.
+        """
+        self.key = key
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.connection = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True, header_encoding='utf-8'))
+        self.streams = {}
+        self.closed = False
+        self.connection.initiate_connection()
+        self.flush()
+        self.reader = threading.Thread(target=self.read_frames)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def flush(self):
+        """ flush()
+            Send any frames waiting to be sent to the server.
+        """
+        self.write_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                data = self.connection.data_to_send()
+            finally:
+                self.lock.release()
+            if len(data) > 0:
+                self.sock.sendall(data)
+        finally:
+            self.write_lock.release()
+
+    def read_frames(self):
+        error = None
+        try:
+            while True:
+                data = self.sock.recv(READ_SIZE)
+                if data == '':
+                    break
+                self.lock.acquire()
+                try:
+                    events = self.connection.receive_data(data)
+                    for event in events:
+                        self.handle_event(event)
+                    self.condition.notifyAll()
+                finally:
+                    self.lock.release()
+                self.flush()
+        except (socket.error, h2.exceptions.ProtocolError), e:
+            error = e
+        self.fail(urllib2.URLError(error or 'connection closed by server'))
+
+    def handle_event(self, event):
+        stream = self.streams.get(getattr(event, 'stream_id', None))
+        if isinstance(event, h2.events.ResponseReceived):
+            if not stream is None:
+                stream.headers = event.headers
+        elif isinstance(event, h2.events.DataReceived):
+            if not stream is None:
+                stream.chunks.append(event.data)
+            else:
+                self.connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            if not stream is None:
+                stream.ended = True
+        elif isinstance(event, h2.events.StreamReset):
+            if not stream is None:
+                stream.error = urllib2.URLError('stream reset by server, error code %d' % event.error_code)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.closed = True
+            for stream in self.streams.values():
+                if stream.stream_id > (event.last_stream_id or 0) and stream.error is None:
+                    stream.error = urllib2.URLError('connection terminated by server')
+
+    def fail(self, error):
+        """ fail(error)
+            Mark the connection closed and fail any streams still open.
+        """
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for stream in self.streams.values():
+                if not stream.ended and stream.error is None:
+                    stream.error = error
+            self.condition.notifyAll()
+        finally:
+            self.lock.release()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        """ close()
+            Close the connection, failing any open streams.
+        """
+        self.lock.acquire()
+        try:
+            if not self.closed:
+                self.connection.close_connection()
+        finally:
+            self.lock.release()
+        try:
+            self.flush()
+        except socket.error:
+            pass
+        self.fail(urllib2.URLError('connection closed'))
+
+    def wait(self, stream, predicate, timeout):
+        """ wait(stream, predicate, timeout)
+            Wait, with the ``lock`` held, until ``predicate()`` is true or
+            the stream fails.
+
+            :raises urllib2.URLError: if the stream fails or the timeout
+                expires.
+        """
+        end = None
+        if not timeout is None:
+            end = time.time() + timeout
+        while not predicate():
+            if not stream.error is None:
+                raise stream.error
+            if end is None:
+                self.condition.wait()
+            else:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise urllib2.URLError(socket.timeout('timed out'))
+                self.condition.wait(remaining)
+
+    def start_request(self, method, authority, path, headers, body, timeout):
+        """ start_request(method, authority, path, headers, body, timeout) -> Http2Stream
+            Open a new stream and send the request headers and body.
+
+            :type headers: list
+            :param headers: the request headers as ``(name, value)`` tuples,
+                names must be lower case.
+            :param body: ``None``, a string, file-like object or iterator
+                of strings.
+            :rtype: :class:`Http2Stream`
+        """
+        request_headers = [(':method', method), (':authority', authority),
+                           (':scheme', self.key[0]), (':path', path)] + headers
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise urllib2.URLError('connection closed')
+            stream_id = self.connection.get_next_available_stream_id()
+            stream = Http2Stream(stream_id)
+            self.streams[stream_id] = stream
+            self.connection.send_headers(stream_id, request_headers, end_stream=body is None)
+        finally:
+            self.lock.release()
+        self.flush()
+        if not body is None:
+            for block in iter_body(body):
+                while len(block) > 0:
+                    self.lock.acquire()
+                    try:
+                        self.wait(stream, lambda: self.window(stream_id) > 0, timeout)
+                        size = min(len(block), self.window(stream_id))
+                        self.connection.send_data(stream_id, block[:size])
+                    finally:
+                        self.lock.release()
+                    block = block[size:]
+                    self.flush()
+            self.lock.acquire()
+            try:
+                self.connection.end_stream(stream_id)
+            finally:
+                self.lock.release()
+            self.flush()
+        return stream
+
+    def window(self, stream_id):
+        return min(self.connection.local_flow_control_window(stream_id),
+                   self.connection.max_outbound_frame_size)
+
+    def read(self, stream, size, timeout):
+        """ read(stream, size, timeout) -> string
+            Read up to ``size`` bytes (or all, if ``size`` is negative) of
+            the response entity from a stream, returning an empty string at
+            the end of the entity. Data read is acknowledged to the server
+            so that it may send more.
+        """
+        self.lock.acquire()
+        try:
+            if size < 0:
+                self.wait(stream, lambda: stream.ended, timeout)
+            else:
+                self.wait(stream, lambda: stream.ended or len(stream.chunks) > 0, timeout)
+            data = ''.join(stream.chunks)
+            if size >= 0 and len(data) > size:
+                stream.chunks = [data[size:]]
+                data = data[:size]
+            else:
+                stream.chunks = []
+            if stream.ended and len(stream.chunks) == 0:
+                self.streams.pop(stream.stream_id, None)
+            if len(data) > 0 and not self.closed:
+                self.connection.acknowledge_received_data(len(data), stream.stream_id)
+        finally:
+            self.lock.release()
+        if len(data) > 0:
+            self.flush()
+        return data
+
+    def reset(self, stream):
+        """ reset(stream)
+            Cancel a stream whose response will not be read.
+        """
+        self.lock.acquire()
+        try:
+            self.streams.pop(stream.stream_id, None)
+            if self.closed:
+                return
+            unread = sum([len(chunk) for chunk in stream.chunks])
+            stream.chunks = []
+            if unread > 0:
+                self.connection.acknowledge_received_data(unread, stream.stream_id)
+            if stream.ended:
+                return
+            try:
+                self.connection.reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+            except h2.exceptions.StreamClosedError:
+                return
+        finally:
+            self.lock.release()
+        self.flush()
+
+class Http2Response(object):
+    """ The response to a request made over HTTP/2, which looks enough like
+        the response returned by ``urllib2`` to be wrapped in a
+        :class:`guernsey.ClientResponse`.
+    """
+    def __init__(self, connection, stream, url, timeout, timings):
+        self.connection = connection
+        self.stream = stream
+        self.url = url
+        self.timeout = timeout
+        self.timings = timings
+        self.code = 0
+        lines = []
+        for (name, value) in stream.headers:
+            if name == ':status':
+                self.code = int(value)
+            elif not name.startswith(':'):
+                lines.append('%s: %s\r\n' % (name, value))
+        self.msg = httplib.responses.get(self.code, '')
+        self.headers = mimetools.Message(StringIO.StringIO(''.join(lines) + '\r\n'))
+
+    def read(self, size=-1):
+        if self.stream is None:
+            return ''
+        data = self.connection.read(self.stream, size, self.timeout)
+        if size < 0 or data == '':
+            self.stream = None
+        return data
+
+    def close(self):
+        if not self.stream is None:
+            self.connection.reset(self.stream)
+            self.stream = None
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+class Http2Transport(ClientFilter):
+    """ A transport for the end of the filter chain which sends requests
+        over HTTP/2, keeping one multiplexed connection for each scheme,
+        host and port. It is used by creating the client with the
+        ``transport`` configuration value set to ``http2``, or by assigning
+        an instance to the client's ``actual_client``.
+
+        The transport has to be configured with the following parameters
+        on construction.
+
+        * ``fallback`` - the transport used for ``https`` servers which do
+          not negotiate HTTP/2, if ``None`` such requests fail.
+        * ``ssl_context`` - the ``ssl.SSLContext`` used for ``https``
+          connections, which should offer ``h2`` with 
+          ``set_alpn_protocols``; default is ``ssl.create_default_context()``.
+
+        The class supports the following data members.
+
+        * ``connections`` - a dictionary of ``(scheme, host, port)`` to the
+          :class:`Http2Connection` for that server.
+        * ``connecting`` - a dictionary of ``(scheme, host, port)`` to the
+          lock held while connecting to that server.
+        * ``plain`` - the set of ``(scheme, host, port)`` for servers which
+          did not negotiate HTTP/2, whose requests go to ``fallback``.
+        * ``opened`` - the number of connections opened.
+    """
+    def __init__(self, fallback=None, ssl_context=None):
+        """ Http2Transport(fallback=None, ssl_context=None) -> Http2Transport
+
+            :raises ImportError: if the ``h2`` package is not installed.
+        """
+        if h2 is None:
+            raise ImportError('the h2 package is required for HTTP/2 support')
+        self.fallback = fallback
+        self.ssl_context = ssl_context
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.connecting = {}
+        self.plain = set()
+        self.opened = 0
+
+    def handle(self, client_request):
+        """ handle(client_request) -> ClientResponse
+            Send the request over HTTP/2, following redirects in the same
+            way as ``urllib2``. An HTTP error status is returned as a
+            response, any failure to reach the server is raised as a
+            ``urllib2.URLError``.
+        """
+        headers = {}
+        for (k, v) in client_request.resource.headers.iteritems():
+            headers[k.lower()] = v
+        for (k, v) in client_request.headers.iteritems():
+            headers[k.lower()] = v
+        for name in CONNECTION_HEADERS:
+            headers.pop(name, None)
+        (method, url, body) = (client_request.method, client_request.url, client_request.entity)
+        if not body is None:
+            length = entity_length(body)
+            if not length is None:
+                headers['content-length'] = str(length)
+        for redirect in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port or DEFAULT_PORTS.get(parts.scheme))
+            if key in self.plain:
+                return self.fallback.handle(self.fallback_request(client_request, url, method, body))
+            response = self.send(client_request, key, parts, method, url, headers.items(), body)
+            if response is None:
+                return self.fallback.handle(self.fallback_request(client_request, url, method, body))
+            location = response.info().getheader('location')
+            if not response.code in REDIRECT_STATUSES or location is None:
+                break
+            if not (method in ['GET', 'HEAD'] or (method == 'POST' and response.code != 307)):
+                break
+            response.close()
+            url = urlparse.urljoin(url, location)
+            if method == 'POST':
+                (method, body) = ('GET', None)
+                headers.pop('content-length', None)
+                headers.pop('content-type', None)
+        if response.code >= 400:
+            logger.error('The server couldn\'t fulfill the request. Status code: %d' % response.code)
+        return ClientResponse(client_request.resource, response, client_request.resource.client, client_request.stream)
+
+    def fallback_request(self, client_request, url, method, body):
+        """ fallback_request(client_request, url, method, body) -> ClientRequest
+            Return the request to send to the ``fallback`` transport, which
+            is for the current ``url``, ``method`` and ``body`` as they may
+            have been changed by following redirects.
+        """
+        if url == client_request.url and method == client_request.method and body is client_request.entity:
+            return client_request
+        request = client_request.copy()
+        (request.url, request.method, request.entity) = (url, method, body)
+        return request
+
+    def send(self, client_request, key, parts, method, url, headers, body):
+        if client_request.remaining() == 0:
+            raise DeadlineExceededError(url)
+        (connect_timeout, read_timeout) = (client_request.connect_timeout, client_request.read_timeout)
+        remaining = client_request.remaining()
+        if not remaining is None:
+            connect_timeout = min(remaining, connect_timeout or remaining)
+            read_timeout = min(remaining, read_timeout or remaining)
+        start = time.time()
+        (connection, opened) = self.connection(key, connect_timeout)
+        if connection is None:
+            return None
+        timings = {'connect': opened and time.time() - start or 0.0}
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        authority = parts.netloc.split('@')[-1]
+        start = time.time()
+        stream = connection.start_request(method, authority, path, headers, body, read_timeout)
+        try:
+            connection.lock.acquire()
+            try:
+                connection.wait(stream, lambda: not stream.headers is None, read_timeout)
+            finally:
+                connection.lock.release()
+        except urllib2.URLError:
+            # the response will never be read, so free the stream.
+            connection.reset(stream)
+            raise
+        timings['first_byte'] = time.time() - start
+        return Http2Response(connection, stream, url, read_timeout, timings)
+
+    def connection(self, key, timeout):
+        """ connection(key, timeout) -> tuple
+            Return a tuple of the open connection for a server, creating it if
+            needed, and whether it was created. The connection is ``None`` if
+            an ``https`` server did not negotiate HTTP/2. Only one connection
+            to a server is made at a time, but connecting to one server does
+            not hold up requests to any other.
+        """
+        self.lock.acquire()
+        try:
+            connection = self.connections.get(key)
+            if not connection is None and not connection.closed:
+                return (connection, False)
+            connecting = self.connecting.get(key)
+            if connecting is None:
+                connecting = threading.Lock()
+                self.connecting[key] = connecting
+        finally:
+            self.lock.release()
+        connecting.acquire()
+        try:
+            # another request may have connected while this one waited.
+            self.lock.acquire()
+            try:
+                connection = self.connections.get(key)
+                if not connection is None and not connection.closed:
+                    return (connection, False)
+                if key in self.plain:
+                    return (None, False)
+            finally:
+                self.lock.release()
+            (scheme, host, port) = key
+            try:
+                sock = socket.create_connection((host, port), timeout)
+                if scheme == 'https':
+                    context = self.ssl_context
+                    if context is None:
+                        context = ssl.create_default_context()
+                        context.set_alpn_protocols(['h2', 'http/1.1'])
+                    sock = context.wrap_socket(sock, server_hostname=host)
+                    if sock.selected_alpn_protocol() != 'h2':
+                        sock.close()
+                        if self.fallback is None:
+                            raise urllib2.URLError('%s did not negotiate HTTP/2' % host)
+                        self.lock.acquire()
+                        try:
+                            self.plain.add(key)
+                        finally:
+                            self.lock.release()
+                        return (None, False)
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except socket.error, e:
+                logger.error('We failed to reach a server. Reason: %s' % e)
+                raise urllib2.URLError(e)
+            connection = Http2Connection(key, sock)
+            self.lock.acquire()
+            try:
+                self.connections[key] = connection
+                self.opened = self.opened + 1
+            finally:
+                self.lock.release()
+            return (connection, True)
+        finally:
+            connecting.release()
+
+    def close(self):
+        """ close()
+            Close all connections held by this transport.
+        """
+        self.lock.acquire()
+        try:
+            connections = self.connections.values()
+            self.connections = {}
+        finally:
+            self.lock.release()
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,366 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import re, urllib, urlparse
+
+# The maximum number of parsed URLs kept by split_url, the cache is simply
+# emptied when it is full.
+MAX_CACHED_URLS = 1024
+
+_split_cache = {}
+
+def split_url(url, scheme=''):
+    """ split_url(url, scheme='') -> urlparse.ParseResult
+        Return the components of a URL as returned by ``urlparse.urlparse``,
+        the results are cached so that the same base URL is not parsed again
+        and again. The result is an immutable tuple and so may be shared.
+
+        :type url: string
+        :param url: the URL, absolute or relative.
+        :type scheme: string
+        :param scheme: the default scheme for a URL without one.
+        :rtype: urlparse.ParseResult
+    """
+    key = (url, scheme)
+    parts = _split_cache.get(key)
+    if parts is None:
+        if len(_split_cache) >= MAX_CACHED_URLS:
+            _split_cache.clear()
+        parts = urlparse.urlparse(url, scheme)
+        _split_cache[key] = parts
+    return parts
+
+def join_url(base, url):
+    """ join_url(base, url) -> urlparse.ParseResult
+        Resolve a URL against the already split components of a base URL,
+        in exactly the same way as ``urlparse.urljoin`` but without parsing
+        the base URL again. A network-path reference (``//host/path``)
+        takes the scheme of the base URL.
+
+        :type base: urlparse.ParseResult
+        :param base: the components of the base URL.
+        :type url: string
+        :param url: the URL to resolve, absolute or relative.
+        :rtype: urlparse.ParseResult
+    """
+    if not url:
+        return base
+    (bscheme, bnetloc, bpath, bparams, bquery, bfragment) = base
+    parts = split_url(url, bscheme)
+    (scheme, netloc, path, params, query, fragment) = parts
+    if scheme != bscheme or not scheme in urlparse.uses_relative:
+        return parts
+    if scheme in urlparse.uses_netloc:
+        if netloc:
+            return parts
+        netloc = bnetloc
+    if path[:1] == '/':
+        return urlparse.ParseResult(scheme, netloc, path, params, query, fragment)
+    if not path and not params:
+        if not query:
+            query = bquery
+        return urlparse.ParseResult(scheme, netloc, bpath, bparams, query, fragment)
+    segments = bpath.split('/')[:-1] + path.split('/')
+    if segments[-1] == '.':
+        segments[-1] = ''
+    while '.' in segments:
+        segments.remove('.')
+    while True:
+        i = 1
+        n = len(segments) - 1
+        while i < n:
+            if segments[i] == '..' and not segments[i - 1] in ('', '..'):
+                del segments[i - 1:i + 1]
+                break
+            i = i + 1
+        else:
+            break
+    if segments == ['', '..']:
+        segments[-1] = ''
+    elif len(segments) >= 2 and segments[-1] == '..':
+        segments[-2:] = ['']
+    return urlparse.ParseResult(scheme, netloc, '/'.join(segments), params, query, fragment)
+
+# The characters allowed unencoded in values by each kind of expansion,
+# in addition to letters, digits and '_.-'.
+UNRESERVED = '~'
+RESERVED = "~:/?#[]@!$&'()*+,;="
+
+# The characters which never need encoding, in each kind of expansion.
+SAFE_UNRESERVED = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.-' + UNRESERVED
+SAFE_RESERVED = SAFE_UNRESERVED + RESERVED
+
+PCT_ENCODED = re.compile('(%[0-9A-Fa-f]{2})')
+
+SCHEME = re.compile('^[A-Za-z][A-Za-z0-9+.-]*:')
+
+VARNAME = re.compile('^(?:[A-Za-z0-9_]|%[0-9A-Fa-f]{2})(?:\\.?(?:[A-Za-z0-9_]|%[0-9A-Fa-f]{2}))*$')
+
+# For each expression operator the string to start the expansion with, 
+# the separator between values, whether values are named, the string 
+# following the name of an empty value and whether reserved characters
+# are allowed (RFC 6570, appendix A).
+OPERATORS = {
+    '':  ('',  ',', False, '',  False),
+    '+': ('',  ',', False, '',  True),
+    '#': ('#', ',', False, '',  True),
+    '.': ('.', '.', False, '',  False),
+    '/': ('/', '/', False, '',  False),
+    ';': (';', ';', True,  '',  False),
+    '?': ('?', '&', True,  '=', False),
+    '&': ('&', '&', True,  '=', False)
+}
+
+def quote_unreserved(value):
+    """ quote_unreserved(value) -> string
+        Percent-encode every character of a value except the unreserved
+        characters.
+    """
+    return urllib.quote(value, UNRESERVED)
+
+def quote_reserved(value):
+    """ quote_reserved(value) -> string
+        Percent-encode every character of a value except the unreserved and
+        reserved characters, percent-encoded triplets are left as they are.
+    """
+    if not '%' in value:
+        return urllib.quote(value, RESERVED)
+    pieces = PCT_ENCODED.split(value)
+    for i in range(0, len(pieces), 2):
+        pieces[i] = urllib.quote(pieces[i], RESERVED)
+    return ''.join(pieces)
+
+def template_value(value, quote):
+    """ template_value(value, quote) -> string
+        Return a variable value as an encoded string, or ``None`` if it is
+        undefined. Lists are joined with commas, as are the keys and values
+        of dictionaries.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        if len(value) == 0:
+            return None
+        return ','.join([template_value(v, quote) for v in value])
+    if isinstance(value, dict):
+        if len(value) == 0:
+            return None
+        return ','.join([template_value(k, quote) + ',' + template_value(v, quote)
+            for (k, v) in sorted(value.items())])
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return quote(value)
+
+def legacy_expand(template, parameters):
+    """ legacy_expand(template, parameters) -> string
+        Replace each ``{key}`` in the string with the value of ``key`` in
+        the parameters, unencoded, as :py:func:`guernsey.Client.resource`
+        did before URI templates were supported. This is used for strings
+        which are not valid RFC 6570 templates, such as those with variable
+        names like ``{user-id}``.
+
+        :type template: string
+        :param template: the URL containing ``{key}`` strings.
+        :type parameters: dict
+        :param parameters: the values to substitute.
+        :rtype: string
+        :raises: KeyError if the string refers to a key which is not in 
+            ``parameters``.
+    """
+    return template.replace('{', '%(').replace('}', ')s') % parameters
+
+class UriTemplate(object):
+    """ A URI template, as defined by RFC 6570, which is compiled once and
+        may then be expanded any number of times with different variables.
+        Templates of levels 1 to 3 are supported; simple string expansion
+        (``{var}``), reserved expansion (``{+var}``), fragment expansion 
+        (``{#var}``) and expressions with multiple variables and the label
+        (``{.var}``), path segment (``{/var}``), path parameter (``{;var}``) 
+        and query (``{?var}`` and ``{&var}``) operators. Values are 
+        percent-encoded as the operator requires.
+
+        A template may be used wherever a URL is accepted by 
+        :py:func:`guernsey.Client.resource` and 
+        :py:func:`guernsey.WebResource.path`, with the parameters passed to
+        those methods as its variables. Strings given to those methods with
+        parameters are compiled, in strict mode, with :py:func:`compile`; a
+        string which is not a valid template is expanded with
+        :py:func:`legacy_expand` instead.
+
+        The class supports the following data members.
+
+        * ``template`` - the template string.
+        * ``strict`` - if ``True`` expanding the template raises 
+          ``KeyError`` for a variable which is not given, rather than 
+          treating it as undefined as RFC 6570 requires.
+        * ``variables`` - the names of the variables in the template.
+        * ``absolute`` - ``True`` if the template starts with a scheme, 
+          and so does not need to be resolved against a base URL.
+    """
+    MAX_CACHED = 1024
+
+    cache = {}
+
+    def __init__(self, template, strict=False):
+        """ UriTemplate(template, strict=False) -> UriTemplate
+
+            :type template: string
+            :param template: the template.
+            :type strict: Boolean
+            :param strict: whether a missing variable raises ``KeyError``.
+            :raises: ValueError if the template is not valid, or uses level
+                4 features (prefix or explode modifiers).
+        """
+        self.template = template
+        self.strict = strict
+        self.variables = []
+        self.segments = []
+        position = 0
+        while True:
+            start = template.find('{', position)
+            end = len(template)
+            if start >= 0:
+                end = start
+            if end > position:
+                literal = template[position:end]
+                if isinstance(literal, unicode):
+                    literal = literal.encode('utf-8')
+                if '}' in literal:
+                    raise ValueError('unmatched "}" in URI template %r' % template)
+                self.segments.append(quote_reserved(literal))
+            if start < 0:
+                break
+            end = template.find('}', start)
+            if end < 0:
+                raise ValueError('unclosed expression in URI template %r' % template)
+            self.segments.append(self.compile_expression(template[start + 1:end]))
+            position = end + 1
+        self.absolute = len(self.segments) > 0 and isinstance(self.segments[0], str) and \
+            not SCHEME.match(self.segments[0]) is None
+        self.format = None
+        self.plan = None
+        expressions = [e for e in self.segments if not isinstance(e, str)]
+        if len([e for e in expressions if e[2] or len(e[5]) > 1]) == 0:
+            # every expression is a single unnamed variable, so the whole
+            # template can be expanded with one string format.
+            self.format = ''.join([isinstance(e, str) and e.replace('%', '%%') or '%s' 
+                for e in self.segments])
+            self.plan = [(e[5][0], e[0], e[4], e[4] is quote_reserved and SAFE_RESERVED or SAFE_UNRESERVED)
+                for e in expressions]
+
+    def compile_expression(self, expression):
+        operator = expression[:1]
+        if operator in OPERATORS:
+            expression = expression[1:]
+        else:
+            if operator in '=,!@|':
+                raise ValueError('reserved operator %r in URI template %r' % (operator, self.template))
+            operator = ''
+        names = expression.split(',')
+        for name in names:
+            if name[-1:] == '*' or ':' in name:
+                raise ValueError('level 4 modifiers are not supported in URI template %r' % self.template)
+            if VARNAME.match(name) is None:
+                raise ValueError('invalid variable name %r in URI template %r' % (name, self.template))
+            self.variables.append(name)
+        (first, separator, named, empty, reserved) = OPERATORS[operator]
+        return (first, separator, named, empty, reserved and quote_reserved or quote_unreserved, names)
+
+    @classmethod
+    def compile(cls, template, strict=False):
+        """ UriTemplate.compile(template, strict=False) -> UriTemplate
+            Return a compiled template for the template string, templates
+            are cached so that the same string is only compiled once. If 
+            ``template`` is already a :class:`UriTemplate` it is returned.
+
+            :type template: string
+            :param template: the template.
+            :type strict: Boolean
+            :param strict: whether a missing variable raises ``KeyError``.
+            :rtype: :class:`UriTemplate`
+        """
+        if isinstance(template, UriTemplate):
+            return template
+        key = (template, strict)
+        compiled = cls.cache.get(key)
+        if compiled is None:
+            if len(cls.cache) >= cls.MAX_CACHED:
+                cls.cache.clear()
+            compiled = UriTemplate(template, strict)
+            cls.cache[key] = compiled
+        return compiled
+
+    def expand(self, variables=None, **kwargs):
+        """ expand(variables=None, **kwargs) -> string
+            Expand the template with the values of its variables, given as a
+            dictionary and/or keyword arguments. A value may be a string, a
+            number, a list or a dictionary; ``None``, or an empty list or 
+            dictionary, is undefined and is left out of the expansion.
+
+            :type variables: dict
+            :param variables: the values of the template variables.
+            :rtype: string
+            :raises: KeyError if the template is strict and a variable is
+                not given.
+        """
+        if variables is None:
+            variables = kwargs
+        elif len(kwargs) > 0:
+            variables = dict(variables, **kwargs)
+        if not self.plan is None:
+            values = []
+            for (name, first, quote, safe) in self.plan:
+                if name in variables:
+                    value = variables[name]
+                elif self.strict:
+                    raise KeyError(name)
+                else:
+                    value = None
+                if value.__class__ is str:
+                    if value.rstrip(safe) == '':
+                        values.append(first + value)
+                    else:
+                        values.append(first + quote(value))
+                else:
+                    value = template_value(value, quote)
+                    if value is None:
+                        values.append('')
+                    else:
+                        values.append(first + value)
+            return self.format % tuple(values)
+        result = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                result.append(segment)
+                continue
+            (first, separator, named, empty, quote, names) = segment
+            values = []
+            for name in names:
+                if name in variables:
+                    value = template_value(variables[name], quote)
+                elif self.strict:
+                    raise KeyError(name)
+                else:
+                    value = None
+                if value is None:
+                    continue
+                if not named:
+                    values.append(value)
+                elif value == '':
+                    values.append(name + empty)
+                else:
+                    values.append(name + '=' + value)
+            if len(values) > 0:
+                result.append(first + separator.join(values))
+        return ''.join(result)
+
+    def __str__(self):
+        return self.template
+
+    def __repr__(self):
+        return '<UriTemplate %r>' % self.template
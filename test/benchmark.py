@@ -0,0 +1,394 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+""" Benchmarks for the Guernsey client, run against a local :class:`StubServer`
+    so that results are reproducible and do not depend on any public service.
+
+    The benchmarks are run from the top of the source tree with::
+
+      python -m test.benchmark --output results.json
+
+    and a later run may be compared with earlier results, exiting with a
+    non-zero status if any measurement has regressed by more than the
+    tolerance::
+
+      python -m test.benchmark --baseline results.json --tolerance 0.2
+
+    The results are written as JSON, a dictionary with the ``environment``
+    the benchmarks were run in and lists of ``requests`` and ``parse``
+    results.
+"""
+
+import gc, json, optparse, platform, resource, sys, threading, time, unittest, urlparse
+
+from guernsey import Client
+from guernsey.entities import JsonReader, XmlReader
+from guernsey.filters import ContentMd5Filter, GzipContentEncodingFilter, LoggingFilter
+
+from stubserver import StubHandler, StubServer
+
+def json_payload(size):
+    """ json_payload(size) -> string
+        Return a JSON array of records of approximately ``size`` bytes.
+    """
+    record = '{"id": %d, "name": "record %d", "value": %d.5, "tags": ["a", "b"]}'
+    records = []
+    length = 2
+    i = 0
+    while length < size:
+        records.append(record % (i, i, i))
+        length = length + len(records[-1]) + 2
+        i = i + 1
+    return '[' + ', '.join(records) + ']'
+
+def xml_payload(size):
+    """ xml_payload(size) -> string
+        Return an XML document of records of approximately ``size`` bytes.
+    """
+    record = '<record id="%d"><name>record %d</name><value>%d.5</value></record>'
+    records = []
+    length = 0
+    i = 0
+    while length < size:
+        records.append(record % (i, i, i))
+        length = length + len(records[-1])
+        i = i + 1
+    return '<records>' + ''.join(records) + '</records>'
+
+PAYLOADS = {
+    'json': ('application/json', json_payload),
+    'xml': ('application/xml', xml_payload),
+    'text': ('text/plain', lambda size: 'x' * size)
+}
+
+class BenchmarkHandler(StubHandler):
+    """ A :class:`StubHandler` which buffers each response and writes it in
+        one go, so that the benchmarks do not measure the delay caused by
+        writing the status line and each header separately.
+    """
+    wbufsize = -1
+
+    def respond(self):
+        StubHandler.respond(self)
+        self.wfile.flush()
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = do_OPTIONS = respond
+
+class BenchmarkServer(StubServer):
+    """ A :class:`StubServer` which answers any path ``/<kind>`` where kind
+        is one of ``json``, ``xml`` or ``text``, with a payload whose size
+        in bytes and latency in milliseconds are given by the ``size`` and
+        ``latency`` query parameters, for example ``/json?size=4096&latency=5``.
+        Payloads are generated once for each kind and size.
+    """
+    request_queue_size = 128
+
+    def __init__(self):
+        StubServer.__init__(self)
+        self.RequestHandlerClass = BenchmarkHandler
+        self.default = self.payload
+        self.payloads = {}
+        self.payload_lock = threading.Lock()
+
+    def payload(self, handler):
+        parts = urlparse.urlparse(handler.path)
+        (path, params) = (parts.path, dict(urlparse.parse_qsl(parts.query)))
+        kind = path.strip('/') or 'text'
+        if not kind in PAYLOADS:
+            return (404, {'Content-Type': 'text/plain'}, 'unknown payload %s' % kind)
+        size = int(params.get('size', 1024))
+        latency = float(params.get('latency', 0))
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+        (content_type, generate) = PAYLOADS[kind]
+        self.payload_lock.acquire()
+        try:
+            if not (kind, size) in self.payloads:
+                self.payloads[(kind, size)] = generate(size)
+            body = self.payloads[(kind, size)]
+        finally:
+            self.payload_lock.release()
+        return (200, {'Content-Type': content_type}, body)
+
+    def start(self):
+        StubServer.start(self)
+        return self
+
+def percentile(values, percent):
+    """ percentile(values, percent) -> float
+        Return the given percentile of a sorted list of values, using the
+        nearest rank.
+    """
+    if len(values) == 0:
+        return 0.0
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+def latency_summary(latencies):
+    """ latency_summary(latencies) -> dict
+        Return the mean, 50th, 90th and 99th percentile and maximum of a
+        list of latencies, all in milliseconds.
+    """
+    latencies = sorted(latencies)
+    summary = {'mean': 0.0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+    if len(latencies) > 0:
+        summary['mean'] = sum(latencies) / len(latencies) * 1000.0
+        summary['max'] = latencies[-1] * 1000.0
+        for percent in (50, 90, 99):
+            summary['p%d' % percent] = percentile(latencies, percent) * 1000.0
+    return summary
+
+def create_client(pooled=True, filters=False):
+    """ create_client(pooled=True, filters=False) -> Client
+        Create a client, with or without connection pooling and with or
+        without the standard filters added.
+    """
+    config = {}
+    if not pooled:
+        config['max_connections_per_host'] = 0
+    client = Client.create(config)
+    if filters:
+        client.add_filter(LoggingFilter('GuernseyBenchmark'))
+        client.add_filter(ContentMd5Filter())
+        client.add_filter(GzipContentEncodingFilter())
+    return client
+
+def run_requests(name, server, kind='json', size=4096, latency=0, requests=200, threads=1,
+                 pooled=True, filters=False, parse=True):
+    """ run_requests(name, server, ...) -> dict
+        Make ``requests`` GET requests for a payload, spread over ``threads``
+        threads all sharing one client, and return the throughput and
+        latency of the requests.
+    """
+    client = create_client(pooled, filters)
+    target = client.resource(server.url('/%s?size=%d&latency=%s' % (kind, size, latency)))
+    target.get()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    def worker(count):
+        mine = []
+        try:
+            for i in range(count):
+                start = time.time()
+                response = target.get()
+                if parse:
+                    response.parsed_entity
+                mine.append(time.time() - start)
+        except Exception, e:
+            errors.append(e)
+        lock.acquire()
+        latencies.extend(mine)
+        lock.release()
+    counts = [requests // threads + (i < requests % threads and 1 or 0) for i in range(threads)]
+    workers = [threading.Thread(target=worker, args=(count,)) for count in counts]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    client.close()
+    if len(errors) > 0:
+        raise errors[0]
+    return {
+        'name': name,
+        'kind': kind, 'size': size, 'latency': latency, 'threads': threads,
+        'pooled': pooled, 'filters': filters, 'parse': parse,
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'latency_ms': latency_summary(latencies)
+    }
+
+def run_memory(name, server, kind='json', size=4096, requests=200):
+    """ run_memory(name, server, ...) -> dict
+        Make ``requests`` GET requests keeping every response alive and
+        return the number of objects, and bytes of maximum resident memory,
+        retained for each response.
+    """
+    client = create_client()
+    target = client.resource(server.url('/%s?size=%d' % (kind, size)))
+    target.get()
+    gc.collect()
+    objects = len(gc.get_objects())
+    rss = resource_rss()
+    responses = []
+    for i in range(requests):
+        response = target.get()
+        response.parsed_entity
+        responses.append(response)
+    gc.collect()
+    result = {
+        'name': name, 'kind': kind, 'size': size,
+        'requests': requests,
+        'objects_per_request': (len(gc.get_objects()) - objects) / float(requests),
+        'rss_bytes_per_request': (resource_rss() - rss) / float(requests)
+    }
+    del responses
+    client.close()
+    return result
+
+def resource_rss():
+    """ resource_rss() -> int
+        Return the maximum resident memory of this process in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+def run_parse(name, reader, type, data, iterations=20):
+    """ run_parse(name, reader, type, data, iterations=20) -> dict
+        Parse ``data`` with an entity reader ``iterations`` times and return
+        the throughput in megabytes per second.
+    """
+    reader.read(data, type)
+    start = time.time()
+    for i in range(iterations):
+        reader.read(data, type)
+    elapsed = time.time() - start
+    return {
+        'name': name, 'reader': reader.__class__.__name__, 'type': type,
+        'size': len(data), 'iterations': iterations,
+        'seconds': elapsed,
+        'mb_per_second': len(data) * iterations / elapsed / (1024.0 * 1024.0)
+    }
+
+def run_all(scale=1.0):
+    """ run_all(scale=1.0) -> dict
+        Run all the benchmarks and return the results, ``scale`` multiplies
+        the number of requests and iterations of each benchmark.
+    """
+    def count(n):
+        return max(1, int(n * scale))
+    server = BenchmarkServer().start()
+    try:
+        requests = []
+        for filters in (False, True):
+            suffix = filters and '-filters' or ''
+            requests.append(run_requests('sequential' + suffix, server,
+                requests=count(500), filters=filters))
+            requests.append(run_requests('threaded' + suffix, server,
+                requests=count(500), threads=8, pooled=False, filters=filters))
+            requests.append(run_requests('pooled' + suffix, server,
+                requests=count(500), threads=8, filters=filters))
+        requests.append(run_requests('pooled-latency', server,
+            latency=10, requests=count(200), threads=8))
+        requests.append(run_requests('sequential-large', server,
+            size=1024 * 1024, requests=count(20)))
+        requests.append(run_requests('sequential-xml', server,
+            kind='xml', requests=count(500)))
+        requests.append(run_requests('sequential-text', server,
+            kind='text', requests=count(500), parse=False))
+        memory = [run_memory('memory-json', server, requests=count(500))]
+    finally:
+        server.stop()
+    parse = []
+    for size in (1024, 64 * 1024, 1024 * 1024):
+        parse.append(run_parse('json-%d' % size, JsonReader(), 'application/json',
+            json_payload(size), count(max(5, 2 * 1024 * 1024 // size))))
+        parse.append(run_parse('xml-%d' % size, XmlReader(), 'application/xml',
+            xml_payload(size), count(max(5, 2 * 1024 * 1024 // size))))
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'json_backend': JsonReader.backend.name,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        },
+        'requests': requests,
+        'memory': memory,
+        'parse': parse
+    }
+
+# The measurements compared against a baseline, and whether a larger
+# value is better.
+MEASUREMENTS = {
+    'requests': [('requests_per_second', True), ('latency_ms.p50', False), ('latency_ms.p99', False)],
+    'memory': [('objects_per_request', False)],
+    'parse': [('mb_per_second', True)]
+}
+
+def measurement(result, path):
+    for name in path.split('.'):
+        result = result[name]
+    return result
+
+def compare(results, baseline, tolerance=0.1):
+    """ compare(results, baseline, tolerance=0.1) -> list
+        Compare results with an earlier baseline and return a list of
+        ``(section, name, measurement, baseline, result)`` tuples for each
+        measurement which is worse by more than ``tolerance`` (a fraction
+        of the baseline value).
+    """
+    regressions = []
+    for (section, measurements) in MEASUREMENTS.items():
+        earlier = dict([(r['name'], r) for r in baseline.get(section, [])])
+        for result in results.get(section, []):
+            if not result['name'] in earlier:
+                continue
+            for (path, larger_is_better) in measurements:
+                (then, now) = (measurement(earlier[result['name']], path), measurement(result, path))
+                if larger_is_better:
+                    worse = now < then * (1.0 - tolerance)
+                else:
+                    worse = now > then * (1.0 + tolerance)
+                if worse:
+                    regressions.append((section, result['name'], path, then, now))
+    return regressions
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='python -m test.benchmark [options]')
+    parser.add_option('-o', '--output', dest='output',
+        help='write the results as JSON to FILE rather than standard output', metavar='FILE')
+    parser.add_option('-b', '--baseline', dest='baseline',
+        help='compare the results with an earlier results FILE', metavar='FILE')
+    parser.add_option('-t', '--tolerance', dest='tolerance', type='float', default=0.1,
+        help='the fraction by which a measurement may be worse than the baseline')
+    parser.add_option('-s', '--scale', dest='scale', type='float', default=1.0,
+        help='multiply the number of requests and iterations by SCALE')
+    (options, args) = parser.parse_args(args)
+    results = run_all(options.scale)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output is None:
+        print text
+    else:
+        output = open(options.output, 'w')
+        output.write(text)
+        output.close()
+    if not options.baseline is None:
+        baseline = json.load(open(options.baseline))
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            sys.stderr.write('%s %s %s regressed from %.3f to %.3f\n' % regression)
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+class TestBenchmark(unittest.TestCase):
+
+    def testSmallRun(self):
+        results = run_all(0.01)
+        self.assertEquals(10, len(results['requests']))
+        for result in results['requests']:
+            self.assertTrue(result['requests_per_second'] > 0)
+            self.assertTrue(result['latency_ms']['p99'] >= result['latency_ms']['p50'])
+        self.assertEquals(6, len(results['parse']))
+        self.assertEquals(results, json.loads(json.dumps(results)))
+
+    def testCompare(self):
+        baseline = {'requests': [{'name': 'a', 'requests_per_second': 100.0,
+            'latency_ms': {'p50': 1.0, 'p99': 2.0}}]}
+        results = {'requests': [{'name': 'a', 'requests_per_second': 80.0,
+            'latency_ms': {'p50': 1.05, 'p99': 2.0}}]}
+        self.assertEquals([('requests', 'a', 'requests_per_second', 100.0, 80.0)],
+            compare(results, baseline, 0.1))
+        self.assertEquals([], compare(results, baseline, 0.25))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import logging, shutil, tempfile, unittest
+
+from guernsey import Client
+from guernsey.cache import *
+from guernsey.entities import JsonReader
+from guernsey.filters import CacheFilter
+
+from stubserver import StubServer
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class TestCacheFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/fresh': (200, {'Content-Type': 'application/json', 'Cache-Control': 'max-age=60'}, '{"fresh": 1}'),
+            '/etag': self.etag,
+            '/nostore': (200, {'Content-Type': 'text/plain', 'Cache-Control': 'no-store', 'ETag': '"x"'}, 'none'),
+            '/changed': self.changed
+        }).start()
+        self.versions = [(200, {'Content-Type': 'text/plain', 'ETag': '"v1"'}, 'one'),
+            (200, {'Content-Type': 'text/plain', 'Cache-Control': 'no-store'}, 'two')]
+        self.client = Client.create()
+        self.filter = CacheFilter()
+        self.client.add_filter(self.filter)
+
+    def etag(self, handler):
+        if handler.headers.get('if-none-match') == '"v1"':
+            return (304, {'ETag': '"v1"'}, '')
+        return (200, {'Content-Type': 'application/json', 'ETag': '"v1"'}, '{"etag": 1}')
+
+    def changed(self, handler):
+        if len(self.versions) > 0:
+            return self.versions.pop(0)
+        if handler.headers.get('if-none-match') == '"v1"':
+            return (304, {'ETag': '"v1"'}, '')
+        return (200, {'Content-Type': 'text/plain'}, 'three')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testFreshHit(self):
+        resource = self.client.resource(self.server.url('/fresh'))
+        first = resource.get()
+        second = resource.get()
+        self.assertEquals(1, len(self.server.requests))
+        self.assertEquals(200, second.status)
+        self.assertEquals({'fresh': 1}, second.parsed_entity)
+        self.assertEquals('max-age=60', second.headers['cache-control'])
+        self.assertEquals(1, self.filter.hits)
+
+    def testRevalidation(self):
+        resource = self.client.resource(self.server.url('/etag'))
+        resource.get()
+        response = resource.get()
+        self.assertEquals(2, len(self.server.requests))
+        self.assertEquals('"v1"', self.server.requests[1][2]['if-none-match'])
+        self.assertEquals(200, response.status)
+        self.assertEquals({'etag': 1}, response.parsed_entity)
+        self.assertEquals(1, self.filter.revalidated)
+        self.assertFalse('If-None-Match' in resource.headers)
+
+    def testRevalidationNotLogged(self):
+        handler = RecordingHandler()
+        logger = logging.getLogger('guernsey')
+        logger.addHandler(handler)
+        try:
+            resource = self.client.resource(self.server.url('/etag'))
+            resource.get()
+            self.assertEquals(200, resource.get().status)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEquals(1, self.filter.revalidated)
+        self.assertEquals([], handler.records)
+
+    def testReplacedByNoStore(self):
+        resource = self.client.resource(self.server.url('/changed'))
+        self.assertEquals('one', resource.get().entity)
+        self.assertEquals('two', resource.get().entity)
+        self.assertEquals(0, len(self.filter.cache))
+        self.assertEquals('three', resource.get().entity)
+        self.assertFalse('if-none-match' in self.server.requests[2][2])
+
+    def testNoStore(self):
+        resource = self.client.resource(self.server.url('/nostore'))
+        resource.get()
+        resource.get()
+        self.assertEquals(2, len(self.server.requests))
+        self.assertEquals(0, len(self.filter.cache))
+
+    def testInvalidation(self):
+        resource = self.client.resource(self.server.url('/fresh'))
+        resource.get()
+        resource.put('{}')
+        resource.get()
+        self.assertEquals(3, len(self.server.requests))
+
+    def testRequestNoCache(self):
+        resource = self.client.resource(self.server.url('/fresh'))
+        resource.get()
+        resource.add_header('Cache-Control', 'no-cache').get()
+        self.assertEquals(2, len(self.server.requests))
+
+class TestCacheStores(unittest.TestCase):
+
+    def testParseCacheControl(self):
+        self.assertEquals({'max-age': '60', 'no-cache': True}, parse_cache_control('max-age=60, no-cache'))
+        self.assertEquals({}, parse_cache_control(None))
+
+    def testFreshness(self):
+        entry = CacheEntry('http://example.com/', 200, 'OK', {
+            'date': 'Sun, 06 Nov 1994 08:49:37 GMT',
+            'expires': 'Sun, 06 Nov 1994 08:50:37 GMT'}, '')
+        self.assertTrue(entry.is_fresh())
+        self.assertFalse(entry.is_fresh(entry.expires + 1))
+        entry = CacheEntry('http://example.com/', 200, 'OK', {'cache-control': 'no-cache, max-age=60'}, '')
+        self.assertFalse(entry.is_fresh())
+
+    def testMemoryCacheEviction(self):
+        cache = MemoryCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEquals(1, cache.get('a'))
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals(2, len(cache))
+
+    def testDiskCache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = DiskCache(directory, 2)
+            entry = CacheEntry('http://example.com/', 200, 'OK', {'etag': '"1"'}, 'data')
+            cache.put('http://example.com/', entry)
+            self.assertEquals('data', cache.get('http://example.com/').entity)
+            cache.put('http://example.com/2', entry)
+            cache.put('http://example.com/3', entry)
+            self.assertEquals(2, len(cache))
+            cache.remove('http://example.com/3')
+            self.assertEquals(None, cache.get('http://example.com/3'))
+            cache.clear()
+            self.assertEquals(0, len(cache))
+        finally:
+            shutil.rmtree(directory)
+
+class CountingJsonReader(JsonReader):
+
+    def __init__(self):
+        JsonReader.__init__(self)
+        self.reads = 0
+
+    def read(self, raw_entity, content_type):
+        self.reads = self.reads + 1
+        return JsonReader.read(self, raw_entity, content_type)
+
+class TestParsedEntityCache(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/etag': (200, {'Content-Type': 'application/json', 'ETag': '"v1"'}, '{"a": [1, 2]}'),
+            '/plain': (200, {'Content-Type': 'application/json'}, '{"b": 2}')
+        }).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testEntityTagKey(self):
+        client = Client.create({'entity_cache_size': 1024, 'entity_cache_copy': True})
+        resource = client.resource(self.server.url('/etag'))
+        first = resource.get().parsed_entity
+        first['a'].append(3)
+        second = resource.get().parsed_entity
+        self.assertEquals({'a': [1, 2]}, second)
+        self.assertEquals(1, client.entity_cache.hits)
+        self.assertEquals(1, client.entity_cache.misses)
+
+    def testContentHashKey(self):
+        client = Client.create({'entity_cache_size': 1024})
+        resource = client.resource(self.server.url('/plain'))
+        first = resource.get().parsed_entity
+        second = resource.get().parsed_entity
+        self.assertTrue(first is second)
+
+    def testHitSkipsParseAndCopy(self):
+        reader = CountingJsonReader()
+        client = Client.create({'entity_cache_size': 1024})
+        client.entity_classes.register(reader, first=True)
+        resource = client.resource(self.server.url('/plain'))
+        entities = [resource.get().parsed_entity for i in range(5)]
+        self.assertEquals(1, reader.reads)
+        self.assertEquals(4, client.entity_cache.hits)
+        # a hit neither parses nor copies, it returns the stored object
+        for entity in entities:
+            self.assertTrue(entity is entities[0])
+
+    def testMemoryLimit(self):
+        cache = ParsedEntityCache(10)
+        cache.put('a', 6, 'A')
+        cache.put('b', 6, 'B')
+        cache.put('c', 20, 'C')
+        self.assertEquals((False, None), cache.get('a'))
+        self.assertEquals((True, 'B'), cache.get('b'))
+        self.assertEquals((False, None), cache.get('c'))
+        self.assertEquals(6, cache.size)
@@ -0,0 +1,190 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import socket, time, unittest, urllib2
+
+from guernsey import Client, ClientFilter, ClientRequest
+from guernsey.connections import ConnectionPool, DeadlineExceededError, TimeoutRedirectHandler
+from guernsey.filters import RetryFilter
+
+from stubserver import StubServer
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/data': (200, {'Content-Type': 'text/plain'}, 'some data'),
+            '/close': (200, {'Content-Type': 'text/plain', 'Connection': 'close'}, 'closing'),
+            '/drop': self.drop,
+            '/reset': self.reset
+        }).start()
+
+    def drop(self, handler):
+        # close the connection without telling the client.
+        handler.close_connection = 1
+        return (200, {'Content-Type': 'text/plain'}, 'dropped')
+
+    def reset(self, handler):
+        # act on the request, then close the connection without a response.
+        handler.connection.shutdown(socket.SHUT_RDWR)
+        raise socket.error('connection reset')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testConnectionReuse(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/data'))
+        for i in range(5):
+            response = resource.get()
+            self.assertEquals(200, response.status)
+            self.assertEquals('some data', response.entity)
+        self.assertEquals(1, self.server.connections)
+        self.assertEquals(1, client.connection_pool.size())
+
+    def testServerClose(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/close'))
+        resource.get()
+        resource.get()
+        self.assertEquals(2, self.server.connections)
+        self.assertEquals(0, client.connection_pool.size())
+
+    def testIdleTimeout(self):
+        client = Client.create({'connection_idle_timeout': 0.1})
+        resource = client.resource(self.server.url('/data'))
+        resource.get()
+        time.sleep(0.2)
+        resource.get()
+        self.assertEquals(2, self.server.connections)
+
+    def testStaleConnection(self):
+        client = Client.create()
+        client.resource(self.server.url('/drop')).get()
+        self.assertEquals(1, client.connection_pool.size())
+        time.sleep(0.1)
+        response = client.resource(self.server.url('/data')).get()
+        self.assertEquals('some data', response.entity)
+        self.assertEquals(2, self.server.connections)
+
+    def testStalePostNotResent(self):
+        client = Client.create()
+        client.resource(self.server.url('/data')).get()
+        self.assertRaises(urllib2.URLError, client.resource(self.server.url('/reset')).post, 'data')
+        self.assertEquals(1, len([r for r in self.server.requests if r[0] == 'POST']))
+        client.resource(self.server.url('/data')).get()
+        self.assertEquals(['GET', 'POST', 'GET'], [r[0] for r in self.server.requests])
+
+    def testMaxPerHost(self):
+        pool = ConnectionPool(max_per_host=1)
+        key = pool.key('http', 'Example.com')
+        self.assertEquals(('http', 'example.com', 80), key)
+
+        class FakeConnection(object):
+            closed = False
+            def close(self):
+                self.closed = True
+        first = FakeConnection()
+        second = FakeConnection()
+        pool.release(key, first)
+        pool.release(key, second)
+        self.assertEquals(1, pool.size(key))
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        pool.close()
+        self.assertTrue(first.closed)
+        self.assertEquals(0, pool.size())
+
+class TestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/slow': self.slow,
+            '/fast': (200, {'Content-Type': 'text/plain'}, 'fast'),
+            '/redirect': (302, {'Location': '/slow'}, ''),
+            '/unavailable': (503, {'Content-Type': 'text/plain'}, '')
+        }).start()
+
+    def slow(self, handler):
+        time.sleep(0.5)
+        return (200, {'Content-Type': 'text/plain'}, 'slow')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def assertTimesOut(self, function, limit=0.4):
+        start = time.time()
+        self.assertRaises(urllib2.URLError, function)
+        self.assertTrue(time.time() - start < limit)
+
+    def testReadTimeout(self):
+        client = Client.create({'read_timeout': 0.1})
+        resource = client.resource(self.server.url('/slow'))
+        self.assertTimesOut(resource.get)
+        self.assertEquals('slow', resource.get(timeout=2).entity)
+        resource.timeout(connect=1, read=2)
+        self.assertEquals('slow', resource.get().entity)
+        self.assertTimesOut(lambda: resource.get(timeout=(1, 0.1)))
+
+    def testConnectTimeoutOnly(self):
+        client = Client.create({'connect_timeout': 0.2})
+        self.assertEquals('slow', client.resource(self.server.url('/slow')).get().entity)
+
+    def testReusedConnectionTimeout(self):
+        client = Client.create()
+        self.assertEquals('fast', client.resource(self.server.url('/fast')).get(timeout=0.2).entity)
+        self.assertEquals('slow', client.resource(self.server.url('/slow')).get().entity)
+        self.assertEquals(1, self.server.connections)
+
+    def testDeadline(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/slow')).deadline(0.2)
+        self.assertTimesOut(resource.get)
+        resource = client.resource(self.server.url('/redirect')).deadline(0.2)
+        self.assertTimesOut(resource.get)
+        resource = client.resource(self.server.url('/fast')).deadline(0)
+        self.assertRaises(DeadlineExceededError, resource.get)
+        self.assertEquals(['/slow', '/redirect', '/slow'], [r[1] for r in self.server.requests])
+
+    def testDeadlineLimitsRetries(self):
+        client = Client.create({'deadline': 0.3})
+        retry = RetryFilter(backoff=0.2, jitter=False)
+        client.add_filter(retry)
+        start = time.time()
+        response = client.resource(self.server.url('/unavailable')).get()
+        self.assertEquals(503, response.status)
+        self.assertEquals(1, retry.retries)
+        self.assertTrue(time.time() - start < 0.3)
+
+    def testCancel(self):
+        requests = []
+        class CapturingFilter(ClientFilter):
+            def handle(self, client_request):
+                requests.append(client_request)
+                return client_request.next_filter(self).handle(client_request)
+        client = Client.create()
+        client.add_filter(CapturingFilter())
+        resource = client.resource(self.server.url('/slow'))
+        future = resource.get_async()
+        time.sleep(0.1)
+        requests[0].cancel()
+        self.assertTrue(isinstance(future.exception(0.3), urllib2.URLError))
+        self.assertEquals(1, len(self.server.requests))
+
+    def testRemaining(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/fast'))
+        self.assertEquals(None, ClientRequest(resource, 'GET').remaining())
+        remaining = ClientRequest(resource.deadline(10), 'GET').remaining()
+        self.assertTrue(9 < remaining <= 10)
+
+    def testRedirectCarriesTimeouts(self):
+        request = urllib2.Request(self.server.url('/redirect'))
+        request.connect_timeout = 1
+        request.read_timeout = 2
+        request.deadline = 3
+        new = TimeoutRedirectHandler().redirect_request(request, None, 302, 'Found', {}, self.server.url('/fast'))
+        self.assertEquals((1, 2, 3), (new.connect_timeout, new.read_timeout, new.deadline))
@@ -4,13 +4,15 @@
 # See LICENSE.txt included in this distribution or more details.
 #
 
-import logging, StringIO, unittest
+import collections, logging, StringIO, unittest
 
 from xml.etree.ElementTree import _ElementInterface, Element, ElementTree
 
 from guernsey import Client
 from guernsey.entities import *
 
+from stubserver import StubServer
+
 class TestBuiltinEntityClasses(unittest.TestCase):
 
     def testJsonReaderLive(self):
@@ -107,3 +109,176 @@ class TestBuiltinEntityClasses(unittest.TestCase):
         root = Element('Head', {'title': 'My XML'})
         test.write(root, 'application/xml', file)
         self.assertEquals('<Head title="My XML" />', file.getvalue())
+
+class TestJsonBackends(unittest.TestCase):
+
+    def testSelection(self):
+        self.assertEquals('json', select_json_backend(['json', 'ujson']).name)
+        self.assertTrue(select_json_backend(['ujson', 'json']).name in ['ujson', 'json'])
+        self.assertRaises(ValueError, load_json_backend, 'nothere')
+        self.assertRaises(ValueError, select_json_backend, ['nothere'])
+        self.assertFalse(default_json_backend is None)
+
+    def testSameResults(self):
+        stdlib = load_json_backend('json')
+        data = '{"a": [1, 2.5, 1e100, "text", "\\u00e9"], "b": {"c": null, "d": true}}'
+        for backend in [select_json_backend([name]) for (name, factory) in JSON_BACKENDS]:
+            if backend is None:
+                continue
+            self.assertEquals(repr(stdlib.loads(data)), repr(backend.loads(data)))
+            self.assertEquals(stdlib.dumps(stdlib.loads(data)), backend.dumps(backend.loads(data)))
+
+    def testSameEncoding(self):
+        Point = collections.namedtuple('Point', ['x', 'y'])
+        stdlib = load_json_backend('json')
+        data = {'point': Point(1, 2), 'pair': (u'\u00e9', 2.5), 'list': [Point(3, None), True]}
+        for backend in [select_json_backend([name]) for (name, factory) in JSON_BACKENDS]:
+            if backend is None:
+                continue
+            self.assertEquals(stdlib.dumps(data), backend.dumps(data))
+
+    def installed_backend(self, name):
+        try:
+            return load_json_backend(name)
+        except ImportError:
+            self.skipTest('the %s JSON backend is not installed' % name)
+
+    def testUjsonLargeIntegers(self):
+        backend = self.installed_backend('ujson')
+        data = '[18446744073709551616, -9223372036854775809, 1]'
+        self.assertEquals([18446744073709551616L, -9223372036854775809L, 1], backend.loads(data))
+        self.assertRaises(ValueError, backend.loads, '[1,')
+
+    def testSimplejsonTuples(self):
+        backend = self.installed_backend('simplejson')
+        Point = collections.namedtuple('Point', ['x', 'y'])
+        self.assertEquals('[[1, 2], [3, 4]]', backend.dumps((Point(1, 2), (3, 4))))
+        self.assertEquals('{"x": 1, "y": 2}', backend.dumps(Point(1, 2), namedtuple_as_object=True))
+
+    def testClientConfig(self):
+        client = Client.create({'json_backend': 'json'})
+        reader = client.entity_classes.reader_for('application/json')
+        self.assertEquals('json', reader.backend.name)
+        writer = client.entity_classes.writers_for('application/json')[0]
+        self.assertEquals('json', writer.backend.name)
+        self.assertRaises(ValueError, Client.create, {'json_backend': 'nothere'})
+
+class HalReader(EntityReader):
+    media_types = ['application/hal+json']
+
+    def read(self, entity, content_type):
+        return 'hal'
+
+class TextReader(EntityReader):
+
+    def __init__(self):
+        self.count = 0
+
+    def is_readable(self, content_type):
+        self.count = self.count + 1
+        return content_type.startswith('text/plain')
+
+class VendorReader(JsonReader):
+
+    def is_readable(self, content_type):
+        return content_type.startswith('application/vnd.example+json')
+
+class TestEntityRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.json = JsonReader()
+        self.xml = XmlReader()
+        self.registry = EntityRegistry([self.json, JsonWriter(), self.xml, XmlWriter()])
+
+    def testMediaTypeKeys(self):
+        self.assertEquals(('application', 'hal+json', 'json'), parse_media_type('Application/HAL+JSON; charset=utf-8'))
+        self.assertEquals(['application/hal+json', '*/hal+json', '*/*+json', 'application/*', '*/*'],
+            media_type_keys('application/hal+json'))
+
+    def testReaderLookup(self):
+        self.assertTrue(self.registry.reader_for('application/json') is self.json)
+        self.assertTrue(self.registry.reader_for('text/json; charset=utf-8') is self.json)
+        self.assertTrue(self.registry.reader_for('application/hal+json') is self.json)
+        self.assertTrue(self.registry.reader_for('application/atom+xml') is self.xml)
+        self.assertTrue(self.registry.reader_for('text/html') is None)
+        self.registry.reader_for('application/json')
+        self.assertEquals(5, len(self.registry.resolved))
+
+    def testSpecificTypeWins(self):
+        hal = HalReader()
+        self.registry.register(hal)
+        self.assertTrue(self.registry.reader_for('application/hal+json') is hal)
+        self.assertTrue(self.registry.reader_for('application/json') is self.json)
+
+    def testMutationInvalidates(self):
+        self.assertTrue(self.registry.reader_for('application/json') is self.json)
+        self.registry.remove(self.json)
+        self.assertTrue(self.registry.reader_for('application/json') is None)
+        self.registry[0:0] = [self.json]
+        self.assertTrue(self.registry.reader_for('application/json') is self.json)
+
+    def testLegacyReaderCached(self):
+        text = TextReader()
+        self.registry.append(text)
+        self.assertTrue(self.registry.reader_for('text/plain') is text)
+        self.assertTrue(self.registry.reader_for('text/plain') is text)
+        self.assertTrue(self.registry.reader_for('application/json') is self.json)
+        self.assertEquals(2, text.count)
+
+    def testOverriddenIsReadable(self):
+        vendor = VendorReader()
+        self.registry.register(vendor, first=True)
+        self.assertTrue(self.registry.reader_for('application/vnd.example+json') is vendor)
+        self.assertTrue(self.registry.reader_for('application/json') is self.json)
+        self.assertFalse(declares_media_types(vendor, 'is_readable'))
+        self.assertTrue(declares_media_types(self.json, 'is_readable'))
+        self.assertTrue(declares_media_types(JsonStreamReader(), 'is_readable'))
+
+    def testWritersForType(self):
+        writers = self.registry.writers_for('application/atom+xml')
+        self.assertEquals([XmlWriter], [w.__class__ for w in writers])
+
+    def testClientAssignment(self):
+        client = Client.create()
+        client.entity_classes = [self.json]
+        self.assertTrue(isinstance(client.entity_classes, EntityRegistry))
+        self.assertTrue(client.entity_classes.reader_for('application/json') is self.json)
+
+class CountingReader(JsonReader):
+
+    def __init__(self):
+        self.count = 0
+
+    def read(self, entity, content_type):
+        self.count = self.count + 1
+        return JsonReader.read(self, entity, content_type)
+
+class TestLazyParsing(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/json': (200, {'Content-Type': 'application/json'}, '{"a": 1}'),
+            '/bad': (200, {'Content-Type': 'application/json'}, '{"a": ')
+        }).start()
+        self.client = Client.create()
+        self.reader = CountingReader()
+        self.client.entity_classes.insert(0, self.reader)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testNotParsedUntilAccessed(self):
+        response = self.client.resource(self.server.url('/json')).get()
+        self.assertEquals(200, response.status)
+        self.assertEquals('{"a": 1}', response.entity)
+        self.assertEquals(0, self.reader.count)
+        self.assertEquals({'a': 1}, response.parsed_entity)
+        self.assertEquals({'a': 1}, response.parsed_entity)
+        self.assertEquals(1, self.reader.count)
+
+    def testParseErrorRaisedOnAccess(self):
+        response = self.client.resource(self.server.url('/bad')).get()
+        self.assertEquals(200, response.status)
+        self.assertRaises(ValueError, lambda: response.parsed_entity)
+        self.assertRaises(ValueError, lambda: response.parsed_entity)
+        self.assertEquals(2, self.reader.count)
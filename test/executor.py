@@ -0,0 +1,118 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import threading, time, unittest, urllib2
+
+from guernsey import Client
+from guernsey.executor import RequestExecutor
+from guernsey.filters import LoggingFilter
+
+from stubserver import StubServer
+
+class TestAsyncRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/slow': self.slow,
+            '/echo': lambda h: (201, {'Content-Type': 'text/plain'}, h.body)
+        }).start()
+
+    def slow(self, handler):
+        time.sleep(0.2)
+        return (200, {'Content-Type': 'application/json'}, '{"slow": true}')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testConcurrentGets(self):
+        client = Client.create({'max_workers': 10})
+        resource = client.resource(self.server.url('/slow'))
+        start = time.time()
+        futures = [resource.get_async() for i in range(10)]
+        responses = [f.result(5) for f in futures]
+        self.assertTrue(time.time() - start < 1.5)
+        for response in responses:
+            self.assertEquals(200, response.status)
+            self.assertEquals({'slow': True}, response.parsed_entity)
+
+    def testPostWithCallback(self):
+        client = Client.create()
+        client.add_filter(LoggingFilter('TestAsyncLogging'))
+        event = threading.Event()
+        completed = []
+        def callback(future):
+            completed.append(future.result().entity)
+            event.set()
+        future = client.resource(self.server.url('/echo')).post_async('hello', callback)
+        self.assertEquals(201, future.result(5).status)
+        event.wait(5)
+        self.assertEquals(['hello'], completed)
+
+    def testStreamAndTimeout(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/slow'))
+        response = resource.get_async(stream=True).result(5)
+        self.assertFalse(response.body is None)
+        self.assertEquals('{"slow": true}', ''.join(response.iter_content()))
+        self.assertTrue(isinstance(resource.get_async(timeout=0.05).exception(5), urllib2.URLError))
+        self.assertEquals(201, client.resource(self.server.url('/echo')).post_async('data', timeout=(1, 2)).result(5).status)
+
+    def testException(self):
+        executor = RequestExecutor(2)
+        def fail():
+            raise ValueError('failed')
+        future = executor.submit(fail)
+        self.assertTrue(isinstance(future.exception(5), ValueError))
+        self.assertRaises(ValueError, future.result)
+        executor.shutdown()
+        self.assertRaises(RuntimeError, executor.submit, fail)
+
+class TestBatchExecution(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/echo': lambda h: (200, {'Content-Type': 'text/plain'}, h.command + ' ' + h.body)
+        }).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testOrderedResults(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/echo'))
+        requests = [(resource, 'GET'), (resource, 'PUT', 'one'), (resource, 'POST', 'two'),
+                    (client.resource('http://127.0.0.1:1/'), 'GET')]
+        results = client.execute_all(requests, max_workers=2)
+        self.assertEquals([0, 1, 2, 3], [r.index for r in results])
+        self.assertEquals('GET ', results[0].response.entity)
+        self.assertEquals('PUT one', results[1].response.entity)
+        self.assertEquals('POST two', results[2].response.entity)
+        self.assertTrue(results[0].succeeded())
+        self.assertFalse(results[3].succeeded())
+        self.assertTrue(results[3].response is None)
+        self.assertTrue(resource.req_entity is None)
+
+    def testAsCompleted(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/echo'))
+        results = list(client.execute_all([(resource, 'GET')] * 20, ordered=False))
+        self.assertEquals(range(20), sorted([r.index for r in results]))
+        self.assertEquals(20, len([r for r in results if r.response.status == 200]))
+
+    def testBreakOutEarly(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/echo'))
+        before = set(threading.enumerate())
+        results = client.execute_all([(resource, 'GET')] * 10, max_workers=3, ordered=False)
+        for result in results:
+            break
+        # results is still referenced, so cannot be what stops the workers
+        workers = [t for t in threading.enumerate() if not t in before and t.name.startswith('guernsey-worker')]
+        self.assertTrue(len(workers) > 0)
+        for worker in workers:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+        self.assertFalse(results is None)
@@ -4,11 +4,13 @@
 # See LICENSE.txt included in this distribution or more details.
 #
 
-import logging, StringIO, unittest
+import logging, StringIO, threading, time, unittest, urllib2
 
-from guernsey import Client
+from guernsey import Client, ClientFilter, FilterProfiler, connections
 from guernsey.filters import *
 
+from stubserver import StubServer
+
 stream = StringIO.StringIO()
 FORMAT = '%(asctime)-15s %(levelname)s %(thread)d %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.DEBUG, stream=stream)
@@ -20,7 +22,7 @@ class TestBuiltinFilters(unittest.TestCase):
         namespaces = client.resource('http://www.amazon.com')
         namespaces.add_filter(GzipContentEncodingFilter())
         response = namespaces.accept('*/*').get()
-        self.assertEquals('gzip', namespaces.headers.get('accept-encoding', ''))
+        self.assertEquals('', namespaces.headers.get('accept-encoding', ''))
         self.assertEquals('gzip', response.headers.get('content-encoding', ''))
         self.assertTrue(response.entity.find('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"') > 0)
 
@@ -32,3 +34,399 @@ class TestBuiltinFilters(unittest.TestCase):
         log_text = stream.getvalue()
         self.assertTrue(log_text.find('GET http://www.thomas-bayer.com/sqlrest/') > 0)
         self.assertTrue(log_text.find('http://www.thomas-bayer.com/sqlrest/ 200 OK') > 0)
+
+class CountingFilter(ClientFilter):
+
+    def __init__(self):
+        self.count = 0
+
+    def handle(self, client_request):
+        self.count = self.count + 1
+        return client_request.next_filter(self).handle(client_request)
+
+class RepeatFilter(ClientFilter):
+
+    def handle(self, client_request):
+        client_request.next_filter(self).handle(client_request)
+        return client_request.next_filter(self).handle(client_request)
+
+class TestFilterChain(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/': (200, {'Content-Type': 'text/plain'}, 'hello')
+        }).start()
+        self.client = Client.create()
+        self.resource = self.client.resource(self.server.url('/'))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testCompiledOnce(self):
+        self.resource.add_filter(CountingFilter())
+        self.resource.get()
+        chain = self.resource.filters.compile(self.client.actual_client)
+        self.resource.get()
+        self.assertTrue(chain is self.resource.filters.compile(self.client.actual_client))
+        self.resource.add_filter(CountingFilter())
+        self.assertEquals(3, len(self.resource.filters.compile(self.client.actual_client)))
+
+    def testDuplicateFilter(self):
+        counter = CountingFilter()
+        self.resource.filters = [counter, CountingFilter(), counter]
+        self.assertEquals('hello', self.resource.get().entity)
+        self.assertEquals(2, counter.count)
+
+    def testRepeatedNextFilter(self):
+        counter = CountingFilter()
+        self.resource.add_filter(counter).add_filter(RepeatFilter())
+        self.assertEquals('hello', self.resource.get().entity)
+        self.assertEquals(2, counter.count)
+        self.assertEquals(2, len(self.server.requests))
+
+class TestRetryFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.failures = 2
+        self.server = StubServer({
+            '/flaky': self.flaky,
+            '/later': (503, {'Retry-After': '2'}, ''),
+            '/never': (503, {'Retry-After': '120'}, '')
+        }).start()
+        self.client = Client.create()
+        self.filter = RetryFilter()
+        self.delays = []
+        self.filter.sleep = self.delays.append
+        self.client.add_filter(self.filter)
+
+    def flaky(self, handler):
+        if self.failures > 0:
+            self.failures = self.failures - 1
+            return (503, {'Content-Type': 'text/plain'}, 'unavailable')
+        return (200, {'Content-Type': 'text/plain'}, handler.body or 'ok')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testRetryStatus(self):
+        response = self.client.resource(self.server.url('/flaky')).get()
+        self.assertEquals(200, response.status)
+        self.assertEquals(3, len(self.server.requests))
+        self.assertEquals(2, self.filter.retries)
+        self.assertTrue(self.delays[0] <= 0.1 and self.delays[1] <= 0.2)
+
+    def testPostNotRetried(self):
+        response = self.client.resource(self.server.url('/flaky')).post('data')
+        self.assertEquals(503, response.status)
+        self.assertEquals(1, len(self.server.requests))
+        self.assertTrue(RetryFilter().methods is connections.IDEMPOTENT_METHODS)
+
+    def testRetryAfter(self):
+        response = self.client.resource(self.server.url('/later')).get()
+        self.assertEquals(503, response.status)
+        self.assertEquals([2.0, 2.0, 2.0], self.delays)
+        response = self.client.resource(self.server.url('/never')).get()
+        self.assertEquals(503, response.status)
+        self.assertEquals(5, len(self.server.requests))
+
+    def testRetryException(self):
+        resource = self.client.resource('http://127.0.0.1:1/')
+        self.assertRaises(urllib2.URLError, resource.get)
+        self.assertEquals(3, self.filter.retries)
+
+    def testBudget(self):
+        self.filter.budget = RetryBudget(ratio=0, minimum=1)
+        response = self.client.resource(self.server.url('/flaky')).get()
+        self.assertEquals(503, response.status)
+        self.assertEquals(1, self.filter.retries)
+        self.assertEquals(1, self.filter.exhausted)
+
+    def testFileRewound(self):
+        entity = StringIO.StringIO('file contents')
+        response = self.client.resource(self.server.url('/flaky')).put(entity)
+        self.assertEquals('file contents', response.entity)
+        self.assertEquals(['file contents'] * 3, [r[3] for r in self.server.requests])
+
+class TestCircuitBreakerFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.healthy = False
+        self.now = 1000.0
+        self.server = StubServer({
+            '/': self.service,
+            '/slow': self.slow
+        }).start()
+        self.client = Client.create()
+        self.filter = CircuitBreakerFilter(min_requests=4, reset_timeout=10, slow_duration=1.0)
+        self.filter.clock = lambda: self.now
+        self.client.add_filter(self.filter)
+        self.resource = self.client.resource(self.server.url('/'))
+
+    def service(self, handler):
+        if self.healthy:
+            return (200, {'Content-Type': 'text/plain'}, 'ok')
+        return (503, {'Content-Type': 'text/plain'}, 'unavailable')
+
+    def slow(self, handler):
+        self.now = self.now + 2
+        return (200, {'Content-Type': 'text/plain'}, 'slow')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def trip(self):
+        for i in range(4):
+            self.assertEquals(503, self.resource.get().status)
+
+    def testOpens(self):
+        self.assertEquals('closed', self.client.circuit_state(self.server.url('/')))
+        self.trip()
+        self.assertEquals('open', self.client.circuit_state(self.server.url('/')))
+        self.assertRaises(CircuitOpenError, self.resource.get)
+        self.assertEquals(4, len(self.server.requests))
+        self.assertEquals(1, self.filter.rejected)
+        self.assertEquals('closed', self.client.circuit_state('example.com'))
+
+    def testHalfOpen(self):
+        self.trip()
+        self.now = self.now + 10
+        self.assertEquals('half-open', self.client.circuit_state(self.server.url('/')))
+        self.assertEquals(503, self.resource.get().status)
+        self.assertEquals('open', self.client.circuit_state(self.server.url('/')))
+        self.now = self.now + 10
+        self.healthy = True
+        self.assertEquals(200, self.resource.get().status)
+        self.assertEquals('closed', self.client.circuit_state(self.server.url('/')))
+
+    def testSlowResponses(self):
+        resource = self.client.resource(self.server.url('/slow'))
+        for i in range(4):
+            self.assertEquals(200, resource.get().status)
+        self.assertEquals('open', self.client.circuit_state(self.server.url('/')))
+
+    def testNotRetried(self):
+        self.trip()
+        retry = RetryFilter()
+        retry.sleep = lambda delay: None
+        self.resource.add_filter(retry)
+        self.assertRaises(CircuitOpenError, self.resource.get)
+        self.assertEquals(0, retry.retries)
+
+class TestHedgingFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.server = StubServer({
+            '/': self.service
+        }).start()
+        self.client = Client.create()
+        self.filter = HedgingFilter(delay=0.05)
+        self.client.add_filter(self.filter)
+        self.resource = self.client.resource(self.server.url('/'))
+
+    def service(self, handler):
+        self.calls = self.calls + 1
+        if self.calls == 1:
+            time.sleep(0.5)
+            return (200, {'Content-Type': 'text/plain'}, 'slow')
+        return (200, {'Content-Type': 'text/plain'}, 'fast')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testHedgeWins(self):
+        start = time.time()
+        response = self.resource.get()
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEquals('fast', response.entity)
+        self.assertEquals(1, self.filter.hedged)
+        self.assertEquals(1, self.filter.wins)
+        self.assertEquals('fast', self.resource.get().entity)
+        self.assertEquals(1, self.filter.hedged)
+
+    def testPrimaryInline(self):
+        threads = []
+        class ThreadFilter(ClientFilter):
+            def handle(self, client_request):
+                threads.append(threading.currentThread())
+                return client_request.next_filter(self).handle(client_request)
+        client = Client.create()
+        client.add_filter(ThreadFilter())
+        client.add_filter(HedgingFilter(delay=1.0))
+        resource = client.resource(self.server.url('/'))
+        resource.get()
+        count = threading.activeCount()
+        for i in range(10):
+            self.assertEquals('fast', resource.get().entity)
+        self.assertEquals(count, threading.activeCount())
+        self.assertEquals([threading.currentThread()] * 11, threads)
+
+    def testHedgeAfterPrimaryFails(self):
+        self.calls = 1
+        client = Client.create()
+        client.add_filter(self.filter)
+        broken = [False, True]
+        class FailingFilter(ClientFilter):
+            def handle(self, client_request):
+                if broken.pop():
+                    time.sleep(0.1)
+                    raise urllib2.URLError('failed')
+                return client_request.next_filter(self).handle(client_request)
+        client.filters.append(FailingFilter())
+        self.assertEquals('fast', client.resource(self.server.url('/')).get().entity)
+        self.assertEquals(1, self.filter.wins)
+
+    def testPostNotHedged(self):
+        self.assertEquals('slow', self.resource.post('data').entity)
+        self.assertEquals(0, self.filter.hedged)
+
+    def testBudget(self):
+        self.filter.budget = RetryBudget(ratio=0, minimum=0)
+        self.assertEquals('slow', self.resource.get().entity)
+        self.assertEquals(0, self.filter.hedged)
+        self.assertEquals(1, self.filter.exhausted)
+
+    def testPercentileDelay(self):
+        hedging = HedgingFilter(delay=1.0, percentile=90)
+        self.assertEquals(1.0, hedging.hedge_delay())
+        for i in range(100):
+            hedging.record(i / 100.0)
+        self.assertEquals(0.9, hedging.hedge_delay())
+
+class TestMetricsFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/json': (200, {'Content-Type': 'application/json'}, '{"a": 1}'),
+            '/missing': (404, {'Content-Type': 'text/plain'}, 'missing')
+        }).start()
+        self.client = Client.create()
+        self.filter = MetricsFilter()
+        self.client.add_filter(self.filter)
+        self.host = host_key(self.server.url('/'))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def sample(self, metrics, name, **labels):
+        for sample in metrics.get(name, []):
+            if all([sample['labels'].get(k) == v for (k, v) in labels.items()]):
+                return sample
+        return None
+
+    def testSnapshot(self):
+        response = self.client.resource(self.server.url('/json')).get()
+        self.assertEquals({'a': 1}, response.parsed_entity)
+        self.client.resource(self.server.url('/missing')).put('data')
+        self.assertRaises(urllib2.URLError, self.client.resource('http://127.0.0.1:1/').get)
+        metrics = self.client.metrics()
+        self.assertEquals(1, self.sample(metrics, 'responses_total', method='GET', status='200')['value'])
+        self.assertEquals(1, self.sample(metrics, 'responses_total', method='PUT', status='404')['value'])
+        self.assertEquals(1, self.sample(metrics, 'errors_total', method='GET')['value'])
+        self.assertEquals(4, self.sample(metrics, 'request_bytes_total', method='PUT')['value'])
+        self.assertEquals(8, self.sample(metrics, 'response_bytes_total', method='GET', host=self.host)['value'])
+        self.assertEquals(0, self.sample(metrics, 'in_flight', host=self.host)['value'])
+        for phase in ['request_duration', 'connect', 'first_byte', 'read', 'parse']:
+            self.assertEquals(1, self.sample(metrics, phase + '_seconds', method='GET', host=self.host)['count'])
+
+    def testStreamingRead(self):
+        response = self.client.resource(self.server.url('/json')).get(stream=True)
+        metrics = self.filter.snapshot()
+        self.assertEquals(None, self.sample(metrics, 'read_seconds'))
+        self.assertEquals('{"a": 1}', ''.join(response.iter_content(3)))
+        metrics = self.filter.snapshot()
+        self.assertEquals(1, self.sample(metrics, 'read_seconds')['count'])
+        self.assertEquals(8, self.sample(metrics, 'response_bytes_total')['value'])
+
+    def testPrometheus(self):
+        self.client.resource(self.server.url('/json')).get()
+        text = self.client.metrics('prometheus')
+        self.assertTrue('# TYPE guernsey_responses_total counter\n' in text)
+        self.assertTrue('guernsey_responses_total{host="%s",method="GET",status="200"} 1\n' % self.host in text)
+        self.assertTrue('guernsey_request_duration_seconds_bucket{host="%s",method="GET",le="+Inf"} 1\n' % self.host in text)
+        self.assertEquals(None, Client.create().metrics())
+
+    def testPrometheusConsistent(self):
+        # record a new metric each time the lock is released, as another
+        # thread waiting on the lock would.
+        filter = self.filter
+        class RecordingLock(object):
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.releases = 0
+            def acquire(self):
+                self.lock.acquire()
+            def release(self):
+                self.lock.release()
+                self.releases = self.releases + 1
+                filter.counters[('late_%d_total' % self.releases, ())] = 1
+        filter.lock = RecordingLock()
+        text = filter.prometheus()
+        self.assertEquals(1, filter.lock.releases)
+        self.assertEquals('\n', text)
+
+    def testHistogram(self):
+        histogram = Histogram([0.1, 1.0])
+        for value in [0.05, 0.5, 5.0]:
+            histogram.observe(value)
+        self.assertEquals({'count': 3, 'sum': 5.55, 'buckets': [(0.1, 1), (1.0, 2)]}, histogram.snapshot())
+
+class SleepingFilter(ClientFilter):
+
+    def __init__(self, before, after):
+        self.before = before
+        self.after = after
+
+    def handle(self, client_request):
+        time.sleep(self.before)
+        client_response = client_request.next_filter(self).handle(client_request)
+        time.sleep(self.after)
+        return client_response
+
+class TestFilterProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/json': (200, {'Content-Type': 'application/json'}, '{"a": 1}')
+        }).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testPhases(self):
+        client = Client.create({'profile_filters': True})
+        client.add_filter(SleepingFilter(0.05, 0.1))
+        response = client.resource(self.server.url('/json')).get()
+        self.assertEquals({'a': 1}, response.parsed_entity)
+        phases = response.profile.phases()
+        self.assertEquals(['SleepingFilter', 'ExecClientFilter', 'parse_entity'], [p[0] for p in phases])
+        (name, calls, request, response) = phases[0]
+        self.assertEquals(1, calls)
+        # a loaded host can only make the sleeps longer
+        self.assertTrue(request >= 0.05)
+        self.assertTrue(response >= 0.1)
+        self.assertEquals(0.0, phases[1][3])
+
+    def testAggregate(self):
+        client = Client.create({'profile_filters': True})
+        client.add_filter(SleepingFilter(0, 0))
+        client.add_filter(RetryFilter(statuses=(200,), max_retries=1, backoff=0))
+        resource = client.resource(self.server.url('/json'))
+        for i in range(3):
+            resource.get().parsed_entity
+        summary = client.profiler.summary()
+        self.assertEquals(3, client.profiler.requests)
+        self.assertEquals(3, summary['RetryFilter']['calls'])
+        self.assertEquals(6, summary['SleepingFilter']['calls'])
+        self.assertEquals(6, summary['ExecClientFilter']['calls'])
+        self.assertEquals(3, summary['parse_entity']['calls'])
+
+    def testDisabled(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/json'))
+        response = resource.get()
+        self.assertTrue(response.profile is None)
+        self.assertTrue(client.profiler is None)
+        client.profiler = FilterProfiler()
+        self.assertFalse(resource.get().profile is None)
+        self.assertEquals(1, client.profiler.requests)
@@ -0,0 +1,80 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import datetime, unittest
+
+from guernsey import Client, ClientRequest, ClientResponse, WebResource
+from guernsey.headers import HeaderMap
+
+from stubserver import StubServer
+
+class TestHeaderMap(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = ['Content-Type: text/plain\r\n', 'X-Folded: a\r\n', '\tb\r\n', 'ETag: "1"\r\n']
+        self.headers = HeaderMap(self.lines)
+
+    def testLookup(self):
+        self.assertTrue(self.headers.index is None)
+        self.assertEquals('text/plain', self.headers['CONTENT-TYPE'])
+        self.assertEquals('a b', self.headers['x-folded'])
+        self.assertEquals(None, self.headers.get('missing'))
+        self.assertTrue('etag' in self.headers)
+        self.assertEquals(['content-type', 'etag', 'x-folded'], sorted(self.headers.keys()))
+        self.assertEquals({'content-type': 'text/plain', 'x-folded': 'a b', 'etag': '"1"'}, dict(self.headers))
+        self.assertRaises(KeyError, lambda: self.headers['missing'])
+
+    def testCopyOnWrite(self):
+        copy = self.headers.copy()
+        self.assertTrue(copy.lines is self.lines)
+        copy['Content-Type'] = 'application/json'
+        del copy['X-Folded']
+        self.assertEquals(['ETag: "1"\r\n', 'Content-Type: application/json\r\n'], copy.lines)
+        self.assertEquals('text/plain', self.headers['content-type'])
+        self.assertEquals(4, len(self.lines))
+        self.assertEquals({'a': '1'}, HeaderMap({'A': 1}))
+
+class TestCompactObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/dated': (200, {'Content-Type': 'text/plain', 'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT',
+                             'Location': '/other'}, 'dated')
+        }).start()
+        self.client = Client.create()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testLazyResponse(self):
+        parsed = []
+        parse_http_date = self.client.parse_http_date
+        def counting_parse(s):
+            parsed.append(s)
+            return parse_http_date(s)
+        self.client.parse_http_date = counting_parse
+        response = self.client.resource(self.server.url('/dated')).get()
+        self.assertTrue(response.headers.index is None)
+        self.assertEquals([], parsed)
+        self.assertEquals(datetime.datetime(1994, 11, 6, 8, 49, 37), response.last_modified)
+        self.assertEquals(datetime.datetime(1994, 11, 6, 8, 49, 37), response.last_modified)
+        self.assertEquals(['Sun, 06 Nov 1994 08:49:37 GMT'], parsed)
+        self.assertEquals(parse_http_date(response.headers['date']), response.response_date)
+        self.assertEquals(2, len(parsed))
+        self.assertEquals('/other', response.location)
+        self.assertEquals('text/plain', response.headers['Content-Type'])
+        response.type = 'application/json'
+        self.assertEquals('application/json', response.headers['content-type'])
+
+    def testSlots(self):
+        resource = self.client.resource(self.server.url('/dated'))
+        response = resource.get()
+        for value in [resource, response]:
+            self.assertFalse(hasattr(value, '__dict__'))
+        request = ClientRequest(resource, 'GET')
+        self.assertEquals({}, request.__dict__)
+        request.attempt = 1
+        self.assertEquals({'attempt': 1}, request.__dict__)
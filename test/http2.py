@@ -0,0 +1,342 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import socket, threading, time, unittest, urllib2
+
+try:
+    import h2.config, h2.connection, h2.events
+except ImportError:
+    h2 = None
+
+from guernsey import Client, ClientFilter, ClientRequest, ClientResponse
+from guernsey.http2 import Http2Transport
+
+from stubserver import StubServer
+
+class H2StubServer(object):
+    """ A local HTTP/2 over cleartext (h2c) server with prior knowledge,
+        answering requests from a ``routes`` dictionary in the same way as
+        :class:`StubServer`, except that route functions are given the
+        ``(headers, body)`` of the request. Each request is answered on its
+        own thread so that slow routes do not hold up other streams.
+    """
+    def __init__(self, routes=None):
+        self.routes = routes or {}
+        self.default = (200, {'content-type': 'text/plain'}, 'OK')
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.sockets = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+
+    def url(self, path='/'):
+        return 'http://127.0.0.1:%d%s' % (self.listener.getsockname()[1], path)
+
+    def start(self):
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.listener.close()
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except socket.error:
+                pass
+
+    def accept(self):
+        while True:
+            try:
+                (sock, address) = self.listener.accept()
+            except socket.error:
+                return
+            self.lock.acquire()
+            self.connections += 1
+            self.sockets.append(sock)
+            self.lock.release()
+            thread = threading.Thread(target=self.serve, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, sock):
+        connection = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        write_lock = threading.Lock()
+        def flush():
+            data = connection.data_to_send()
+            if len(data) > 0:
+                sock.sendall(data)
+        connection.initiate_connection()
+        flush()
+        requests = {}
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                return
+            if data == '':
+                return
+            write_lock.acquire()
+            try:
+                events = connection.receive_data(data)
+                for event in events:
+                    if isinstance(event, h2.events.RequestReceived):
+                        requests[event.stream_id] = (dict(event.headers), [])
+                    elif isinstance(event, h2.events.DataReceived):
+                        requests[event.stream_id][1].append(event.data)
+                        connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        (headers, body) = requests.pop(event.stream_id)
+                        thread = threading.Thread(target=self.respond,
+                            args=(connection, write_lock, flush, event.stream_id, headers, ''.join(body)))
+                        thread.daemon = True
+                        thread.start()
+                flush()
+            finally:
+                write_lock.release()
+
+    def respond(self, connection, write_lock, flush, stream_id, headers, body):
+        self.lock.acquire()
+        self.requests.append((headers[':method'], headers[':path'], headers, body))
+        self.lock.release()
+        route = self.routes.get(headers[':path'].split('?')[0], self.default)
+        if callable(route):
+            route = route(headers, body)
+        (status, response_headers, response_body) = route
+        write_lock.acquire()
+        try:
+            connection.send_headers(stream_id, [(':status', str(status))] +
+                [(k.lower(), v) for (k, v) in response_headers.items()] +
+                [('content-length', str(len(response_body)))], end_stream=len(response_body) == 0)
+            while len(response_body) > 0:
+                size = min(connection.local_flow_control_window(stream_id), connection.max_outbound_frame_size)
+                if size == 0:
+                    write_lock.release()
+                    time.sleep(0.01)
+                    write_lock.acquire()
+                    continue
+                connection.send_data(stream_id, response_body[:size], end_stream=len(response_body) <= size)
+                response_body = response_body[size:]
+                flush()
+            flush()
+        finally:
+            write_lock.release()
+
+LARGE = 'x' * (256 * 1024)
+
+class TestHttp2Transport(unittest.TestCase):
+
+    def setUp(self):
+        if h2 is None:
+            self.skipTest('the h2 package is not installed')
+        self.server = H2StubServer({
+            '/json': (200, {'Content-Type': 'application/json'}, '{"a": 1}'),
+            '/slow': self.slow,
+            '/large': (200, {'Content-Type': 'text/plain'}, LARGE),
+            '/echo': lambda headers, body: (201, {'Content-Type': 'text/plain'}, body),
+            '/redirect': (302, {'Location': '/json'}, ''),
+            '/away': lambda headers, body: (302, {'Location': self.plain.url('/plain')}, ''),
+            '/missing': (404, {'Content-Type': 'text/plain'}, 'missing')
+        }).start()
+        self.plain = StubServer().start()
+        self.client = Client.create({'transport': 'http2', 'max_workers': 10})
+
+    def slow(self, headers, body):
+        time.sleep(0.2)
+        return (200, {'Content-Type': 'text/plain'}, 'slow')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.plain.stop()
+
+    def testGet(self):
+        response = self.client.resource(self.server.url('/json')).get()
+        self.assertEquals(200, response.status)
+        self.assertEquals({'a': 1}, response.parsed_entity)
+        self.assertEquals('application/json', response.type)
+        self.assertTrue('first_byte' in response.timings)
+
+    def testMultiplexing(self):
+        resource = self.client.resource(self.server.url('/slow'))
+        start = time.time()
+        futures = [resource.get_async() for i in range(10)]
+        self.assertEquals(['slow'] * 10, [f.result(5).entity for f in futures])
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEquals(1, self.server.connections)
+        self.assertEquals(1, self.client.actual_client.opened)
+
+    def testLargeEntities(self):
+        response = self.client.resource(self.server.url('/large')).get(stream=True)
+        self.assertEquals(LARGE, ''.join(response.iter_content(1000)))
+        response = self.client.resource(self.server.url('/echo')).post(LARGE)
+        self.assertEquals(201, response.status)
+        self.assertEquals(LARGE, response.entity)
+        self.assertEquals(str(len(LARGE)), self.server.requests[-1][2]['content-length'])
+
+    def testRedirectToFallback(self):
+        transport = self.client.actual_client
+        transport.plain.add(('http', '127.0.0.1', self.plain.server_address[1]))
+        transport.fallback = RecordingTransport(transport.fallback)
+        response = self.client.resource(self.server.url('/away')).post('data')
+        self.assertEquals('OK', response.entity)
+        self.assertEquals([self.plain.url('/plain')], transport.fallback.urls)
+        self.assertEquals([('GET', '/plain', '')], [r[0:2] + (r[3],) for r in self.plain.requests])
+
+    def testTimeoutResetsStream(self):
+        resource = self.client.resource(self.server.url('/slow'))
+        self.assertRaises(urllib2.URLError, resource.get, None, 0.05)
+        connection = self.client.actual_client.connections.values()[0]
+        self.assertEquals({}, connection.streams)
+
+    def testRedirectAndError(self):
+        response = self.client.resource(self.server.url('/redirect')).get()
+        self.assertEquals({'a': 1}, response.parsed_entity)
+        self.assertEquals(self.server.url('/json'), response.url)
+        self.assertEquals(404, self.client.resource(self.server.url('/missing')).get().status)
+
+class RecordingTransport(ClientFilter):
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.urls = []
+
+    def handle(self, client_request):
+        self.urls.append(client_request.url)
+        return self.transport.handle(client_request)
+
+class NoH2Transport(Http2Transport):
+    """ An :class:`Http2Transport` for servers which never negotiate 
+        HTTP/2, as no HTTP/2 connection is ever made it does not need the
+        ``h2`` package.
+    """
+    def __init__(self, fallback, ssl_context):
+        self.fallback = fallback
+        self.ssl_context = ssl_context
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.connecting = {}
+        self.plain = set()
+        self.opened = 0
+
+class NoAlpnSocket(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def selected_alpn_protocol(self):
+        return 'http/1.1'
+
+    def close(self):
+        self.sock.close()
+
+class NoAlpnContext(object):
+    """ Stands in for the ``ssl.SSLContext`` of a server which only speaks
+        HTTP/1.1, the socket is not actually wrapped so any plain server may
+        play the part. The handshake with ``slow_port`` waits for 
+        ``proceed`` to be set.
+    """
+    def __init__(self, slow_port=None):
+        self.slow_port = slow_port
+        self.proceed = threading.Event()
+
+    def wrap_socket(self, sock, server_hostname=None):
+        if sock.getpeername()[1] == self.slow_port:
+            self.proceed.wait(5)
+        return NoAlpnSocket(sock)
+
+class PlainTransport(ClientFilter):
+    """ A fallback transport which records each request and sends it to
+        the plain server standing in for an ``https`` one.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.requests = []
+
+    def handle(self, client_request):
+        self.requests.append((client_request.method, client_request.url, client_request.entity))
+        request = client_request.copy()
+        request.url = request.url.replace('https:', 'http:', 1)
+        return self.transport.handle(request)
+
+class TestTransports(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testCustomTransport(self):
+        client = Client.create()
+        transport = RecordingTransport(client.actual_client)
+        client = Client.create({'transport': transport})
+        self.assertEquals('OK', client.resource(self.server.url('/')).get().entity)
+        self.assertEquals([self.server.url('/')], transport.urls)
+
+    def testReplaceTransport(self):
+        client = Client.create()
+        resource = client.resource(self.server.url('/'))
+        resource.get()
+        client.actual_client = RecordingTransport(client.actual_client)
+        resource.get()
+        self.assertEquals(1, len(client.actual_client.urls))
+
+    def testFallbackRequest(self):
+        if h2 is None:
+            transport = object.__new__(Http2Transport)
+        else:
+            transport = Http2Transport()
+        request = ClientRequest(Client.create().resource(self.server.url('/')), 'POST')
+        request.entity = 'data'
+        self.assertTrue(transport.fallback_request(request, request.url, 'POST', 'data') is request)
+        redirected = transport.fallback_request(request, self.server.url('/other'), 'GET', None)
+        self.assertEquals((self.server.url('/other'), 'GET', None),
+            (redirected.url, redirected.method, redirected.entity))
+        self.assertEquals((self.server.url('/'), 'POST', 'data'), (request.url, request.method, request.entity))
+
+    def testAlpnFallback(self):
+        client = Client.create()
+        fallback = PlainTransport(client.actual_client)
+        transport = NoH2Transport(fallback, NoAlpnContext())
+        client.actual_client = transport
+        url = self.server.url('/').replace('http:', 'https:', 1)
+        self.assertEquals('OK', client.resource(url).post('data').entity)
+        self.assertEquals('OK', client.resource(url).get().entity)
+        self.assertEquals([('POST', url, 'data'), ('GET', url, None)], fallback.requests)
+        self.assertEquals(set([('https', '127.0.0.1', self.server.server_address[1])]), transport.plain)
+        self.assertEquals(0, transport.opened)
+        self.assertEquals(2, len(self.server.requests))
+
+    def testConnectOneHostAtATime(self):
+        slow = StubServer().start()
+        try:
+            context = NoAlpnContext(slow.server_address[1])
+            transport = NoH2Transport(PlainTransport(None), context)
+            thread = threading.Thread(target=transport.connection,
+                args=(('https', '127.0.0.1', slow.server_address[1]), 5))
+            thread.daemon = True
+            thread.start()
+            time.sleep(0.1)
+            # the slow handshake must not hold up a different server
+            self.assertEquals((None, False), transport.connection(('https', '127.0.0.1', self.server.server_address[1]), 5))
+            self.assertTrue(thread.is_alive())
+            context.proceed.set()
+            thread.join(5)
+            self.assertEquals(2, len(transport.plain))
+        finally:
+            slow.stop()
+
+    def testMissingH2(self):
+        if not h2 is None:
+            self.skipTest('the h2 package is installed')
+        self.assertRaises(ImportError, Client.create, {'transport': 'http2'})
@@ -4,9 +4,13 @@
 # See LICENSE.txt included in this distribution or more details.
 #
 
-import unittest
+import threading, unittest, urlparse
 
-from guernsey import Client
+from guernsey import Client, ClientFilter
+from guernsey import urls
+from guernsey.urls import UriTemplate, join_url, split_url
+
+from stubserver import StubServer
 
 class TestPathConstruction(unittest.TestCase):
 
@@ -101,3 +105,162 @@ class TestPathConstruction(unittest.TestCase):
         r = r.sub_resource("/add5/")
         self.assertEquals("http://example.com/base/add1/add2/add3/add5/?q=my+query&return=std&page=1&format=json", r.url)
 
+
+class TestUrlDerivation(unittest.TestCase):
+
+    BASES = ['http://a/b/c/d;p?q#f', 'http://example.com/base', 'http://example.com/add1/#frag']
+    RELATIVES = ['g', './g', 'g/', '/g', '//g', '?y', 'g?y#s', '#s', ';x', '', '.', '..', '../g',
+                 '../../../g', '/./g', 'g/../h', 'https://other/x', 'http:g', '//otherhost/x',
+                 '//user@otherhost:8080/x?y#z']
+
+    def testJoinMatchesUrljoin(self):
+        for base in self.BASES:
+            for relative in self.RELATIVES:
+                self.assertEquals(urlparse.urljoin(base, relative, True),
+                    urlparse.urlunparse(join_url(split_url(base), relative)))
+
+    def testDerivedParts(self):
+        c = Client.create()
+        r = c.resource('http://example.com/base?a=1')
+        self.assertTrue(r.parts is split_url('http://example.com/base?a=1'))
+        child = r.sub_resource('items').query_params({'b': 2}).path('#top')
+        self.assertEquals('http://example.com/base/items?a=1&b=2#top', child.url)
+        self.assertEquals(('http', 'example.com', '/base/items', '', 'a=1&b=2', 'top'), child.parts)
+        self.assertTrue(child.clone().parts is child.parts)
+        child.url = 'https://example.org/'
+        self.assertEquals('example.org', child.parts.netloc)
+        self.assertRaises(ValueError, setattr, child, 'url', '/relative')
+        self.assertRaises(ValueError, r.path, 'mailto:someone')
+
+    def testSchemeRelativeAndAbsolute(self):
+        c = Client.create()
+        r = c.resource('http://example.com/base/')
+        self.assertEquals('http://otherhost/x', r.path('//otherhost/x').url)
+        self.assertEquals('https://otherhost/x', c.resource('https://example.com/').path('//otherhost/x').url)
+        self.assertEquals('https://other/y?z=1', r.path('https://other/y?z=1').url)
+        self.assertEquals(('https', 'other', '/y', '', 'z=1', ''), r.path('https://other/y?z=1').parts)
+        # the result must not depend on what the split cache holds
+        urls._split_cache.clear()
+        self.assertEquals('http://otherhost/x', r.path('//otherhost/x').url)
+        split_url('//otherhost/x', 'http')
+        self.assertEquals('http://otherhost/x', r.path('//otherhost/x').url)
+
+class TestUriTemplate(unittest.TestCase):
+
+    VARIABLES = {'var': 'value', 'hello': 'Hello World!', 'path': '/foo/bar', 'empty': '',
+                 'x': 1024, 'y': 768, 'list': ['red', 'green', 'blue'], 'undef': None}
+
+    EXAMPLES = [
+        ('{var}', 'value'), ('{hello}', 'Hello%20World%21'), ('{+hello}', 'Hello%20World!'),
+        ('{+path}/here', '/foo/bar/here'), ('X{#hello}', 'X#Hello%20World!'),
+        ('map?{x,y}', 'map?1024,768'), ('{+path,x}/here', '/foo/bar,1024/here'),
+        ('X{.x,y}', 'X.1024.768'), ('{/var,x}/here', '/value/1024/here'),
+        ('{;x,y,empty}', ';x=1024;y=768;empty'), ('{?x,y,empty}', '?x=1024&y=768&empty='),
+        ('?fixed=yes{&x}', '?fixed=yes&x=1024'), ('{list}', 'red,green,blue'),
+        ('{var}{undef}{?undef}', 'value'), ('/%7E{/hello}', '/%7E/Hello%20World%21')]
+
+    def testExpansion(self):
+        for (template, expected) in self.EXAMPLES:
+            self.assertEquals(expected, UriTemplate(template).expand(self.VARIABLES))
+        self.assertEquals('/a/b', UriTemplate('/{x}/{y}').expand({'x': 'a'}, y='b'))
+
+    def testInvalid(self):
+        for template in ['{var:3}', '{list*}', '{=var}', '{var', 'var}', '{a b}']:
+            self.assertRaises(ValueError, UriTemplate, template)
+
+    def testStrict(self):
+        self.assertEquals('/', UriTemplate('/{missing}').expand())
+        self.assertRaises(KeyError, UriTemplate('/{missing}', True).expand)
+        self.assertTrue(UriTemplate.compile('/{a}', True) is UriTemplate.compile('/{a}', True))
+
+    def testLegacyNames(self):
+        c = Client.create()
+        r = c.resource('http://example.com/{user-id}', {'user-id': 1})
+        self.assertEquals('http://example.com/1', r.url)
+        self.assertEquals('http://example.com/1/items/a b', r.path('1/items/{item name}', {'item name': 'a b'}).url)
+        self.assertRaises(KeyError, c.resource, 'http://example.com/{user-id}', {})
+
+    def testResources(self):
+        c = Client.create()
+        template = UriTemplate('http://example.com/{service}{/id}{?q}')
+        r = c.resource(template, {'service': 'search', 'q': 'a b'})
+        self.assertEquals('http://example.com/search?q=a%20b', r.url)
+        self.assertEquals('http://example.com/search/items/a%2Fb',
+            r.path('search/items/{id}', {'id': 'a/b'}).url)
+        self.assertEquals('http://example.com/search/1',
+            r.path(UriTemplate('{/service,id}'), {'service': 'search', 'id': 1}).url)
+        self.assertEquals('https://example.org/1', r.path(UriTemplate('https://example.org/{id}'), {'id': 1}).url)
+
+class NamedFilter(ClientFilter):
+
+    def handle(self, client_request):
+        return client_request.next_filter(self).handle(client_request)
+
+class TestImmutableResources(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.client = Client.create()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testCopyOnWrite(self):
+        r = self.client.resource(self.server.url('/')).accept('text/plain')
+        r2 = r.clone()
+        self.assertTrue(r2.headers is r.headers)
+        self.assertTrue(r2.filters is r.filters)
+        r2.accept('text/xml')
+        self.assertEquals('text/plain', r.headers['Accept'])
+        self.assertEquals('text/plain, text/xml', r2.headers['Accept'])
+        self.assertTrue(r2.filters is r.filters)
+        entity = {'a': [1]}
+        self.assertTrue(r.entity(entity).clone().req_entity is entity)
+
+    def testFiltersNotShared(self):
+        r = self.client.resource(self.server.url('/'))
+        r.add_filter(NamedFilter())
+        self.assertEquals(1, len(r.filters))
+        self.assertEquals(0, len(self.client.filters))
+        self.assertEquals(0, len(self.client.resource(self.server.url('/')).filters))
+
+    def testImmutable(self):
+        base = self.client.resource(self.server.url('/')).accept('text/plain').freeze()
+        self.assertTrue(base.freeze() is base)
+        derived = base.accept('text/xml').type('text/plain').entity('data').add_filter(NamedFilter())
+        self.assertFalse(derived is base)
+        self.assertTrue(derived.immutable)
+        self.assertEquals({'Accept': 'text/plain'}, base.headers)
+        self.assertEquals(None, base.req_entity)
+        self.assertEquals(0, len(base.filters))
+        self.assertEquals('text/plain, text/xml', derived.headers['Accept'])
+        self.assertEquals(1, len(derived.filters))
+        self.assertTrue(base.stream().timeout(1, 2).deadline(3).streaming)
+        self.assertFalse(base.streaming)
+        self.assertTrue(base.path('child').immutable)
+        self.assertEquals('OK', base.post('posted').entity)
+        self.assertEquals(None, base.req_entity)
+        self.assertEquals('posted', self.server.requests[-1][3])
+        self.assertTrue(Client.create({'immutable_resources': True}).resource(self.server.url('/')).immutable)
+
+    def testSharedBetweenThreads(self):
+        base = self.client.resource(self.server.url('/')).add_header('X-Base', 'yes').freeze()
+        errors = []
+        def run(n):
+            try:
+                for i in range(5):
+                    response = base.add_header('X-Thread', str(n)).get()
+                    if response.entity != 'OK':
+                        errors.append(response.status)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals([], errors)
+        self.assertEquals({'X-Base': 'yes'}, base.headers)
+        self.assertEquals(20, len(self.server.requests))
+        self.assertEquals(set([str(n) for n in range(4)]),
+            set([request[2]['x-thread'] for request in self.server.requests]))
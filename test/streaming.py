@@ -0,0 +1,233 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import gzip, hashlib, json, mmap, os, StringIO, tempfile, unittest
+
+from guernsey import Client
+from guernsey.entities import JsonStream, JsonStreamReader, XmlStreamReader
+from guernsey.filters import *
+
+from stubserver import StubServer
+
+def compress(data):
+    buffer = StringIO.StringIO()
+    encoder = gzip.GzipFile(fileobj=buffer, mode='wb')
+    encoder.write(data)
+    encoder.close()
+    return buffer.getvalue()
+
+LARGE = ''.join(['line %06d\n' % i for i in range(20000)])
+
+class TestStreamingResponses(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/large': (200, {'Content-Type': 'text/plain'}, LARGE),
+            '/json': (200, {'Content-Type': 'application/json'}, '{"a": [1, 2]}'),
+            '/gzip': (200, {'Content-Type': 'text/plain', 'Content-Encoding': 'gzip'}, compress(LARGE)),
+            '/md5': (200, {'Content-Type': 'text/plain', 'Content-MD5': hashlib.md5(LARGE).hexdigest()}, LARGE),
+            '/badmd5': (200, {'Content-Type': 'text/plain', 'Content-MD5': 'bad'}, LARGE)
+        }).start()
+        self.client = Client.create()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testIterContent(self):
+        response = self.client.resource(self.server.url('/large')).stream().get()
+        self.assertTrue(response.streaming)
+        chunks = list(response.iter_content(1024))
+        self.assertEquals(1024, len(chunks[0]))
+        self.assertEquals(LARGE, ''.join(chunks))
+        self.assertTrue(response.body is None)
+        self.assertEquals(1, self.client.connection_pool.size())
+
+    def testDeferredParse(self):
+        response = self.client.resource(self.server.url('/json')).get(stream=True)
+        self.assertFalse(response.body is None)
+        self.assertEquals({'a': [1, 2]}, response.parsed_entity)
+        self.assertTrue(response.body is None)
+        self.assertEquals('{"a": [1, 2]}', response.entity)
+        response.entity = '{"b": 3}'
+        self.assertEquals({'b': 3}, response.parse())
+
+    def testClose(self):
+        response = self.client.resource(self.server.url('/large')).get(stream=True)
+        self.assertEquals(1024, len(response.body.read(1024)))
+        response.close()
+        self.assertEquals(0, self.client.connection_pool.size())
+
+    def testGzipStream(self):
+        resource = self.client.resource(self.server.url('/gzip'))
+        resource.add_filter(GzipContentEncodingFilter())
+        response = resource.get(stream=True)
+        self.assertEquals(LARGE, ''.join(response.iter_content(100)))
+        self.assertEquals(LARGE, resource.get().entity)
+
+    def testMd5Stream(self):
+        resource = self.client.resource(self.server.url('/md5'))
+        resource.add_filter(ContentMd5Filter())
+        response = resource.get(stream=True)
+        self.assertEquals(LARGE, ''.join(response.iter_content()))
+        response = self.client.resource(self.server.url('/badmd5')).add_filter(ContentMd5Filter()).get(stream=True)
+        self.assertRaises(ValueError, lambda: list(response.iter_content()))
+
+class TestStreamingRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/echo': lambda h: (200, {'Content-Type': 'text/plain'}, h.body)
+        }).start()
+        self.client = Client.create()
+        self.resource = self.client.resource(self.server.url('/echo'))
+        (fd, self.filename) = tempfile.mkstemp()
+        os.write(fd, LARGE)
+        os.close(fd)
+
+    def tearDown(self):
+        self.server.stop()
+        os.remove(self.filename)
+
+    def lastHeaders(self):
+        return self.server.requests[-1][2]
+
+    def testFileEntity(self):
+        fp = open(self.filename, 'rb')
+        response = self.resource.put(fp)
+        fp.close()
+        self.assertEquals(LARGE, response.entity)
+        self.assertEquals(str(len(LARGE)), self.lastHeaders()['content-length'])
+
+    def testMmapEntity(self):
+        fp = open(self.filename, 'rb')
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        response = self.resource.post(data)
+        data.close()
+        fp.close()
+        self.assertEquals(LARGE, response.entity)
+        self.assertEquals(str(len(LARGE)), self.lastHeaders()['content-length'])
+
+    def testGeneratorEntity(self):
+        def chunks():
+            for i in range(3):
+                yield 'chunk %d;' % i
+        response = self.resource.put(chunks())
+        self.assertEquals('chunk 0;chunk 1;chunk 2;', response.entity)
+        self.assertEquals('chunked', self.lastHeaders()['transfer-encoding'])
+
+    def testWrittenEntity(self):
+        response = self.resource.type('application/json').put({'a': 1})
+        self.assertEquals('{"a": 1}', response.entity)
+
+    def testMd5OfFile(self):
+        self.resource.add_filter(ContentMd5Filter())
+        fp = open(self.filename, 'rb')
+        response = self.resource.put(fp)
+        fp.close()
+        self.assertEquals(LARGE, response.entity)
+        self.assertEquals(hashlib.md5(LARGE).hexdigest(), self.lastHeaders()['content-md5'])
+
+RECORDS = [{'id': i, 'name': 'record %d' % i, 'value': i * 1.5} for i in range(2000)]
+
+class TestStreamingJson(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/array': (200, {'Content-Type': 'application/json'}, json.dumps(RECORDS)),
+            '/lines': (200, {'Content-Type': 'application/x-ndjson'}, 
+                '\n'.join([json.dumps(r) for r in RECORDS[:10]]) + '\n'),
+            '/echo': lambda h: (200, {'Content-Type': 'application/json'}, h.body)
+        }).start()
+        self.client = Client.create()
+        self.client.entity_classes.register(JsonStreamReader(1024), first=True)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testStreamArray(self):
+        response = self.client.resource(self.server.url('/array')).get(stream=True)
+        records = response.parsed_entity
+        self.assertEquals(RECORDS[0], records.next())
+        self.assertFalse(response.body is None)
+        self.assertEquals(RECORDS[1:], list(records))
+        self.assertTrue(response.body is None)
+
+    def testDocumentedRegistration(self):
+        client = Client.create()
+        reader = JsonStreamReader()
+        client.entity_classes.register(reader, first=True)
+        self.assertTrue(client.entity_classes.reader_for('application/json') is reader)
+        self.assertTrue(client.entity_classes.reader_for('application/x-ndjson') is reader)
+
+    def testStreamLines(self):
+        response = self.client.resource(self.server.url('/lines')).get(stream=True)
+        self.assertEquals(RECORDS[:10], list(response.parsed_entity))
+
+    def testChunkBoundaries(self):
+        reader = JsonStreamReader()
+        data = ' [ 1234567, "a, b]", {"c": [true, null]}, -1.5e3 ] '
+        for size in range(1, len(data)):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEquals([1234567, 'a, b]', {'c': [True, None]}, -1500.0],
+                list(reader.read_stream(chunks, 'application/json')))
+        self.assertEquals([], list(reader.read('[]', 'application/json')))
+        self.assertEquals([1, 2], list(reader.read('1 2', 'application/json')))
+        self.assertRaises(ValueError, lambda: list(reader.read('[1 2]', 'application/json')))
+        self.assertRaises(ValueError, lambda: list(reader.read('[1, {"a"', 'application/json')))
+
+    def testWriteStream(self):
+        def records():
+            for record in RECORDS:
+                yield record
+        resource = self.client.resource(self.server.url('/echo')).type('application/json')
+        response = resource.post(JsonStream(records()))
+        self.assertEquals('chunked', self.server.requests[-1][2]['transfer-encoding'])
+        self.assertEquals(RECORDS, json.loads(response.entity))
+        response = resource.post(JsonStream([]))
+        self.assertEquals([], json.loads(response.entity))
+
+FEED = ''.join(['<Envelope xmlns="urn:feed"><Header><record id="header"/></Header><Body>'] +
+    ['<record id="%d"><name>record %d</name></record>' % (i, i) for i in range(5000)] +
+    ['</Body></Envelope>'])
+
+class TestStreamingXml(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/feed': (200, {'Content-Type': 'application/soap+xml'}, FEED)
+        }).start()
+        self.client = Client.create()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testStreamRecords(self):
+        self.client.entity_classes.register(XmlStreamReader('Body/record', 1024), first=True)
+        response = self.client.resource(self.server.url('/feed')).get(stream=True)
+        records = response.parsed_entity
+        first = records.next()
+        self.assertEquals('{urn:feed}record', first.tag)
+        self.assertEquals('0', first.get('id'))
+        self.assertFalse(response.body is None)
+        rest = list(records)
+        self.assertEquals(4999, len(rest))
+        self.assertEquals('4999', rest[-1].get('id'))
+        self.assertEquals('record 0', first[0].text)
+
+    def testDocumentedRegistration(self):
+        reader = XmlStreamReader('record')
+        self.client.entity_classes.register(reader, first=True)
+        self.assertTrue(self.client.entity_classes.reader_for('application/soap+xml') is reader)
+        response = self.client.resource(self.server.url('/feed')).get()
+        self.assertEquals(5001, len(list(response.parsed_entity)))
+
+    def testPaths(self):
+        reader = XmlStreamReader('record')
+        self.assertEquals(5001, len(list(reader.read(FEED, 'application/xml'))))
+        reader = XmlStreamReader('/Envelope/Header/{urn:feed}record')
+        self.assertEquals(['header'], [e.get('id') for e in reader.read(FEED, 'application/xml')])
+        reader = XmlStreamReader('/record')
+        self.assertEquals([], list(reader.read(FEED, 'application/xml')))
@@ -0,0 +1,103 @@
+#
+# Guernsey REST client package, based on the Java Jersey client.
+# Copyright (c) 2011 Simon Johnston (simon@johnstonshome.org)
+# See LICENSE.txt included in this distribution or more details.
+#
+
+import BaseHTTPServer, socket, SocketServer, threading
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Request handler for :class:`StubServer`, every method is answered
+        from the server's ``routes`` dictionary which maps a path to either
+        a tuple ``(status, headers, body)`` or a function taking the
+        handler and returning such a tuple.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.lock.acquire()
+        self.server.connections += 1
+        self.server.sockets.append(self.connection)
+        self.server.lock.release()
+
+    def read_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline().strip() != '':
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return ''.join(chunks)
+        length = int(self.headers.get('content-length', 0))
+        if length > 0:
+            return self.rfile.read(length)
+        return ''
+
+    def respond(self):
+        self.body = self.read_body()
+        self.server.lock.acquire()
+        self.server.requests.append((self.command, self.path, self.headers, self.body))
+        self.server.lock.release()
+        route = self.server.routes.get(self.path.split('?')[0], self.server.default)
+        if callable(route):
+            route = route(self)
+        (status, headers, body) = route
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if not 'Content-Length' in headers and not 'Transfer-Encoding' in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD' and status not in (204, 304):
+            self.wfile.write(body)
+        if headers.get('Connection', '').lower() == 'close':
+            self.close_connection = 1
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = do_OPTIONS = respond
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A local, in-process, HTTP/1.1 server used by the tests. The server
+        listens on an ephemeral port on the loopback interface and counts
+        the number of connections accepted and the requests received.
+    """
+    daemon_threads = True
+
+    def __init__(self, routes=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.routes = routes or {}
+        self.default = (200, {'Content-Type': 'text/plain'}, 'OK')
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.sockets = []
+        self.thread = None
+
+    def url(self, path='/'):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for s in self.sockets:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        # connections are routinely dropped by the tests.
+        pass
@@ -2,6 +2,13 @@ from paths import *
 from chaining import *
 from filters import *
 from entities import *
+from connections import *
+from executor import *
+from streaming import *
+from cache import *
+from http2 import *
+from headers import *
+from benchmark import TestBenchmark
 
 if __name__ == '__main__':
     import unittest